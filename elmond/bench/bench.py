@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+'''
+Microbenchmarks for the data and metadata hot paths of elmond. Elasticsearch
+is replaced with recorded or generated responses (see corpus.py) so only
+elmond's own work is timed. Results are written as JSON that can be compared
+across commits:
+
+    bench.py run --output before.json
+    bench.py run --output after.json
+    bench.py compare before.json after.json
+
+The corpus subcommand saves the generated responses to a directory and
+record saves responses from a real elastic. Either can be given to run with
+--corpus in place of the generated ones.
+'''
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "elmond"))
+
+from columns import np
+from corpus import CorpusES, build_data_response, build_metadata_response, data_cases, load_response, save_response, ROLLUP_WINDOWS, RESULT_INTERVAL
+from data import EsmondData
+from flask import Flask
+from metadata import EsmondMetadata
+from response import build_writer, FORMAT_CSV, FORMAT_JSON, FORMAT_MSGPACK, FORMAT_NDJSON
+
+log = logging.getLogger('elmond')
+
+DEFAULT_SIZES = "100,1000,10000"
+DEFAULT_METADATA_SIZES = "100,1000,5000"
+DEFAULT_REPEAT = 5
+DEFAULT_THRESHOLD = 0.1
+#Name of the metadata response in a corpus directory
+METADATA_CASE = "metadata"
+#Metadata key used for the generated data
+BENCH_METADATA_KEY = "bench"
+WRITER_FORMATS = [FORMAT_JSON, FORMAT_NDJSON, FORMAT_CSV, FORMAT_MSGPACK]
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def measure(func, repeat):
+    '''
+    Runs func once to warm up and then repeat times. Returns the number of
+    results func returned, the fastest and median time and the peak memory
+    allocated by a separate run.
+    '''
+    count = func()
+    times = []
+    for i in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    #tracing slows everything down so it gets its own run
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    median = statistics.median(times)
+    return {
+        "results": count,
+        "min-seconds": min(times),
+        "median-seconds": median,
+        "results-per-second": (count / median) if median else None,
+        "peak-bytes": peak
+    }
+
+class Bench:
+    '''
+    Runs the benchmarks selected by a regular expression on their names
+    '''
+
+    def __init__(self, corpus_dir=None, repeat=DEFAULT_REPEAT, name_filter=None):
+        self.corpus_dir = corpus_dir
+        self.repeat = repeat
+        self.name_filter = re.compile(name_filter) if name_filter else None
+        self.results = {}
+
+    def _wanted(self, name):
+        return self.name_filter is None or self.name_filter.search(name) is not None
+
+    def _run(self, name, func):
+        if not self._wanted(name):
+            return
+        result = measure(func, self.repeat)
+        self.results[name] = result
+        log.info("{0:<60} {1:>8} results {2:>10.2f} ms {3:>12.0f} results/s {4:>8.1f} MiB".format(
+            name, result["results"], result["median-seconds"] * 1000, result["results-per-second"] or 0, result["peak-bytes"] / 1048576.0))
+
+    def _data_response(self, name, event_type, summary_type, summary_window, size):
+        response = load_response(self.corpus_dir, name)
+        if response is None:
+            hits = size
+            if summary_window and summary_window not in ROLLUP_WINDOWS:
+                #merged windows are built from the raw results in each window
+                hits = size * max(summary_window // RESULT_INTERVAL, 1)
+            response = build_data_response(event_type, summary_type, summary_window, hits)
+        return response
+
+    def run_data(self, sizes):
+        for name, event_type, summary_type, summary_window in data_cases():
+            if not any(self._wanted("{0}/{1}/{2}".format(step, name, size)) for step in ["fetch", "parse"] + ["write-" + f for f in WRITER_FORMATS] for size in sizes):
+                continue
+            response = self._data_response(name, event_type, summary_type, summary_window, max(sizes))
+            metadata_key = response.get("metadata-key", BENCH_METADATA_KEY)
+            esd = EsmondData(CorpusES(response))
+            for size in sizes:
+                q = { "limit": str(size) }
+                def fetch():
+                    return len(esd.fetch(metadata_key, event_type, summary_type, summary_window, q=q))
+                self._run("fetch/{0}/{1}".format(name, size), fetch)
+
+                query = esd.prepare_fetch(metadata_key, event_type, summary_type, summary_window, q=q)
+                if query is not None:
+                    hits = response["hits"]["hits"][:size]
+                    def parse():
+                        return len(esd.parse_hits(metadata_key, query, hits))
+                    self._run("parse/{0}/{1}".format(name, size), parse)
+
+                data = esd.fetch(metadata_key, event_type, summary_type, summary_window, q=q)
+                for fmt in WRITER_FORMATS:
+                    writer = build_writer(fmt)
+                    def write():
+                        writer.write_list(data).get_data()
+                        return len(data)
+                    self._run("write-{0}/{1}/{2}".format(fmt, name, size), write)
+
+    def run_metadata(self, sizes):
+        response = load_response(self.corpus_dir, METADATA_CASE)
+        if response is None:
+            response = build_metadata_response(max(sizes))
+        emd = EsmondMetadata(CorpusES(response))
+        buckets = response.get("aggregations", {}).get("tests", {}).get("buckets", [])
+        for size in sizes:
+            q = { "limit": str(size) }
+            def search():
+                return len(emd.search(q=q, request_url="http://localhost/esmond/perfsonar/archive/", paginate=True))
+            self._run("metadata-search/{0}".format(size), search)
+
+            sources = [(b["key"]["checksum"], b["test_params"]["hits"]["hits"][0]["_source"]) for b in buckets[:size]]
+            def build_md():
+                return len([emd._build_md_obj(md_key, source) for md_key, source in sources])
+            self._run("metadata-parse/{0}".format(size), build_md)
+
+            data = emd.search(q=q)
+            writer = build_writer(FORMAT_JSON)
+            def write():
+                writer.write_list(data).get_data()
+                return len(data)
+            self._run("write-json/metadata/{0}".format(size), write)
+
+class RecordingES:
+    '''
+    Wraps an elasticsearch client and keeps the hits and aggregations of
+    every search so the searches for one case can be saved as one response
+    '''
+
+    def __init__(self, es):
+        self.es = es
+        self.response = None
+
+    def search(self, **kwargs):
+        res = self.es.search(**kwargs)
+        if self.response is None:
+            self.response = res
+        else:
+            self.response["hits"]["hits"].extend(res.get("hits", {}).get("hits", []))
+        return res
+
+    def take(self):
+        response = self.response
+        self.response = None
+        return response
+
+def record(es, corpus_dir, sizes, metadata_sizes):
+    '''
+    Saves a metadata response and a data response for each case from a real
+    elastic. Each data case uses the first test that has its event type.
+    '''
+    res = RecordingES(es)
+    emd = EsmondMetadata(res)
+    metadata = emd.search(q={ "limit": str(max(metadata_sizes)) })
+    save_response(corpus_dir, METADATA_CASE, res.take())
+    log.info("Recorded {0} tests".format(len(metadata)))
+
+    esd = EsmondData(res)
+    for name, event_type, summary_type, summary_window in data_cases():
+        metadata_key = None
+        for md in metadata:
+            for et in md.get("event-types", []):
+                if et.get("event-type") != event_type:
+                    continue
+                windows = [0] + [int(s.get("summary-window", 0)) for s in et.get("summaries", []) if s.get("summary-type") == summary_type]
+                if summary_window in windows or summary_window not in ROLLUP_WINDOWS:
+                    metadata_key = md["metadata-key"]
+                    break
+            if metadata_key:
+                break
+        if metadata_key is None:
+            log.warning("No test has {0}, skipping".format(name))
+            continue
+        esd.fetch(metadata_key, event_type, summary_type, summary_window, q={ "limit": str(max(sizes)), "time-range": str(365 * 86400) })
+        response = res.take()
+        if response is None:
+            continue
+        response["metadata-key"] = metadata_key
+        save_response(corpus_dir, name, response)
+        log.info("Recorded {0} with {1} hits from {2}".format(name, len(response["hits"]["hits"]), metadata_key))
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD):
+    '''
+    Prints the change in median time of each benchmark. Returns the names of
+    the ones that got slower by more than threshold.
+    '''
+    regressions = []
+    for name in sorted(set(baseline["results"]) | set(current["results"])):
+        before = baseline["results"].get(name, None)
+        after = current["results"].get(name, None)
+        if before is None or after is None:
+            print("{0:<60} {1}".format(name, "only in baseline" if after is None else "new"))
+            continue
+        change = (after["median-seconds"] - before["median-seconds"]) / before["median-seconds"]
+        mem_change = (after["peak-bytes"] - before["peak-bytes"]) / float(before["peak-bytes"] or 1)
+        flag = ""
+        if change > threshold:
+            flag = "SLOWER"
+            regressions.append(name)
+        elif change < -threshold:
+            flag = "faster"
+        print("{0:<60} {1:>10.2f} ms {2:>10.2f} ms {3:>+7.1%} time {4:>+7.1%} memory {5}".format(
+            name, before["median-seconds"] * 1000, after["median-seconds"] * 1000, change, mem_change, flag))
+    return regressions
+
+def build_app(config_file=None):
+    app = Flask("elmond")
+    config = {}
+    if config_file:
+        with open(config_file) as f:
+            config = json.load(f)
+    app.config['ELMOND'] = config
+    return app
+
+def parse_sizes(val):
+    return [int(s) for s in val.split(",") if s]
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the data and metadata hot paths of elmond')
+    parser.add_argument('--config', dest='config_file', default=None, type=str, help='An elmond.json to run with, e.g. to turn COLUMNAR off')
+    parser.add_argument('--corpus', dest='corpus_dir', default=None, type=str, help='A directory of saved responses to use in place of generated ones')
+    parser.add_argument('--sizes', dest='sizes', default=DEFAULT_SIZES, type=str, help='Comma-separated numbers of data results to benchmark')
+    parser.add_argument('--metadata-sizes', dest='metadata_sizes', default=DEFAULT_METADATA_SIZES, type=str, help='Comma-separated numbers of tests to benchmark')
+    parser.add_argument('--repeat', dest='repeat', default=DEFAULT_REPEAT, type=int, help='Timed runs of each benchmark')
+    parser.add_argument('--filter', dest='name_filter', default=None, type=str, help='Only run benchmarks whose name matches this regular expression')
+    parser.add_argument('--output', dest='output', default=None, type=str, help='File to write results to with run, directory to write responses to with corpus and record')
+    parser.add_argument('--elastic-url', dest='elastic_url', default="http://localhost:9200", type=str, help='The elastic to record from')
+    parser.add_argument('--threshold', dest='threshold', default=DEFAULT_THRESHOLD, type=float, help='Fraction a benchmark can slow down before compare fails')
+    parser.add_argument('action', choices=["run", "corpus", "record", "compare"], help='The action to perform')
+    parser.add_argument('files', nargs='*', default=[], help='The baseline and current results to compare')
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(message)s", level=logging.INFO)
+    sizes = parse_sizes(args.sizes)
+    metadata_sizes = parse_sizes(args.metadata_sizes)
+
+    if args.action == "compare":
+        if len(args.files) != 2:
+            parser.error("compare needs a baseline and a current results file")
+        with open(args.files[0]) as f:
+            baseline = json.load(f)
+        with open(args.files[1]) as f:
+            current = json.load(f)
+        regressions = compare(baseline, current, threshold=args.threshold)
+        if regressions:
+            print("{0} benchmarks slowed down by more than {1:.0%}".format(len(regressions), args.threshold))
+            sys.exit(1)
+        return
+    if args.action in ["corpus", "record"] and not args.output:
+        parser.error("{0} needs --output".format(args.action))
+
+    app = build_app(args.config_file)
+    with app.test_request_context("/"):
+        if args.action == "corpus":
+            save_response(args.output, METADATA_CASE, build_metadata_response(max(metadata_sizes)))
+            for name, event_type, summary_type, summary_window in data_cases():
+                save_response(args.output, name, Bench()._data_response(name, event_type, summary_type, summary_window, max(sizes)))
+            return
+        if args.action == "record":
+            from elasticsearch import Elasticsearch
+            es = Elasticsearch([args.elastic_url], **app.config['ELMOND'].get("ELASTIC_PARAMS", {}))
+            record(es, args.output, sizes, metadata_sizes)
+            return
+
+        bench = Bench(corpus_dir=args.corpus_dir, repeat=args.repeat, name_filter=args.name_filter)
+        bench.run_metadata(metadata_sizes)
+        bench.run_data(sizes)
+
+    results = {
+        "commit": git_commit(),
+        "time": int(time.time()),
+        "python": platform.python_version(),
+        "numpy": np is not None,
+        "corpus": args.corpus_dir,
+        "repeat": args.repeat,
+        "results": bench.results
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+            f.write("\n")
+
+if __name__ == '__main__':
+    main()
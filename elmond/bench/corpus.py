@@ -0,0 +1,272 @@
+'''
+Builds the elasticsearch responses the benchmarks run against. Responses are
+generated with a fixed seed so every run sees the same data, and are shaped
+like the ones elastic returns for the pscheduler indices and rollups so they
+go through the same code as production. A corpus can be saved to and loaded
+from a directory of JSON files, including one recorded from a real elastic
+with bench.py record.
+'''
+import datetime
+import json
+import os
+import random
+from data import DATA_FIELD_MAP
+
+#Seed so every run builds the same corpus
+SEED = 42
+#Timestamp of the first result and the time between results
+BASE_TS = 1588291200
+RESULT_INTERVAL = 60
+#Shape of the generated results
+HISTOGRAM_BUCKETS = 30
+INTERVALS = 10
+STREAMS = 4
+TRACE_HOPS = 12
+#Summary windows that are benchmarked for each summary type. Windows without
+# a rollup (600) merge the raw histograms.
+SUMMARY_WINDOWS = {
+    "base": [0],
+    "averages": [86400],
+    "aggregations": [300],
+    "statistics": [0, 3600, 600]
+}
+ROLLUP_WINDOWS = [300, 3600, 86400]
+#Test types of the generated metadata and their spec
+TEST_SPECS = {
+    "latencybg": { "packet-count": 600, "packet-interval": 0.1, "bucket-width": 0.001 },
+    "latency": { "packet-count": 100, "packet-interval": 0.1, "flip": False },
+    "throughput": { "duration": "PT20S", "omit": "PT5S", "parallel": 4, "ip-version": 4 },
+    "rtt": { "count": 10, "interval": "PT1S", "length": 64, "ttl": 255 },
+    "trace": { "algorithm": "paris-traceroute", "first-ttl": 1, "hops": 30, "probe-type": "udp" },
+    "disk-to-disk": { "source-path": "/tmp/src", "dest-path": "/tmp/dest" }
+}
+
+def data_cases():
+    '''
+    Returns (name, event_type, summary_type, summary_window) for every entry
+    in DATA_FIELD_MAP at each of its summary windows, plus pscheduler-raw
+    '''
+    cases = []
+    for dfm_key in sorted(DATA_FIELD_MAP):
+        event_type, summary_type = dfm_key.split("/")
+        for summary_window in SUMMARY_WINDOWS[summary_type]:
+            if summary_window == 600 and not event_type.startswith("histogram-"):
+                continue
+            cases.append(("{0}/{1}".format(dfm_key, summary_window), event_type, summary_type, summary_window))
+    cases.append(("pscheduler-raw/base/0", "pscheduler-raw", "base", 0))
+    return cases
+
+def _set_path(obj, path, value):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        obj = obj.setdefault(part, {})
+    obj[parts[-1]] = value
+
+def _histogram(rnd, scale=1.0):
+    values = sorted(set(round(rnd.uniform(10, 40) * scale, 2) for i in range(HISTOGRAM_BUCKETS)))
+    return { "values": values, "counts": [rnd.randint(1, 50) for v in values] }
+
+def _statistics(rnd):
+    low = rnd.uniform(10, 20)
+    high = low + rnd.uniform(1, 20)
+    mean = (low + high) / 2
+    return {
+        "min": low, "max": high, "mean": mean, "median": mean, "mode": [mean],
+        "p_25": (low + mean) / 2, "p_75": (mean + high) / 2, "p_95": high * 0.95,
+        "stddev": (high - low) / 4, "variance": ((high - low) / 4) ** 2
+    }
+
+def _interval(rnd, start, stream_id=None):
+    interval = { "start": start, "end": start + 1.0, "throughput": rnd.uniform(1e8, 1e10), "retransmits": rnd.randint(0, 20) }
+    if stream_id is not None:
+        interval["stream-id"] = stream_id
+    return interval
+
+def _trace_path(rnd):
+    hops = []
+    for ttl in range(TRACE_HOPS):
+        hops.append({
+            "ip": "10.{0}.{1}.1".format(ttl, rnd.randint(0, 255)),
+            "hostname": "hop{0}.example.net".format(ttl),
+            "as": { "number": 64512 + ttl, "owner": "EXAMPLE" },
+            "rtt": "PT{0:.6f}S".format(rnd.uniform(0.001, 0.1)),
+            "mtu": 9000 if ttl == 0 else None
+        })
+    return hops
+
+def _raw_value(rnd, field):
+    '''
+    Returns a value for field the way the pscheduler pipeline stores it
+    '''
+    leaf = field.split(".")[-1]
+    if field == "result.error":
+        return "Timed out waiting for the test to finish"
+    elif leaf == "histogram":
+        return _histogram(rnd)
+    elif field in ["result.latency", "result.ttl", "result.rtt"]:
+        return dict(_statistics(rnd), histogram=_histogram(rnd))
+    elif field == "result.intervals.json":
+        return [{
+            "summary": _interval(rnd, float(i)),
+            "streams": [_interval(rnd, float(i), stream_id=s + 1) for s in range(STREAMS)]
+        } for i in range(INTERVALS)]
+    elif field == "result.streams.json":
+        return [_interval(rnd, 0.0, stream_id=s + 1) for s in range(STREAMS)]
+    elif field == "result.json":
+        return [_trace_path(rnd), _trace_path(rnd)]
+    elif leaf in ["loss", "throughput", "max_clock_error"]:
+        return rnd.uniform(0, 1) if leaf == "loss" else rnd.uniform(1, 1e10)
+    return rnd.randint(0, 600)
+
+def _raw_result(rnd, event_type, field):
+    result = {}
+    if event_type == "pscheduler-raw":
+        #everything a latency test stores
+        for f in ["result.latency", "result.ttl", "result.packets.lost", "result.packets.sent", "result.packets.loss", "result.packets.duplicated", "result.packets.reordered", "result.max_clock_error"]:
+            _set_path(result, f, _raw_value(rnd, f))
+    else:
+        _set_path(result, field, _raw_value(rnd, field))
+    return result["result"]
+
+def _rollup_source(rnd, summary_type, field, ts):
+    source = {
+        "pscheduler.start_time.date_histogram.timestamp": ts * 1000,
+        "pscheduler.start_time.date_histogram.interval": "5m",
+        "pscheduler.test_checksum.keyword.terms.value": "bench"
+    }
+    count = rnd.randint(1, 12)
+    if summary_type == "averages":
+        source["{0}.avg.value".format(field)] = rnd.uniform(1e8, 1e10) * count
+        source["{0}.avg._count".format(field)] = count
+    elif summary_type == "aggregations":
+        sent = 600 * count
+        source["result.packets.sent.sum.value"] = sent
+        source["result.packets.lost.sum.value"] = rnd.randint(0, sent // 100)
+    elif summary_type == "statistics":
+        stats = _statistics(rnd)
+        source["{0}.max.max.value".format(field)] = stats["max"]
+        source["{0}.min.min.value".format(field)] = stats["min"]
+        for stat in ["mean", "median", "p_25", "p_75", "p_95", "stddev", "variance"]:
+            source["{0}.{1}.avg.value".format(field, stat)] = stats[stat] * count
+            source["{0}.{1}.avg._count".format(field, stat)] = count
+        source["{0}.mode.avg.value".format(field)] = stats["mode"][0] * count
+        source["{0}.mode.avg._count".format(field)] = count
+    return source
+
+def build_data_hit(rnd, event_type, summary_type, ts, is_rollup=False, metadata_key="bench"):
+    '''
+    Returns a search hit for a result or rollup document at ts
+    '''
+    field = DATA_FIELD_MAP.get("{0}/{1}".format(event_type, summary_type), None)
+    if is_rollup:
+        source = _rollup_source(rnd, summary_type, field, ts)
+    else:
+        start_time = datetime.datetime.utcfromtimestamp(ts).strftime("%Y-%m-%dT%H:%M:%SZ")
+        source = {
+            "pscheduler": { "start_time": start_time, "test_checksum": metadata_key },
+            "result": _raw_result(rnd, event_type, field)
+        }
+    return { "_index": "pscheduler_bench-2020.05.01", "_id": "{0}-{1}".format(metadata_key, ts), "_source": source, "sort": [ts * 1000] }
+
+def build_data_response(event_type, summary_type, summary_window, size):
+    '''
+    Returns a search response with size hits for a data request
+    '''
+    rnd = random.Random("{0}/{1}/{2}/{3}".format(SEED, event_type, summary_type, summary_window))
+    is_rollup = summary_window in ROLLUP_WINDOWS
+    if summary_window and not is_rollup:
+        #merged statistics are calculated from the raw histograms
+        summary_type = "base"
+    hits = [build_data_hit(rnd, event_type, summary_type, BASE_TS + i * RESULT_INTERVAL, is_rollup=is_rollup) for i in range(size)]
+    return { "took": 1, "timed_out": False, "hits": { "total": { "value": size, "relation": "eq" }, "hits": hits } }
+
+def build_metadata_source(rnd, i):
+    test_type = sorted(TEST_SPECS)[i % len(TEST_SPECS)]
+    source_ip = "10.{0}.{1}.{2}".format(i // 65536 % 256, i // 256 % 256, i % 256)
+    dest_ip = "10.255.{0}.{1}".format(rnd.randint(0, 255), rnd.randint(1, 254))
+    spec = dict(TEST_SPECS[test_type], source=source_ip, dest=dest_ip)
+    return {
+        "test": { "type": test_type, "spec": spec },
+        "meta": { "observer": { "ip": source_ip }, "source": { "ip": source_ip }, "destination": { "ip": dest_ip } },
+        "pscheduler": { "tool": "bench", "duration": "PT30S", "added": "2020-05-01T00:00:00Z", "test_checksum": "{0:032x}".format(i) },
+        "reference": { "project": "bench", "tags": ["a", "b"] }
+    }
+
+def build_metadata_response(size):
+    '''
+    Returns a composite aggregation response with size test buckets
+    '''
+    rnd = random.Random("{0}/metadata".format(SEED))
+    buckets = []
+    for i in range(size):
+        source = build_metadata_source(rnd, i)
+        md_key = source["pscheduler"]["test_checksum"]
+        buckets.append({
+            "key": { "checksum": md_key },
+            "doc_count": rnd.randint(1, 1000),
+            "test_params": { "hits": { "hits": [{ "_index": "pscheduler_bench-2020.05.01", "_id": md_key, "_source": source }] } }
+        })
+    aggs = { "tests_total_count": { "value": size }, "tests": { "buckets": buckets } }
+    if buckets:
+        aggs["tests"]["after_key"] = buckets[-1]["key"]
+    return { "took": 1, "timed_out": False, "hits": { "total": { "value": 0, "relation": "eq" }, "hits": [] }, "aggregations": aggs }
+
+def case_filename(name):
+    return "{0}.json".format(name.replace("/", "_"))
+
+def load_response(corpus_dir, name):
+    '''
+    Returns the recorded response for name in corpus_dir or None
+    '''
+    if not corpus_dir:
+        return None
+    path = os.path.join(corpus_dir, case_filename(name))
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def save_response(corpus_dir, name, response):
+    os.makedirs(corpus_dir, exist_ok=True)
+    with open(os.path.join(corpus_dir, case_filename(name)), "w") as f:
+        json.dump(response, f)
+
+class CorpusES:
+    '''
+    Stands in for the elasticsearch client by answering every search from one
+    response. Honors size, from, search_after and composite paging so code
+    that pages sees the end of the data.
+    '''
+
+    def __init__(self, response):
+        self.response = response
+        self.searches = 0
+
+    def search(self, index=None, body=None, **kwargs):
+        self.searches += 1
+        body = body or {}
+        res = dict(self.response)
+        composite = body.get("aggs", {}).get("tests", {}).get("composite", None)
+        if composite is not None and "aggregations" in res:
+            tests = res["aggregations"]["tests"]
+            buckets = tests["buckets"]
+            after = composite.get("after", {}).get("checksum", None)
+            if after is not None:
+                buckets = [b for b in buckets if b["key"]["checksum"] > after]
+            buckets = buckets[:composite.get("size", 10)]
+            page = { "buckets": buckets }
+            if buckets:
+                page["after_key"] = buckets[-1]["key"]
+            res["aggregations"] = dict(res["aggregations"], tests=page)
+        elif "hits" in res:
+            hits = res["hits"]["hits"]
+            if body.get("search_after", None):
+                after = body["search_after"][0]
+                hits = [h for h in hits if h.get("sort", [0])[0] > after]
+            start = body.get("from", 0)
+            hits = hits[start:start + body.get("size", 10)]
+            res["hits"] = dict(res["hits"], hits=hits)
+        return res
+
+    def msearch(self, body=None, **kwargs):
+        return { "responses": [self.search(index=body[i].get("index", None), body=body[i + 1]) for i in range(0, len(body), 2)] }
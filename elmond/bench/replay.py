@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+'''
+Replays a capture log written by elmond's CAPTURE option against an elmond
+instance and reports latency percentiles and error rates:
+
+    replay.py capture.ndjson --target http://localhost:5000 --speed 2
+
+Requests are sent at the rate they were captured times --speed, or as fast as
+--concurrency allows with --speed 0. Requests that can't be sent on time
+because every connection is busy are reported as lag, which means the
+instance or the replay can't keep up with that rate.
+'''
+import argparse
+import http.client
+import json
+import logging
+import math
+import sys
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger('elmond')
+
+DEFAULT_TARGET = "http://localhost:5000"
+DEFAULT_SPEED = 1.0
+DEFAULT_CONCURRENCY = 32
+DEFAULT_TIMEOUT = 60
+PERCENTILES = [50, 95, 99]
+
+def percentile(sorted_vals, p):
+    '''
+    Returns the nearest-rank percentile p of a sorted list
+    '''
+    if not sorted_vals:
+        return None
+    rank = max(int(math.ceil(p / 100.0 * len(sorted_vals))) - 1, 0)
+    return sorted_vals[min(rank, len(sorted_vals) - 1)]
+
+def route_kind(entry):
+    '''
+    Groups requests by what they ask elmond for
+    '''
+    parts = [p for p in entry["path"].split("/") if p]
+    if entry["method"] == "POST" and parts[-1:] == ["batch"]:
+        return "batch"
+    if len(parts) >= 4:
+        #data by event type and summary
+        return "data/{0}/{1}/{2}".format(parts[-3], parts[-2], parts[-1])
+    if len(parts) == 1:
+        return "metadata-key"
+    return "metadata"
+
+def load_entries(filename, limit=None):
+    entries = []
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                log.warning("Skipping invalid line in {0}".format(filename))
+            if limit and len(entries) >= limit:
+                break
+    entries.sort(key=lambda e: e["ts"])
+    return entries
+
+class Replayer:
+    '''
+    Sends captured requests to target from a pool of threads that each keep a
+    connection open
+    '''
+
+    def __init__(self, target, concurrency=DEFAULT_CONCURRENCY, timeout=DEFAULT_TIMEOUT, headers={}):
+        url = urllib.parse.urlsplit(target)
+        self.scheme = url.scheme
+        self.netloc = url.netloc
+        self.prefix = url.path.rstrip("/")
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.headers = headers
+        self.results = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._sem = threading.Semaphore(concurrency)
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            cls = http.client.HTTPSConnection if self.scheme == "https" else http.client.HTTPConnection
+            conn = cls(self.netloc, timeout=self.timeout)
+            self._local.conn = conn
+        return conn
+
+    def _send(self, entry):
+        url = self.prefix + entry["path"]
+        if entry.get("args"):
+            url += "?" + urllib.parse.urlencode([tuple(a) for a in entry["args"]])
+        headers = dict(self.headers)
+        if entry.get("accept"):
+            headers["Accept"] = entry["accept"]
+        body = None
+        if entry.get("body") is not None:
+            body = entry["body"].encode("utf-8")
+            headers["Content-Type"] = entry.get("content_type") or "application/json"
+        for attempt in range(2):
+            conn = self._connection()
+            try:
+                conn.request(entry["method"], url, body=body, headers=headers)
+                res = conn.getresponse()
+                data = res.read()
+                return res.status, len(data), None
+            except (http.client.HTTPException, ConnectionError) as e:
+                #the server may have closed a kept-alive connection
+                conn.close()
+                self._local.conn = None
+                if attempt:
+                    return None, 0, str(e)
+            except Exception as e:
+                conn.close()
+                self._local.conn = None
+                return None, 0, str(e)
+
+    def _run(self, entry, scheduled):
+        try:
+            start = time.time()
+            try:
+                status, size, error = self._send(entry)
+            except Exception as e:
+                status, size, error = None, 0, str(e)
+            result = {
+                "kind": route_kind(entry),
+                "status": status,
+                "latency": time.time() - start,
+                "lag": max(start - scheduled, 0.0),
+                "bytes": size,
+                "error": error,
+                "captured_latency": entry.get("latency", None),
+                "captured_status": entry.get("status", None)
+            }
+            with self._lock:
+                self.results.append(result)
+        finally:
+            self._sem.release()
+
+    def replay(self, entries, speed=DEFAULT_SPEED):
+        '''
+        Sends entries spaced by their captured times divided by speed.
+        Returns the seconds it took.
+        '''
+        if not entries:
+            return 0.0
+        first_ts = entries[0]["ts"]
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            for entry in entries:
+                #without a rate lag is the wait for a free connection
+                scheduled = time.time()
+                if speed:
+                    scheduled = start + (entry["ts"] - first_ts) / speed
+                    wait = scheduled - time.time()
+                    if wait > 0:
+                        time.sleep(wait)
+                #don't queue more than there are connections so lag is measured
+                self._sem.acquire()
+                pool.submit(self._run, entry, scheduled)
+        return time.time() - start
+
+def summarize(results, elapsed):
+    '''
+    Returns latency percentiles and error rates overall and for each kind of
+    request
+    '''
+    def summary(rows):
+        latencies = sorted(r["latency"] for r in rows)
+        captured = sorted(r["captured_latency"] for r in rows if r["captured_latency"] is not None)
+        lags = sorted(r["lag"] for r in rows)
+        errors = [r for r in rows if r["status"] is None or r["status"] >= 500]
+        statuses = {}
+        for r in rows:
+            statuses[str(r["status"])] = statuses.get(str(r["status"]), 0) + 1
+        s = {
+            "requests": len(rows),
+            "errors": len(errors),
+            "error-rate": len(errors) / float(len(rows)) if rows else 0.0,
+            "status-mismatches": len([r for r in rows if r["captured_status"] is not None and r["status"] != r["captured_status"]]),
+            "statuses": statuses,
+            "bytes": sum(r["bytes"] for r in rows),
+            "max-latency": latencies[-1] if latencies else None,
+            "max-lag": lags[-1] if lags else None
+        }
+        for p in PERCENTILES:
+            s["p{0}-latency".format(p)] = percentile(latencies, p)
+            s["p{0}-captured-latency".format(p)] = percentile(captured, p)
+            s["p{0}-lag".format(p)] = percentile(lags, p)
+        return s
+
+    report = summary(results)
+    report["seconds"] = elapsed
+    report["requests-per-second"] = len(results) / elapsed if elapsed else None
+    kinds = {}
+    for r in results:
+        kinds.setdefault(r["kind"], []).append(r)
+    report["kinds"] = { kind: summary(rows) for kind, rows in sorted(kinds.items()) }
+    return report
+
+def _ms(val):
+    return "-" if val is None else "{0:.1f}".format(val * 1000)
+
+def print_report(report):
+    print("{0} requests in {1:.1f}s ({2:.1f}/s), {3} errors ({4:.2%})".format(
+        report["requests"], report["seconds"], report["requests-per-second"] or 0, report["errors"], report["error-rate"]))
+    print("{0:<50} {1:>8} {2:>8} {3:>9} {4:>9} {5:>9} {6:>12} {7:>9}".format("kind", "requests", "errors", "p50 ms", "p95 ms", "p99 ms", "captured p95", "p95 lag"))
+    for kind, s in [("all", report)] + list(report["kinds"].items()):
+        print("{0:<50} {1:>8} {2:>8} {3:>9} {4:>9} {5:>9} {6:>12} {7:>9}".format(
+            kind, s["requests"], s["errors"], _ms(s["p50-latency"]), _ms(s["p95-latency"]), _ms(s["p99-latency"]), _ms(s["p95-captured-latency"]), _ms(s["p95-lag"])))
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay captured requests against elmond')
+    parser.add_argument('--target', dest='target', default=DEFAULT_TARGET, type=str, help='Base URL of the elmond to send requests to')
+    parser.add_argument('--speed', dest='speed', default=DEFAULT_SPEED, type=float, help='Multiple of the captured rate to send at. 0 sends as fast as possible.')
+    parser.add_argument('--concurrency', dest='concurrency', default=DEFAULT_CONCURRENCY, type=int, help='Requests that can be waiting for a response at once')
+    parser.add_argument('--timeout', dest='timeout', default=DEFAULT_TIMEOUT, type=float, help='Seconds to wait for a response')
+    parser.add_argument('--limit', dest='limit', default=None, type=int, help='Only replay the first number of requests')
+    parser.add_argument('--header', dest='headers', action='append', default=[], help='A "Name: value" header to add to every request')
+    parser.add_argument('--output', dest='output', default=None, type=str, help='File to write the report to as JSON')
+    parser.add_argument('capture', type=str, help='The capture log to replay')
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(message)s", level=logging.INFO)
+    headers = {}
+    for header in args.headers:
+        name, _, value = header.partition(":")
+        headers[name.strip()] = value.strip()
+
+    entries = load_entries(args.capture, limit=args.limit)
+    if not entries:
+        log.error("No requests in {0}".format(args.capture))
+        sys.exit(1)
+    log.info("Replaying {0} requests captured over {1:.1f}s at {2}x".format(len(entries), entries[-1]["ts"] - entries[0]["ts"], args.speed))
+    replayer = Replayer(args.target, concurrency=args.concurrency, timeout=args.timeout, headers=headers)
+    elapsed = replayer.replay(entries, speed=args.speed)
+    report = summarize(replayer.results, elapsed)
+    report["target"] = args.target
+    report["speed"] = args.speed
+    report["concurrency"] = args.concurrency
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4, sort_keys=True)
+            f.write("\n")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+'''
+Records how the latency of elmond endpoints grows with the size of the
+archive. For each number of tests in --steps, loads the tests that are new
+since the last step with "pselastic generate load", then times a set of
+metadata and data requests against a running elmond:
+
+    scale.py --steps 100,1000,10000 --days 7 --output scale.json
+
+elmond has to be configured to use the same elasticsearch. The first request
+of each endpoint is reported separately since later ones can be answered from
+elmond's caches; turn RESPONSE_CACHE off to time elastic on every request.
+'''
+import argparse
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+log = logging.getLogger('elmond')
+
+DEFAULT_ELMOND_URL = "http://localhost:5000"
+DEFAULT_ELASTIC_URL = "http://localhost:9200"
+DEFAULT_PSELASTIC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "pselastic_setup", "bin", "pselastic")
+DEFAULT_STEPS = "100,1000,10000"
+DEFAULT_REPEAT = 5
+#Test type and event type of the data endpoints that are timed
+DATA_ENDPOINTS = [
+    ("data-owdelay", "latencybg", "histogram-owdelay/base/0", 86400),
+    ("data-loss", "latencybg", "packet-loss-rate/base/0", 86400),
+    ("data-throughput", "throughput", "throughput/base/0", None),
+    ("data-rtt-stats", "rtt", "histogram-rtt/statistics/0", 86400),
+    ("data-trace", "trace", "packet-trace/base/0", 86400)
+]
+
+def get(url, timeout=300):
+    '''
+    Returns the status, body and seconds taken of a GET
+    '''
+    start = time.time()
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as res:
+            body = res.read()
+            status = res.status
+    except urllib.error.HTTPError as e:
+        body = e.read()
+        status = e.code
+    return status, body, time.time() - start
+
+def count_documents(elastic_url):
+    status, body, _ = get("{0}/pscheduler_*-*/_count?ignore_unavailable=true".format(elastic_url))
+    if status != 200:
+        return None
+    return json.loads(body).get("count", None)
+
+def find_metadata_key(elmond_url, test_type):
+    status, body, _ = get("{0}/?{1}".format(elmond_url, urllib.parse.urlencode({ "pscheduler-test-type": test_type, "limit": 1 })))
+    if status != 200:
+        return None
+    metadata = json.loads(body)
+    return metadata[0]["metadata-key"] if metadata else None
+
+def time_endpoint(url, repeat):
+    '''
+    Requests url repeat times. Returns the status and time of the first
+    request and the median and maximum time of the others.
+    '''
+    times = []
+    statuses = set()
+    size = 0
+    for i in range(repeat):
+        status, body, elapsed = get(url)
+        statuses.add(status)
+        size = len(body)
+        times.append(elapsed)
+    rest = times[1:] or times
+    return {
+        "url": url,
+        "statuses": sorted(statuses),
+        "bytes": size,
+        "first-seconds": times[0],
+        "median-seconds": statistics.median(rest),
+        "max-seconds": max(rest)
+    }
+
+def build_endpoints(elmond_url, days):
+    endpoints = [
+        ("metadata-list", "{0}/?limit=1000".format(elmond_url)),
+        ("metadata-type", "{0}/?pscheduler-test-type=throughput&limit=1000".format(elmond_url)),
+        ("metadata-time", "{0}/?time-range=86400&limit=1000".format(elmond_url))
+    ]
+    keys = {}
+    for name, test_type, path, time_range in DATA_ENDPOINTS:
+        if test_type not in keys:
+            keys[test_type] = find_metadata_key(elmond_url, test_type)
+        metadata_key = keys[test_type]
+        if metadata_key is None:
+            log.warning("No {0} test found for {1}".format(test_type, name))
+            continue
+        if name == DATA_ENDPOINTS[0][0]:
+            endpoints.append(("metadata-key", "{0}/{1}".format(elmond_url, metadata_key)))
+        endpoints.append((name, "{0}/{1}/{2}?time-range={3}".format(elmond_url, metadata_key, path, time_range or days * 86400)))
+    return endpoints
+
+def run_pselastic(args, command):
+    cmd = [args.pselastic] + command + ["-u", args.elastic_url]
+    log.info(" ".join(cmd))
+    start = time.time()
+    subprocess.check_call(cmd)
+    return time.time() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='Record how elmond latency scales with the number of tests and results')
+    parser.add_argument('--elmond-url', dest='elmond_url', default=DEFAULT_ELMOND_URL, type=str, help='Base URL of elmond')
+    parser.add_argument('--elastic-url', dest='elastic_url', default=DEFAULT_ELASTIC_URL, type=str, help='The elastic elmond uses')
+    parser.add_argument('--pselastic', dest='pselastic', default=DEFAULT_PSELASTIC, type=str, help='Path to the pselastic command')
+    parser.add_argument('--steps', dest='steps', default=DEFAULT_STEPS, type=str, help='Comma-separated numbers of tests to measure at')
+    parser.add_argument('--days', dest='days', default=7, type=int, help='Days of results to generate')
+    parser.add_argument('--hosts', dest='hosts', default=None, type=int, help='Number of hosts the tests run between')
+    parser.add_argument('--workers', dest='workers', default=4, type=int, help='Processes loading documents')
+    parser.add_argument('--generate-arg', dest='generate_args', action='append', default=[], help='Extra argument for pselastic generate load, e.g. --generate-arg=--interval=latencybg=300')
+    parser.add_argument('--metadata-update', dest='metadata_update', action='store_true', help='Run pselastic metadata update after loading, for METADATA_SOURCE index')
+    parser.add_argument('--settle', dest='settle', default=0, type=int, help='Seconds to wait after loading, e.g. for the metadata cache to refresh')
+    parser.add_argument('--skip-load', dest='skip_load', action='store_true', help='Only time the endpoints')
+    parser.add_argument('--repeat', dest='repeat', default=DEFAULT_REPEAT, type=int, help='Requests per endpoint')
+    parser.add_argument('--output', dest='output', default=None, type=str, help='File to write results to as JSON')
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(message)s", level=logging.INFO)
+    steps = [int(s) for s in args.steps.split(",") if s]
+    results = []
+    loaded = 0
+    for tests in steps:
+        step = { "tests": tests }
+        if not args.skip_load and tests > loaded:
+            command = ["generate", "load", "--tests", str(tests), "--skip-tests", str(loaded), "--days", str(args.days), "--workers", str(args.workers)]
+            if args.hosts:
+                command.extend(["--hosts", str(args.hosts)])
+            step["load-seconds"] = run_pselastic(args, command + args.generate_args)
+            loaded = tests
+            if args.metadata_update:
+                step["metadata-update-seconds"] = run_pselastic(args, ["metadata", "update"])
+            if args.settle:
+                time.sleep(args.settle)
+        step["documents"] = count_documents(args.elastic_url)
+        step["endpoints"] = {}
+        for name, url in build_endpoints(args.elmond_url, args.days):
+            step["endpoints"][name] = time_endpoint(url, args.repeat)
+        results.append(step)
+
+        print("{0} tests, {1} documents".format(tests, step["documents"]))
+        for name, r in step["endpoints"].items():
+            print("    {0:<20} {1:>10.1f} ms first {2:>10.1f} ms median {3:>10} bytes {4}".format(
+                name, r["first-seconds"] * 1000, r["median-seconds"] * 1000, r["bytes"], r["statuses"]))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({ "elmond": args.elmond_url, "days": args.days, "steps": results }, f, indent=4, sort_keys=True)
+            f.write("\n")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+'''
+A stand-in for elasticsearch that answers the searches elmond makes with
+generated tests and results, so elmond can be load tested or replayed against
+without an archive:
+
+    standin.py --port 9200 --tests 1000
+    ELASTIC_HOSTS=["localhost:9200"] in elmond.json
+
+Metadata comes from a fixed set of tests. Data is generated for whatever
+field and time range a search asks for, one result every --interval seconds
+or one per rollup window. Only the parts of the query DSL that elmond uses
+are understood: checksum terms, the time range, sort, size, from,
+search_after, docvalue_fields and composite paging. Bulk requests are accepted and counted but
+not stored.
+'''
+import argparse
+import datetime
+import json
+import logging
+import math
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "elmond"))
+
+from corpus import build_data_hit, build_metadata_response, SEED
+from data import DATA_FIELD_MAP
+
+log = logging.getLogger('elmond')
+
+DEFAULT_PORT = 9200
+DEFAULT_TESTS = 1000
+DEFAULT_INTERVAL = 60
+#Time range of data searches without a time filter
+DEFAULT_RANGE = 86400
+ROLLUP_INTERVALS = { "5m": 300, "1h": 3600, "1d": 86400 }
+CHECKSUM_FIELDS = ["pscheduler.test_checksum.keyword", "pscheduler.test_checksum", "pscheduler.test_checksum.keyword.terms.value"]
+VERSION = "7.10.2"
+
+def _walk(obj, name):
+    '''
+    Yields every value of key name in a nested DSL
+    '''
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            if k == name:
+                yield v
+            yield from _walk(v, name)
+    elif isinstance(obj, list):
+        for v in obj:
+            yield from _walk(v, name)
+
+def _parse_time(val):
+    if isinstance(val, (int, float)):
+        return val / 1000.0
+    dt = datetime.datetime.fromisoformat(str(val).replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return dt.timestamp()
+
+def _requested_fields(dsl):
+    '''
+    Returns the fields a search asks for in _source or as doc values
+    '''
+    if dsl.get("docvalue_fields"):
+        return [f["field"] if isinstance(f, dict) else f for f in dsl["docvalue_fields"]]
+    source = dsl.get("_source", [])
+    if isinstance(source, str):
+        return [source]
+    if isinstance(source, list):
+        return source
+    return []
+
+def _source_value(source, field):
+    for key in field.split("."):
+        if not isinstance(source, dict) or key not in source:
+            return None
+        source = source[key]
+    return source
+
+def _docvalue_hit(hit, dsl, time_field, ts):
+    '''
+    Converts a hit to the shape returned for docvalue_fields, with fields
+    instead of _source
+    '''
+    fields = {}
+    for f in dsl["docvalue_fields"]:
+        field = f["field"] if isinstance(f, dict) else f
+        if field == time_field:
+            #only the epoch_second format elmond asks for is supported
+            fields[field] = [str(ts)]
+            continue
+        val = _source_value(hit["_source"], field)
+        if isinstance(val, (int, float)) and not isinstance(val, bool):
+            fields[field] = [val]
+    hit = dict(hit, fields=fields)
+    del hit["_source"]
+    return hit
+
+def _checksums(dsl):
+    keys = set()
+    for term in _walk(dsl.get("query", {}), "term"):
+        for field in CHECKSUM_FIELDS:
+            if field in term:
+                val = term[field]
+                keys.add(val.get("value") if isinstance(val, dict) else val)
+    for terms in _walk(dsl.get("query", {}), "terms"):
+        for field in CHECKSUM_FIELDS:
+            if field in terms:
+                keys.update(terms[field])
+    return keys
+
+class StandinES:
+    '''
+    Answers search bodies with generated responses
+    '''
+
+    def __init__(self, tests=DEFAULT_TESTS, interval=DEFAULT_INTERVAL, latency=0.0):
+        self.interval = interval
+        self.latency = latency
+        aggs = build_metadata_response(tests)["aggregations"]
+        self.buckets = sorted(aggs["tests"]["buckets"], key=lambda b: b["key"]["checksum"])
+        self.searches = 0
+        self.indexed = 0
+        self._lock = threading.Lock()
+
+    def search(self, dsl):
+        start = time.time()
+        with self._lock:
+            self.searches += 1
+        aggs = dsl.get("aggs", dsl.get("aggregations", {}))
+        if "tests" in aggs:
+            res = self._metadata_aggs(dsl, aggs["tests"])
+        elif any(CHECKSUM_FIELDS[0] in s for s in dsl.get("sort", []) if isinstance(s, dict)):
+            res = self._metadata_index(dsl)
+        else:
+            res = self._data(dsl)
+        if self.latency:
+            time.sleep(self.latency)
+        res["took"] = int((time.time() - start) * 1000)
+        res["timed_out"] = False
+        return res
+
+    def _tests(self, dsl):
+        keys = _checksums(dsl)
+        if not keys:
+            return self.buckets
+        return [b for b in self.buckets if b["key"]["checksum"] in keys]
+
+    def _metadata_aggs(self, dsl, tests_agg):
+        buckets = self._tests(dsl)
+        composite = tests_agg.get("composite", {})
+        after = composite.get("after", {}).get("checksum", None)
+        if after is not None:
+            buckets = [b for b in buckets if b["key"]["checksum"] > after]
+        page = buckets[:composite.get("size", 10)]
+        tests = { "buckets": page }
+        if page:
+            tests["after_key"] = page[-1]["key"]
+        aggs = { "tests": tests, "tests_total_count": { "value": len(self._tests(dsl)) } }
+        return { "hits": { "total": { "value": 0, "relation": "eq" }, "hits": [] }, "aggregations": aggs }
+
+    def _metadata_index(self, dsl):
+        buckets = self._tests(dsl)
+        after = (dsl.get("search_after") or [None])[0]
+        if after is not None:
+            buckets = [b for b in buckets if b["key"]["checksum"] > after]
+        hits = []
+        for b in buckets[dsl.get("from", 0):dsl.get("from", 0) + dsl.get("size", 10)]:
+            md_key = b["key"]["checksum"]
+            hits.append({ "_id": md_key, "_source": b["test_params"]["hits"]["hits"][0]["_source"], "sort": [md_key] })
+        return { "hits": { "total": { "value": len(buckets), "relation": "eq" }, "hits": hits } }
+
+    def _data_case(self, dsl, time_field):
+        '''
+        Returns the event type and summary type whose fields the search asks for
+        '''
+        is_rollup = "date_histogram" in time_field
+        fields = [f for f in _requested_fields(dsl) if f != time_field]
+        if "result.*" in fields or not fields:
+            return "pscheduler-raw", "base"
+        for dfm_key, field in sorted(DATA_FIELD_MAP.items()):
+            event_type, summary_type = dfm_key.split("/")
+            #raw results only depend on the field, rollups on the summary too
+            if field in fields and (not is_rollup or summary_type != "base"):
+                return event_type, summary_type
+        return "pscheduler-raw", "base"
+
+    def _data(self, dsl):
+        sort = dsl.get("sort", [{}])
+        time_field = "pscheduler.start_time"
+        if sort and isinstance(sort[0], dict) and sort[0]:
+            time_field = list(sort[0].keys())[0]
+        if not time_field.startswith("pscheduler.start_time"):
+            time_field = "pscheduler.start_time"
+        is_rollup = "date_histogram" in time_field
+        interval = self.interval
+        for term in _walk(dsl.get("query", {}), "term"):
+            val = term.get("pscheduler.start_time.date_histogram.interval", None)
+            if val is not None:
+                interval = ROLLUP_INTERVALS.get(val, interval)
+
+        #results in the time range
+        end = time.time()
+        begin = end - DEFAULT_RANGE
+        for rng in _walk(dsl.get("query", {}), "range"):
+            if time_field in rng:
+                if "gte" in rng[time_field]:
+                    begin = _parse_time(rng[time_field]["gte"])
+                if "lte" in rng[time_field]:
+                    end = min(_parse_time(rng[time_field]["lte"]), end)
+        first = int(math.ceil(begin / interval) * interval)
+        total = max(int((end - first) // interval) + 1, 0)
+
+        res = { "hits": { "total": { "value": total, "relation": "eq" }, "hits": [] } }
+        aggs = dsl.get("aggs", {})
+        if "newest" in aggs:
+            newest = (first + (total - 1) * interval) * 1000.0 if total else None
+            res["aggregations"] = { "newest": { "value": newest } }
+        size = dsl.get("size", 10)
+        if not size:
+            return res
+
+        #the page asked for
+        start = dsl.get("from", 0)
+        if dsl.get("search_after"):
+            after = dsl["search_after"][0] / 1000.0
+            start = max(int((after - first) // interval) + 1, 0)
+        event_type, summary_type = self._data_case(dsl, time_field)
+        metadata_key = next(iter(_checksums(dsl)), "standin")
+        rnd = random.Random("{0}/{1}/{2}/{3}/{4}".format(SEED, metadata_key, event_type, summary_type, start))
+        for i in range(start, min(start + size, total)):
+            ts = first + i * interval
+            hit = build_data_hit(rnd, event_type, summary_type, ts, is_rollup=is_rollup, metadata_key=metadata_key)
+            if dsl.get("docvalue_fields"):
+                hit = _docvalue_hit(hit, dsl, time_field, ts)
+            res["hits"]["hits"].append(hit)
+        return res
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+    def _send(self, obj, status=200):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-Elastic-Product", "Elasticsearch")
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length).decode("utf-8") if length else ""
+
+    def _handle(self):
+        path = self.path.split("?")[0].rstrip("/")
+        body = self._body()
+        es = self.server.es
+        try:
+            if path == "":
+                self._send({ "name": "standin", "cluster_name": "standin", "version": { "number": VERSION, "build_flavor": "default" }, "tagline": "You Know, for Search" })
+            elif path.endswith("/_search"):
+                self._send(es.search(json.loads(body) if body else {}))
+            elif path.endswith("/_msearch"):
+                lines = [json.loads(l) for l in body.splitlines() if l.strip()]
+                self._send({ "took": 0, "responses": [dict(es.search(lines[i + 1]), status=200) for i in range(0, len(lines) - 1, 2)] })
+            elif path.endswith("/_bulk"):
+                #documents are counted and dropped so loaders can be timed
+                items = [{ "index": { "_id": json.loads(l).get("index", {}).get("_id", None), "status": 201 } } for l in body.splitlines()[0::2] if l.strip()]
+                with es._lock:
+                    es.indexed += len(items)
+                self._send({ "took": 0, "errors": False, "items": items })
+            elif path.endswith("/_refresh"):
+                self._send({ "_shards": { "total": 1, "successful": 1, "failed": 0 } })
+            elif path.endswith("/_count"):
+                self._send({ "count": es.indexed })
+            elif path.endswith("/_delete_by_query"):
+                self._send({ "took": 0, "deleted": 0 })
+            elif path.endswith("/_pit") and self.command == "DELETE":
+                self._send({ "succeeded": True, "num_freed": 1 })
+            elif path.endswith("/_pit"):
+                self._send({ "id": "standin" })
+            else:
+                self._send({ "error": "no handler for {0} {1}".format(self.command, path), "status": 400 }, status=400)
+        except Exception as e:
+            log.exception("Unable to answer {0} {1}".format(self.command, path))
+            self._send({ "error": { "type": "standin_exception", "reason": str(e) }, "status": 500 }, status=500)
+
+    do_GET = _handle
+    do_HEAD = _handle
+    do_POST = _handle
+    do_PUT = _handle
+    do_DELETE = _handle
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve generated elasticsearch responses to elmond')
+    parser.add_argument('--host', dest='host', default="127.0.0.1", type=str, help='Address to listen on')
+    parser.add_argument('--port', dest='port', default=DEFAULT_PORT, type=int, help='Port to listen on')
+    parser.add_argument('--tests', dest='tests', default=DEFAULT_TESTS, type=int, help='Number of tests in the metadata')
+    parser.add_argument('--interval', dest='interval', default=DEFAULT_INTERVAL, type=int, help='Seconds between results of a test')
+    parser.add_argument('--latency', dest='latency', default=0.0, type=float, help='Seconds to wait before answering each search')
+    parser.add_argument('--verbose', dest='verbose', action='store_true', help='Log every request')
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s %(message)s", level=logging.DEBUG if args.verbose else logging.INFO)
+    server = ThreadingHTTPServer((args.host, args.port), StandinHandler)
+    server.daemon_threads = True
+    server.es = StandinES(tests=args.tests, interval=args.interval, latency=args.latency)
+    log.info("Serving {0} tests on {1}:{2}".format(args.tests, args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+'''
+Summaries for windows that have no rollup job. Elastic calculates them with a
+composite date_histogram aggregation over the raw results, using the same 
+metrics as the rollup jobs. Each bucket is converted to a document shaped like
+the ones in the rollup indices so it is parsed the same way as rollup data.
+Like rollups, windows are aligned to the epoch, a time range matches the 
+windows that start in it and each window has all of its results.
+'''
+from util import *
+from werkzeug.exceptions import BadRequest
+from columns import ROLLUP_STATS
+
+#Most windows that one request can aggregate, including the ones skipped by
+# offset. Elastic fails searches with more buckets than search.max_buckets.
+DEFAULT_MAX_AGGREGATION_BUCKETS=10000
+AGGREGATION_NAME="windows"
+#Field rollup documents have the start of their window in, as epoch millis
+ROLLUP_TIME_FIELD="pscheduler.start_time.date_histogram.timestamp"
+
+log = logging.getLogger('elmond')
+
+def aggregation_metrics(event_type, summary_type, field):
+    '''
+    Returns a list of (rollup key, metric, field) tuples with the metrics
+    needed for the summary of field and the key each one has in a rollup
+    document. Returns None if the summary can't be aggregated.
+    '''
+    if not isinstance(field, str):
+        return None
+    if summary_type == "averages":
+        #rollups keep the sum and count so averages can be combined
+        return [
+            ("{0}.avg.value".format(field), "sum", field),
+            ("{0}.avg._count".format(field), "value_count", field)
+        ]
+    elif summary_type == "aggregations" and event_type.startswith("packet-loss-rate"):
+        return [
+            ("{0}.lost.sum.value".format(field), "sum", "{0}.lost".format(field)),
+            ("{0}.sent.sum.value".format(field), "sum", "{0}.sent".format(field))
+        ]
+    elif summary_type == "aggregations" and field.endswith(".sum.value"):
+        return [ (field, "sum", field[:-len(".sum.value")]) ]
+    elif summary_type == "statistics" and event_type.startswith("histogram-"):
+        metrics = []
+        for name, key, metric in ROLLUP_STATS:
+            if metric == "avg":
+                stat_field = "{0}.{1}".format(field, key)
+                metrics.append(("{0}.avg.value".format(stat_field), "sum", stat_field))
+                metrics.append(("{0}.avg._count".format(stat_field), "value_count", stat_field))
+            else:
+                #e.g. the max of the max of each result
+                stat, metric = key.split('.')[:2]
+                metrics.append(("{0}.{1}".format(field, key), metric, "{0}.{1}".format(field, stat)))
+        return metrics
+
+    return None
+
+def check_window_count(result_size, result_offset=0):
+    '''
+    Returns the number of windows to aggregate to answer a request for 
+    result_size windows after result_offset, which is all of them up to 
+    MAX_AGGREGATION_BUCKETS if result_size is None. Raises BadRequest if 
+    more than MAX_AGGREGATION_BUCKETS are needed.
+    '''
+    max_buckets = app.config.get('ELMOND', {}).get("MAX_AGGREGATION_BUCKETS", DEFAULT_MAX_AGGREGATION_BUCKETS)
+    if result_size is None:
+        windows = max_buckets
+    else:
+        windows = result_offset + result_size
+    if result_offset >= max_buckets or windows > max_buckets:
+        raise BadRequest("Requests for summary windows without a rollup cannot go past {0} windows. Use a smaller offset or limit, or a shorter time range.".format(max_buckets))
+    return windows
+
+def build_window_filter(q, summary_window, time_field="pscheduler.start_time"):
+    '''
+    Builds the time filter on the raw results for the windows that start in
+    the requested time range, so every window is whole like a rollup
+    '''
+    time_filters = handle_time_filters(q)
+    if not time_filters["has_filters"]:
+        return None
+    #first window starting at or after begin
+    begin = -(-time_filters["begin"] // summary_window) * summary_window
+    range_dsl = { "range": { time_field: { "gte": datetime.datetime.utcfromtimestamp(begin) } } }
+    if time_filters["end"] is not None:
+        #end of the last window starting at or before end
+        end = (time_filters["end"] // summary_window + 1) * summary_window
+        range_dsl["range"][time_field]["lt"] = datetime.datetime.utcfromtimestamp(end)
+    return range_dsl
+
+def build_aggregation(metrics, summary_window, size, time_field="pscheduler.start_time"):
+    '''
+    Returns the aggs for a search that calculates metrics for the first size
+    windows in time order. Empty windows are left out like with rollups.
+    '''
+    return {
+        AGGREGATION_NAME: {
+            "composite": {
+                "size": size,
+                "sources": [
+                    { "ts": { "date_histogram": { "field": time_field, "fixed_interval": "{0}s".format(summary_window) } } }
+                ]
+            },
+            "aggs": {
+                "m{0}".format(i): { metric: { "field": field } } for i, (key, metric, field) in enumerate(metrics)
+            }
+        }
+    }
+
+def aggregation_hits(res, metrics, result_size=None, result_offset=0):
+    '''
+    Converts the buckets in a response to the search from build_aggregation
+    to hits with rollup documents. Skips result_offset windows and returns no
+    more than result_size.
+    '''
+    buckets = res.get("aggregations", {}).get(AGGREGATION_NAME, {}).get("buckets", [])
+    if result_size is None:
+        buckets = buckets[result_offset:]
+    else:
+        buckets = buckets[result_offset:result_offset + result_size]
+    hits = []
+    for bucket in buckets:
+        source = { ROLLUP_TIME_FIELD: bucket.get("key", {}).get("ts", None) }
+        for i, (key, metric, field) in enumerate(metrics):
+            source[key] = bucket.get("m{0}".format(i), {}).get("value", None)
+        hits.append({ "_source": source })
+
+    return hits
@@ -3,11 +3,29 @@ import logging.config
 import json
 import os
 import sys
-from data import EsmondData
-from elasticsearch import Elasticsearch
+import time
+from cache import LRUCache
+from capture import RequestCapture
+from data import EsmondData, build_batch_lookups, build_batch_response
+from elastic import build_elastic
 from flask import Flask, Response, request, g
-from metadata import EsmondMetadata
-from werkzeug.exceptions import NotFound
+from httpcache import ResponseCache, build_request_key, DEFAULT_RESPONSE_CACHE_BYTES, DEFAULT_RESPONSE_CACHE_SIZE, EMPTY_RESULTS_HEADER
+from indices import DEFAULT_TEST_TYPE_CACHE_SIZE
+from metadata import EsmondMetadata, EsmondMetadataCache, DEFAULT_METADATA_CACHE_SIZE
+from metrics import REGISTRY, REQUEST_SECONDS, RESPONSE_BYTES, CONTENT_TYPE, count_bytes, data_labels, stats_collector
+from profiling import profile_data, wants_profile
+from resolver import Resolver
+from singleflight import SingleFlight, coalesce_response
+from sqlitecache import SQLiteCacheStore
+from timing import build_server_timing, get_timings
+from response import build_writer, get_format, DEFAULT_MSGPACK_MAX_RESULTS, ENCODER_AUTO, FORMAT_JSON, FORMAT_MIMETYPES, FORMAT_MSGPACK, FORMAT_NDJSON
+from util import PRETTY_FILTER, STREAM_FILTER
+from werkzeug.exceptions import BadRequest, NotFound
+
+#metadata objects are not flat so only the json formats make sense
+METADATA_FORMATS = [FORMAT_JSON, FORMAT_NDJSON]
+#batch results are one object keyed by request
+BATCH_FORMATS = [FORMAT_JSON, FORMAT_MSGPACK]
 
 def create_app(test_config=None):
     app = Flask(__name__)
@@ -38,42 +56,226 @@ def create_app(test_config=None):
     app.config['ELMOND'] = config
     
     #todo: error handling
-    es_hosts = config.get("ELASTIC_HOSTS", ['localhost'])
-    elastic_params = config.get("ELASTIC_PARAMS", {})
-    es = Elasticsearch(es_hosts, **elastic_params)
+    es = build_elastic(config)
+    
+    #caches below can be kept in a file shared by all processes on the host
+    shared_cache = None
+    shared_cache_params = dict(config.get("SHARED_CACHE", {}))
+    if shared_cache_params.pop("enabled", False):
+        shared_cache = SQLiteCacheStore(**shared_cache_params)
+    
+    #shared map of metadata key to test type used to pick indices
+    test_type_params = dict(config.get("TEST_TYPE_CACHE", {}))
+    test_type_params.setdefault("max_size", DEFAULT_TEST_TYPE_CACHE_SIZE)
+    if shared_cache:
+        test_types = shared_cache.cache("test_types", **test_type_params)
+    else:
+        test_types = LRUCache(**test_type_params)
+    
+    #shared cache of metadata objects
+    md_cache = None
+    md_cache_params = dict(config.get("METADATA_CACHE", {}))
+    if md_cache_params.pop("enabled", True):
+        if shared_cache:
+            md_cache_params["entries"] = shared_cache.cache("metadata", max_size=md_cache_params.get("max_size", DEFAULT_METADATA_CACHE_SIZE))
+            md_cache_params["state"] = shared_cache.cache("metadata_state", max_size=None)
+        md_cache = EsmondMetadataCache(es, test_types=test_types, **md_cache_params)
 
-    #function for dumping a json response
-    def json_response(obj):
-        text = json.dumps(obj,
-                     sort_keys=True,
-                     indent=4,
-                     separators=(',', ': ')
-                    )
-        return Response(text + '\n',
-                        mimetype='application/json')
-                
+    #shared DNS cache for filters on hostnames
+    resolver = Resolver(**config.get("DNS_RESOLVER", {}))
+    
+    #shared cache of rendered responses for conditional and repeated requests
+    response_cache = None
+    response_cache_params = dict(config.get("RESPONSE_CACHE", {}))
+    if response_cache_params.pop("enabled", True):
+        if shared_cache:
+            response_cache_params["entries"] = shared_cache.cache("responses",
+                max_size=response_cache_params.get("max_size", DEFAULT_RESPONSE_CACHE_SIZE),
+                max_bytes=response_cache_params.get("max_bytes", DEFAULT_RESPONSE_CACHE_BYTES),
+                sizeof=lambda entry: len(entry[0]))
+        response_cache = ResponseCache(**response_cache_params)
+    
+    #identical requests running at the same time share one search
+    flight = None
+    coalesce_params = dict(config.get("COALESCE", {}))
+    if coalesce_params.pop("enabled", True):
+        flight = SingleFlight(**coalesce_params)
+
+    #writes responses. json encoder is pluggable and output is compact unless asked
+    json_encoder = config.get("JSON_ENCODER", ENCODER_AUTO)
+    pretty_default = config.get("PRETTY_JSON", False)
+    msgpack_max_results = config.get("MSGPACK_MAX_RESULTS", DEFAULT_MSGPACK_MAX_RESULTS)
+    def get_writer(allowed=None):
+        pretty = pretty_default
+        if PRETTY_FILTER in request.args:
+            pretty = request.args.get(PRETTY_FILTER, "").lower() in ["", "1", "true"]
+        fmt = get_format(request, allowed=allowed)
+        return build_writer(fmt, pretty=pretty, encoder=json_encoder, msgpack_max_results=msgpack_max_results)
+    
+    #shared with other ways of serving the app like asgi.py
+    app.extensions['elmond'] = {
+        "es": es,
+        "test_types": test_types,
+        "md_cache": md_cache,
+        "resolver": resolver,
+        "response_cache": response_cache,
+        "flight": flight,
+        "get_writer": get_writer
+    }
+    
+    @app.before_request
+    def start_request_timer():
+        g.request_start = time.time()
+    
+    #time spent on each step, for the browser's developer tools. streamed 
+    # responses are written after the header so don't include serializing.
+    if config.get("SERVER_TIMING", True):
+        @app.after_request
+        def add_server_timing(response):
+            start = g.get("request_start", None)
+            total = None
+            if start is not None:
+                total = time.time() - start
+            response.headers["Server-Timing"] = build_server_timing(get_timings(), total=total)
+            return response
+    
+    #per-process metrics for prometheus
+    if config.get("METRICS", True):
+        def get_cache_stats():
+            return {
+                "test_types": test_types.stats(),
+                "metadata": md_cache.stats() if md_cache else None,
+                "dns": resolver.stats(),
+                "response": response_cache.stats() if response_cache else None,
+                "coalesce": flight.stats() if flight else None
+            }
+        cache_collector = stats_collector("elmond_cache", "Statistics of the shared caches", get_cache_stats)
+        formats = { m: f for f, m in FORMAT_MIMETYPES }
+        
+        @app.after_request
+        def observe_request(response):
+            start = g.get("request_start", None)
+            if start is None:
+                return response
+            endpoint = request.endpoint or "none"
+            method = request.method
+            status = response.status_code
+            fmt = formats.get(response.mimetype, "")
+            labels = data_labels()
+            def done(size):
+                REQUEST_SECONDS.observe(time.time() - start, endpoint=endpoint, method=method, status=status, **labels)
+                RESPONSE_BYTES.observe(size, endpoint=endpoint, format=fmt, **labels)
+            #streamed responses are timed until the last byte is written
+            if response.is_streamed:
+                response.response = count_bytes(response.response, done)
+            else:
+                done(response.content_length or 0)
+            return response
+        
+        @app.route('/metrics', methods=['GET'])
+        def get_metrics():
+            return Response(REGISTRY.render(collectors=[cache_collector]), content_type=CONTENT_TYPE)
+    
+    #sample of requests written to a log that can be replayed
+    capture_params = dict(config.get("CAPTURE", {}))
+    if capture_params.pop("enabled", False):
+        capture = RequestCapture(**capture_params)
+        
+        @app.after_request
+        def capture_request(response):
+            if request.endpoint == "get_metrics" or not capture.sample():
+                return response
+            entry = capture.build_entry(response.status_code)
+            def done(size):
+                capture.write(entry, size)
+            if response.is_streamed:
+                response.response = count_bytes(response.response, done)
+            else:
+                done(response.content_length or 0)
+            return response
                 
+    def cached_metadata(writer, q, build):
+        #responses answered from the metadata cache are versioned by its 
+        # contents. Anything that has to search elastic is not cached since
+        # there is no cheap way to tell if it changed.
+        key = build_request_key(writer)
+        if response_cache is None or md_cache is None or not md_cache.answers(q):
+            return coalesce_response(flight, key, build)
+        version = md_cache.version
+        etag = response_cache.build_etag(key, version)
+        response = response_cache.lookup(etag)
+        if response is None:
+            response = coalesce_response(flight, etag, build)
+            #the cache may have been refreshed or lost the entry while building
+            if md_cache.version == version and md_cache.answers(q):
+                response = response_cache.store(etag, response)
+        return response
+    
     @app.route('/', methods=['GET'])
     def list_metadata():
-        emd = EsmondMetadata(es)
-        metadata = emd.search(q=request.args, request_url=request.url, paginate=True)
-        return json_response(metadata)
+        emd = EsmondMetadata(es, cache=md_cache, test_types=test_types)
+        writer = get_writer(allowed=METADATA_FORMATS)
+        def build():
+            metadata = emd.search(q=request.args, request_url=request.url, paginate=True)
+            return writer.write_list(metadata)
+        return cached_metadata(writer, request.args, build)
 
     @app.route('/<metadata_key>', methods=['GET'])
     def get_metadata(metadata_key):
-        emd = EsmondMetadata(es)
-        metadata = emd.search(q={'metadata-key': metadata_key}, request_url=request.url)
-        if len(metadata) == 0:
-            raise NotFound("Unable to find metadata with key {0}".format(metadata_key))
-            
-        return json_response(metadata[0])
+        writer = get_writer(allowed=METADATA_FORMATS)
+        emd = EsmondMetadata(es, cache=md_cache, test_types=test_types)
+        def build():
+            metadata = emd.search(q={'metadata-key': metadata_key}, request_url=request.url)
+            if len(metadata) == 0:
+                raise NotFound("Unable to find metadata with key {0}".format(metadata_key))
+            return writer.write(metadata[0])
+        return cached_metadata(writer, {'metadata-key': metadata_key}, build)
         
     @app.route('/<metadata_key>/<event_type>/<summary_type>/<summary_window>', methods=['GET'])
     def get_data(metadata_key, event_type, summary_type, summary_window):
-        esd = EsmondData(es)
-        data = esd.fetch(metadata_key, event_type, summary_type, summary_window, q=request.args)
+        writer = get_writer()
+        esd = EsmondData(es, test_types=test_types)
+        if wants_profile():
+            return profile_data(esd, writer, metadata_key, event_type, summary_type, summary_window, q=request.args)
+        if request.args.get(STREAM_FILTER, "").lower() in ["1", "true"]:
+            data = esd.stream(metadata_key, event_type, summary_type, summary_window, q=request.args)
+            return writer.write_list(data)
+        closed = False
+        def build():
+            data = esd.fetch(metadata_key, event_type, summary_type, summary_window, q=request.args)
+            response = writer.write_list(data)
+            if closed and len(data) == 0:
+                response.headers[EMPTY_RESULTS_HEADER] = "1"
+            return response
+        key = build_request_key(writer)
+        if response_cache is None:
+            return coalesce_response(flight, key, build)
+        
+        #closed windows can't change so only open ones need to check elastic
+        closed = response_cache.is_closed(request.args, summary_window)
+        if not closed and not response_cache.open_windows:
+            return coalesce_response(flight, key, build)
+        version = None
+        if not closed:
+            version = esd.version(metadata_key, event_type, summary_type, summary_window, q=request.args)
+        etag = response_cache.build_etag(key, version)
+        response = response_cache.lookup(etag, closed=closed)
+        if response is None:
+            response = response_cache.store(etag, coalesce_response(flight, etag, build), closed=closed)
+        
+        return response
+    
+    @app.route('/batch', methods=['POST'])
+    def post_batch():
+        writer = get_writer(allowed=BATCH_FORMATS)
+        body = request.get_json(silent=True)
+        if body is None:
+            raise BadRequest("Batch request body must be JSON")
+        lookups = build_batch_lookups(body)
+        esd = EsmondData(es, test_types=test_types)
+        results = esd.fetch_batch([lookup for lookup_id, lookup in lookups])
         
-        return json_response(data)
+        return writer.write(build_batch_response(lookups, results))
     
     return app
     
@@ -0,0 +1,373 @@
+'''
+Serves elmond with asyncio through ASGI, e.g. with uvicorn:
+
+    uvicorn --factory --app-dir /app asgi:create_asgi_app
+
+Data and batch requests are run on the event loop with an async elastic
+client, so slow searches don't tie up a worker. Building queries, parsing,
+serializing and the response cache are run in a thread pool so they don't
+hold up the loop. Everything else (metadata, streaming, profiling and merged
+histogram statistics) is run by the regular Flask app in the thread pool. Requires elasticsearch-py with async support (aiohttp).
+'''
+import asyncio
+import concurrent.futures
+import io
+import logging
+import sys
+import threading
+import time
+from app import create_app, BATCH_FORMATS
+from concurrent.futures import ThreadPoolExecutor
+from data import EsmondData, build_batch_lookups, build_batch_response
+from elastic import elastic_params
+from flask import request
+from httpcache import build_request_key, EMPTY_RESULTS_HEADER
+from metrics import ES_ERRORS, add_search_timing, observe_search
+from singleflight import build_response, read_response
+from timing import add_timing, get_timings
+from urllib.parse import parse_qs
+from util import PROFILE_FILTER, STREAM_FILTER
+from werkzeug.exceptions import BadRequest, HTTPException
+
+#async client is optional and only needed for this mode
+try:
+    from elasticsearch import AsyncElasticsearch
+except ImportError:
+    AsyncElasticsearch = None
+
+log = logging.getLogger('elmond')
+
+#Threads used for requests that are not async
+DEFAULT_ASYNC_THREADS=32
+#Chunks of a threaded response that can be waiting to be sent
+WSGI_QUEUE_SIZE=8
+#Seconds between checks that the loop is still reading a threaded response
+WSGI_PUT_POLL=1
+
+def _build_environ(scope, body):
+    '''
+    Builds a WSGI environ from an ASGI HTTP scope so the Flask app can route
+    and handle the request
+    '''
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/{0}".format(scope.get("http_version", "1.1")),
+        "REMOTE_ADDR": client[0],
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+        elif name != "CONTENT_LENGTH":
+            key = "HTTP_{0}".format(name)
+            if key in environ:
+                value = "{0},{1}".format(environ[key], value)
+            environ[key] = value
+
+    return environ
+
+class ElmondASGI:
+    '''
+    ASGI application that wraps the Flask app returned by create_app
+    '''
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.state = flask_app.extensions['elmond']
+        config = flask_app.config.get('ELMOND', {})
+        self.executor = ThreadPoolExecutor(max_workers=config.get("ASYNC_THREADS", DEFAULT_ASYNC_THREADS))
+        self.aes = None
+
+    def _get_async_es(self):
+        #the client has to be created from within the event loop
+        if self.aes is None:
+            if AsyncElasticsearch is None:
+                raise RuntimeError("elasticsearch-py async support is not installed, install aiohttp")
+            config = self.flask_app.config.get('ELMOND', {})
+            params = elastic_params(config)
+            #aiohttp sets up its own sockets
+            params.pop("tcp_keepalive", None)
+            self.aes = AsyncElasticsearch(config.get("ELASTIC_HOSTS", ['localhost']), **params)
+        return self.aes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({ "type": "lifespan.startup.complete" })
+            elif message["type"] == "lifespan.shutdown":
+                if self.aes is not None:
+                    await self.aes.close()
+                self.executor.shutdown(wait=False)
+                await send({ "type": "lifespan.shutdown.complete" })
+                return
+
+    async def _http(self, scope, receive, send):
+        body = b''
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+        environ = _build_environ(scope, body)
+
+        #route with the flask url map and hand anything we don't do async to flask
+        endpoint = None
+        view_args = {}
+        try:
+            endpoint, view_args = self.flask_app.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            pass
+        if endpoint == "get_data" and (self._has_flag(environ, STREAM_FILTER) or self._has_flag(environ, PROFILE_FILTER)):
+            endpoint = None
+        if endpoint == "get_data":
+            await self._handle(environ, send, self._get_data(**view_args))
+        elif endpoint == "post_batch":
+            await self._handle(environ, send, self._post_batch())
+        else:
+            await self._run_wsgi(environ, send)
+
+    def _has_flag(self, environ, name):
+        value = parse_qs(environ["QUERY_STRING"]).get(name, [""])[0]
+        return value.lower() in ["1", "true"]
+
+    async def _in_thread(self, func, *args):
+        '''
+        Runs func in the thread pool with a context for the current request of
+        its own, then adds the timings it recorded to the ones of the current
+        request
+        '''
+        environ = request.environ
+        def run():
+            with self.flask_app.request_context(environ):
+                return func(*args), dict(get_timings())
+        result, timings = await asyncio.get_running_loop().run_in_executor(self.executor, run)
+        for name, seconds in timings.items():
+            add_timing(name, seconds)
+        return result
+
+    async def _handle(self, environ, send, handler):
+        '''
+        Runs the coroutine handler with the request context and the hooks
+        registered on the flask app, then sends the response it returns
+        '''
+        app = self.flask_app
+        with app.request_context(environ):
+            try:
+                rv = app.preprocess_request()
+                if rv is None:
+                    rv = await handler
+                else:
+                    handler.close()
+                response = app.make_response(rv)
+            except Exception as e:
+                response = self._handle_exception(e)
+            response = app.process_response(response)
+            await self._send_response(send, response)
+
+    def _handle_exception(self, e):
+        app = self.flask_app
+        try:
+            return app.make_response(app.handle_user_exception(e))
+        except Exception as e:
+            return app.make_response(app.handle_exception(e))
+
+    async def _send_response(self, send, response):
+        headers = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in response.headers.to_wsgi_list()]
+        await send({ "type": "http.response.start", "status": response.status_code, "headers": headers })
+        try:
+            for chunk in response.iter_encoded():
+                if chunk:
+                    await send({ "type": "http.response.body", "body": chunk, "more_body": True })
+        finally:
+            response.close()
+        await send({ "type": "http.response.body", "body": b"", "more_body": False })
+
+    async def _run_wsgi(self, environ, send):
+        '''
+        Runs the request through the flask app in the thread pool. The response
+        is read in the same thread, since flask streams with context locals,
+        and handed to the loop through a queue as it is written.
+        '''
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=WSGI_QUEUE_SIZE)
+        stopped = threading.Event()
+
+        def put(item):
+            if stopped.is_set() or loop.is_closed():
+                raise ConnectionAbortedError("client went away")
+            future = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+            #don't wait forever on a loop that is no longer reading the queue
+            while True:
+                try:
+                    return future.result(timeout=WSGI_PUT_POLL)
+                except concurrent.futures.TimeoutError:
+                    if stopped.is_set() or loop.is_closed():
+                        future.cancel()
+                        raise ConnectionAbortedError("client went away")
+
+        def run():
+            def start_response(status, headers, exc_info=None):
+                put({ 
+                    "type": "http.response.start",
+                    "status": int(status.split(" ", 1)[0]),
+                    "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers]
+                })
+            body = self.flask_app.wsgi_app(environ, start_response)
+            try:
+                for chunk in body:
+                    if chunk:
+                        put({ "type": "http.response.body", "body": chunk, "more_body": True })
+            finally:
+                if hasattr(body, "close"):
+                    body.close()
+                #the loop may have stopped reading or be gone already
+                try:
+                    put(None)
+                except (ConnectionAbortedError, RuntimeError):
+                    pass
+
+        future = loop.run_in_executor(self.executor, run)
+        try:
+            while True:
+                message = await queue.get()
+                if message is None:
+                    break
+                await send(message)
+        finally:
+            #let the thread finish if we stopped early
+            stopped.set()
+            while not future.done():
+                try:
+                    queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    await asyncio.sleep(0.01)
+            #the thread stops with ConnectionAbortedError if we stopped early
+            if not future.cancelled():
+                future.exception()
+        await future
+        await send({ "type": "http.response.body", "body": b"", "more_body": False })
+
+    async def _search(self, query, kind="data"):
+        '''
+        Runs the search for an EsmondDataQuery with the async client and
+        records metrics for it
+        '''
+        start = time.time()
+        try:
+            res = await self._get_async_es().search(index=query.index_name, body=query.dsl, ignore_unavailable=True, allow_no_indices=True)
+        except Exception:
+            ES_ERRORS.inc(kind=kind, **query.labels())
+            raise
+        wall = time.time() - start
+        observe_search(res, wall, kind, **query.labels())
+        add_search_timing([res], wall)
+        return res
+
+    async def _msearch(self, esd, batch):
+        start = time.time()
+        res = await self._get_async_es().msearch(body=batch.body)
+        esd.observe_batch(batch, res, time.time() - start)
+        return res
+
+    async def _get_data(self, metadata_key, event_type, summary_type, summary_window):
+        writer = self.state["get_writer"]()
+        esd = EsmondData(self.state["es"], test_types=self.state["test_types"])
+        response_cache = self.state.get("response_cache", None)
+        flight = self.state.get("flight", None)
+        key = build_request_key(writer)
+        closed = False
+        cached = response_cache is not None
+        if cached:
+            #open windows need a version search so are only cached if asked
+            closed = response_cache.is_closed(request.args, summary_window)
+            cached = closed or response_cache.open_windows
+        if cached:
+            version = None
+            if not closed:
+                query = await self._in_thread(esd.prepare_version, metadata_key, event_type, summary_type, summary_window, request.args)
+                res = await self._search(query, kind="version")
+                version = esd.parse_version(res)
+            key = response_cache.build_etag(key, version)
+            response = await self._in_thread(response_cache.lookup, key, closed)
+            if response is not None:
+                return response
+
+        def serialize(data):
+            #read in full in the same thread, since flask streams with 
+            # context locals and the body is sent from the loop anyway
+            response = writer.write_list(data)
+            if closed and len(data) == 0:
+                response.headers[EMPTY_RESULTS_HEADER] = "1"
+            shared, response = read_response(response)
+            return shared
+
+        def fetch():
+            return serialize(esd.fetch(metadata_key, event_type, summary_type, summary_window, request.args.copy()))
+
+        def parse(query, res):
+            return serialize(esd.parse_response(metadata_key, query, res))
+
+        async def build():
+            query = await self._in_thread(esd.prepare_fetch, metadata_key, event_type, summary_type, summary_window, request.args)
+            if query is None:
+                return await self._in_thread(fetch)
+            res = await self._search(query)
+            return await self._in_thread(parse, query, res)
+
+        #identical requests on this loop share the search
+        if flight is None:
+            response = build_response(await build())
+        else:
+            response = build_response(await flight.do_async(key, build))
+        if cached:
+            return await self._in_thread(response_cache.store, key, response, closed)
+        return response
+
+    async def _post_batch(self):
+        writer = self.state["get_writer"](allowed=BATCH_FORMATS)
+        body = request.get_json(silent=True)
+        if body is None:
+            raise BadRequest("Batch request body must be JSON")
+        lookups = build_batch_lookups(body)
+        esd = EsmondData(self.state["es"], test_types=self.state["test_types"])
+        batch = await self._in_thread(esd.prepare_batch, [lookup for lookup_id, lookup in lookups])
+
+        #run the msearch and any lookups that need their own searches at the same time
+        tasks = [self._in_thread(esd.fetch_lookup, batch.lookups[i]) for i in batch.separate]
+        if batch.body:
+            tasks.append(self._msearch(esd, batch))
+        results = await asyncio.gather(*tasks)
+        for i, data in zip(batch.separate, results):
+            batch.results[i] = data
+        if batch.body:
+            await self._in_thread(esd.parse_batch, batch, results[-1])
+
+        def write():
+            return writer.write(build_batch_response(lookups, batch.results))
+        return await self._in_thread(write)
+
+def create_asgi_app(test_config=None):
+    return ElmondASGI(create_app(test_config=test_config))
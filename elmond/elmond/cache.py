@@ -0,0 +1,132 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+log = logging.getLogger('elmond')
+
+class LRUCache:
+    '''
+    A thread-safe in-process cache with least-recently-used eviction and an
+    optional time-to-live for entries. Keeps hit, miss and eviction counters.
+    If max_bytes is set entries are also evicted once the total of sizeof for
+    each value goes over it.
+    '''
+
+    def __init__(self, max_size=1000, ttl=None, max_bytes=None, sizeof=len):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def _expired(self, expires):
+        return expires is not None and expires < time.time()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, None)
+            if entry is None or self._expired(entry[0]):
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def peek(self, key, default=None):
+        '''
+        Returns the value for key like get but does not affect the 
+        recently-used order or the hit/miss counters
+        '''
+        with self._lock:
+            entry = self._data.get(key, None)
+            if entry is None or self._expired(entry[0]):
+                return default
+            return entry[1]
+
+    def _remove(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def _full(self):
+        if self.max_size and len(self._data) > self.max_size:
+            return True
+        return bool(self.max_bytes) and self.bytes > self.max_bytes
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        expires = None
+        if ttl:
+            expires = time.time() + ttl
+        size = 0
+        if self.max_bytes:
+            size = self.sizeof(value)
+            if size > self.max_bytes:
+                #would evict everything else and still not fit
+                self.delete(key)
+                return
+        with self._lock:
+            self._remove(key)
+            self._data[key] = (expires, value, size)
+            self.bytes += size
+            while self._full():
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def set_many(self, items, ttl=None):
+        '''
+        Sets each (key, value) pair in items
+        '''
+        with self._lock:
+            for key, value in items:
+                self.set(key, value, ttl=ttl)
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def items(self):
+        '''
+        Returns a list of (key, value) pairs that have not expired. Does not
+        affect the recently-used order or the hit/miss counters.
+        '''
+        with self._lock:
+            return [(k, v[1]) for k, v in self._data.items() if not self._expired(v[0])]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "bytes": self.bytes
+            }
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._data.get(key, None)
+            return entry is not None and not self._expired(entry[0])
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
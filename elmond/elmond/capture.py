@@ -0,0 +1,94 @@
+'''
+Writes a sample of requests to a log that bench/replay.py can play back
+against another elmond. Each line is a JSON object with the time, method,
+path, query arguments, Accept header and body of the request and the status,
+latency and size of its response.
+'''
+import json
+import logging
+import os
+import random
+import threading
+import time
+from flask import g, request
+
+log = logging.getLogger('elmond')
+
+#Defaults for the CAPTURE config
+DEFAULT_CAPTURE_FILE="/var/log/elmond/capture.ndjson"
+DEFAULT_CAPTURE_SAMPLE_RATE=1.0
+#Request bodies longer than this are not captured
+DEFAULT_CAPTURE_MAX_BODY=1048576
+
+class RequestCapture:
+    '''
+    Appends captured requests to file. Every line is written with a single
+    write on a file opened for appending so processes can share the file.
+    '''
+
+    def __init__(self,
+                    file=DEFAULT_CAPTURE_FILE,
+                    sample_rate=DEFAULT_CAPTURE_SAMPLE_RATE,
+                    max_body=DEFAULT_CAPTURE_MAX_BODY
+                ):
+        self.file = file
+        self.sample_rate = sample_rate
+        self.max_body = max_body
+        self.captured = 0
+        self.errors = 0
+        self._fd = None
+        self._lock = threading.Lock()
+
+    def _get_fd(self):
+        if self._fd is None:
+            dirname = os.path.dirname(self.file)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            self._fd = os.open(self.file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        return self._fd
+
+    def sample(self):
+        '''
+        Returns True if the current request should be captured
+        '''
+        return self.sample_rate >= 1.0 or random.random() < self.sample_rate
+
+    def build_entry(self, status):
+        '''
+        Returns the parts of the current request needed to replay it
+        '''
+        entry = {
+            "ts": g.get("request_start", time.time()),
+            "method": request.method,
+            "path": request.path,
+            "args": [[k, v] for k, v in request.args.items(multi=True)],
+            "status": status
+        }
+        if "Accept" in request.headers:
+            entry["accept"] = request.headers["Accept"]
+        if request.method == "POST":
+            body = request.get_data(cache=True)
+            if len(body) <= self.max_body:
+                entry["content_type"] = request.content_type
+                entry["body"] = body.decode("utf-8", errors="replace")
+        return entry
+
+    def write(self, entry, size):
+        '''
+        Adds the latency and response size to entry and appends it to the log
+        '''
+        entry["latency"] = round(time.time() - entry["ts"], 6)
+        entry["bytes"] = size
+        line = (json.dumps(entry, separators=(",", ":")) + "\n").encode("utf-8")
+        try:
+            with self._lock:
+                os.write(self._get_fd(), line)
+                self.captured += 1
+        except OSError as e:
+            with self._lock:
+                self.errors += 1
+            log.error("Unable to write to capture file {0}: {1}".format(self.file, e))
+
+    def stats(self):
+        with self._lock:
+            return { "captured": self.captured, "errors": self.errors, "sample_rate": self.sample_rate }
@@ -0,0 +1,276 @@
+import logging
+from histogram import ESMOND_STATS, build_esmond_histograms
+from util import datestr_to_timestamp
+
+#numpy is optional. Without it data is extracted one hit at a time.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+log = logging.getLogger('elmond')
+
+#Order of the statistics fields in rollups and their esmond names
+ROLLUP_STATS = [
+    ("maximum", "max.max.value", None),
+    ("mean", "mean", "avg"),
+    ("median", "median", "avg"),
+    ("minimum", "min.min.value", None),
+    ("mode", "mode", "avg"),
+    ("percentile-25", "p_25", "avg"),
+    ("percentile-75", "p_75", "avg"),
+    ("percentile-95", "p_95", "avg"),
+    ("standard-deviation", "stddev", "avg"),
+    ("variance", "variance", "avg")
+]
+
+def _get_path(obj, key_parts):
+    for key_part in key_parts:
+        if not isinstance(obj, dict):
+            return None
+        obj = obj.get(key_part, None)
+        if obj is None:
+            return None
+    return obj
+
+def _to_float(v):
+    if v is None or isinstance(v, bool):
+        return None
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return None
+
+def _to_float_array(vals):
+    '''
+    Converts a list of values to a float array with NaN where there is no value
+    '''
+    return np.array([np.nan if f is None else f for f in map(_to_float, vals)], dtype=np.float64)
+
+def _nan_to_none(arr):
+    col = arr.tolist()
+    for i in np.flatnonzero(np.isnan(arr)):
+        col[i] = None
+    return col
+
+def parse_timestamps(datestrs):
+    '''
+    Converts a list of ISO 8601 date strings to an array of unix timestamps and
+    a mask of the ones that had a date. Strings in UTC (ending in Z) are 
+    converted all at once, anything else one at a time with dateutil.
+    '''
+    if all(d is None or d.endswith("Z") for d in datestrs):
+        try:
+            ts = np.array([d[:-1] if d else "NaT" for d in datestrs], dtype='datetime64[s]')
+            valid = ~np.isnat(ts)
+            return np.where(valid, ts.astype(np.int64), 0), valid
+        except ValueError:
+            pass
+    ts = [datestr_to_timestamp(d) for d in datestrs]
+    valid = np.array([t is not None for t in ts], dtype=bool)
+    return np.array([t or 0 for t in ts], dtype=np.int64), valid
+
+def docvalue(fields, field):
+    '''
+    Returns the first doc value of field in the fields of a hit
+    '''
+    vals = fields.get(field, None)
+    if not vals:
+        return None
+    return vals[0]
+
+def docvalue_timestamp(val):
+    '''
+    Converts a date doc value in epoch_second format to a unix timestamp.
+    Elastic adds the fraction of a second if there is one.
+    '''
+    if val is None:
+        return None
+    try:
+        return int(float(val))
+    except (TypeError, ValueError):
+        return None
+
+class DataColumns:
+    '''
+    Columnar data for an esmond data request. Holds the timestamps and values 
+    as arrays and only builds the {"ts": ..., "val": ...} rows as they are 
+    iterated over when the response is written.
+    '''
+
+    def __init__(self, ts, val=None, stats=None):
+        self.ts = ts
+        #scalar values as an array or structured values as a list
+        self.val = val
+        #statistics as an ordered map of esmond name to an array or a list
+        self.stats = stats
+
+    def __len__(self):
+        return len(self.ts)
+
+    def values(self):
+        '''
+        Returns the values as a list of python objects
+        '''
+        if self.stats is None and isinstance(self.val, list):
+            return self.val
+        elif self.stats is None:
+            return self.val.tolist()
+        names = list(self.stats.keys())
+        cols = []
+        for name in names:
+            col = self.stats[name]
+            if isinstance(col, np.ndarray):
+                col = _nan_to_none(col)
+            cols.append(col)
+        return [dict(zip(names, row)) for row in zip(*cols)]
+
+    def __iter__(self):
+        for ts, val in zip(self.ts.tolist(), self.values()):
+            yield { "ts": ts, "val": val }
+
+def _scalar_columns(ts, vals):
+    '''
+    Builds columns for plain numbers. Returns None if there are values that
+    are not numbers or a mix of integers and floats since those would not 
+    serialize the same as the original values.
+    '''
+    mask = np.array([v is not None for v in vals], dtype=bool)
+    present = [v for v in vals if v is not None]
+    if all(isinstance(v, int) and not isinstance(v, bool) for v in present):
+        dtype = np.int64
+    elif all(isinstance(v, float) for v in present):
+        dtype = np.float64
+    else:
+        return None
+    try:
+        val = np.array(present, dtype=dtype)
+    except OverflowError:
+        return None
+    return DataColumns(ts[mask], val=val)
+
+def _ratio_columns(ts, num, denom):
+    '''
+    Divides two columns, dropping rows without a numerator or denominator
+    '''
+    mask = ~np.isnan(num) & ~np.isnan(denom) & (denom != 0)
+    return DataColumns(ts[mask], val=num[mask] / denom[mask])
+
+def _ratio(num, denom):
+    '''
+    Divides two columns, with NaN for rows without a numerator or denominator
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(~np.isnan(denom) & (denom != 0), num / denom, np.nan)
+
+def _rollup_average(results, key):
+    return _ratio(
+        _to_float_array([r.get("{0}.avg.value".format(key), None) for r in results]),
+        _to_float_array([r.get("{0}.avg._count".format(key), None) for r in results])
+    )
+
+def _rollup_stats(ts, results, field, conversion_factor):
+    stats = {}
+    for name, key, metric in ROLLUP_STATS:
+        if metric == "avg":
+            col = _rollup_average(results, "{0}.{1}".format(field, key))
+        else:
+            col = _to_float_array([r.get("{0}.{1}".format(field, key), None) for r in results])
+        col = col * conversion_factor
+        if name == "mode":
+            col = [[v] for v in _nan_to_none(col)]
+        stats[name] = col
+    return DataColumns(ts, stats=stats)
+
+def _raw_stats(ts, results, field, conversion_factor):
+    #rows without the statistics object are skipped
+    key_parts = field.split('.')[1:]
+    objs = [_get_path(r, key_parts) for r in results]
+    has_stats = np.array([o is not None for o in objs], dtype=bool)
+    objs = [o for o in objs if o is not None]
+    if not all(isinstance(o, dict) for o in objs):
+        return None
+    stats = {}
+    for name, key in ESMOND_STATS:
+        vals = [o.get(key, None) for o in objs]
+        if name == "mode":
+            modes = []
+            for m in vals:
+                try:
+                    modes.append([float(v)*conversion_factor for v in m])
+                except:
+                    modes.append(m)
+            stats[name] = modes
+        else:
+            stats[name] = _to_float_array(vals) * conversion_factor
+    return DataColumns(ts[has_stats], stats=stats)
+
+def extract_columns(hits, query, field, conversion_factor=1):
+    '''
+    Pulls the timestamps and values of field out of all the hits at once and
+    does any math on whole columns. Returns a DataColumns object or None if 
+    numpy is not installed or the event type is not a number or statistics, 
+    in which case the hits should be parsed one at a time.
+    '''
+    if np is None or query.raw_type or not isinstance(field, str):
+        return None
+    event_type = query.event_type
+    summary_type = query.summary_type
+    is_stats = event_type.startswith("histogram-") and summary_type == "statistics"
+    is_histogram = event_type.startswith("histogram-") and not is_stats
+    if is_histogram and query.is_rollup:
+        return None
+    elif (event_type.startswith("streams") or event_type.endswith("subintervals") 
+            or event_type.startswith("packet-trace") or event_type == 'failures'):
+        return None
+
+    if query.docvalue_field:
+        #already epoch seconds and a number
+        fields = [hit.get("fields", {}) for hit in hits]
+        raw_ts = [docvalue_timestamp(docvalue(f, query.time_field)) for f in fields]
+        valid = np.array([bool(t) for t in raw_ts], dtype=bool)
+        ts = np.array([t or 0 for t in raw_ts], dtype=np.int64)[valid]
+        return _scalar_columns(ts, [docvalue(f, query.docvalue_field) for f, v in zip(fields, valid) if v])
+
+    #get timestamps and drop hits without a timestamp or result
+    sources = [hit.get("_source", {}) for hit in hits]
+    if query.is_rollup:
+        raw_ts = [s.get("pscheduler.start_time.date_histogram.timestamp", None) for s in sources]
+        valid = np.array([bool(t) for t in raw_ts], dtype=bool)
+        ts = (np.array([t or 0 for t in raw_ts], dtype=np.float64) / 1000).astype(np.int64)
+        results = sources
+    else:
+        ts, valid = parse_timestamps([s.get("pscheduler", {}).get("start_time", None) for s in sources])
+        results = [s.get("result", None) for s in sources]
+    valid &= (ts != 0) & np.array([bool(r) for r in results], dtype=bool)
+    ts = ts[valid]
+    results = [r for r, v in zip(results, valid) if v]
+
+    #get values
+    if is_stats and query.is_rollup:
+        return _rollup_stats(ts, results, field, conversion_factor)
+    elif is_stats:
+        return _raw_stats(ts, results, field, conversion_factor)
+    elif is_histogram:
+        key_parts = field.split('.')[1:]
+        histos = build_esmond_histograms([_get_path(r, key_parts) for r in results], conversion_factor=conversion_factor)
+        mask = np.array([h is not None for h in histos], dtype=bool)
+        return DataColumns(ts[mask], val=[h for h in histos if h is not None])
+    elif event_type.startswith("packet-loss-rate") and summary_type == "aggregations":
+        return _ratio_columns(
+            ts,
+            _to_float_array([r.get("result.packets.lost.sum.value", None) for r in results]),
+            _to_float_array([r.get("result.packets.sent.sum.value", None) for r in results])
+        )
+    elif summary_type == "averages":
+        return _ratio_columns(
+            ts,
+            _to_float_array([r.get("{0}.avg.value".format(field), None) for r in results]),
+            _to_float_array([r.get("{0}.avg._count".format(field), None) for r in results])
+        )
+    elif query.is_rollup:
+        #rollups just have dotted string keys
+        return _scalar_columns(ts, [r.get(field, None) for r in results])
+
+    key_parts = field.split('.')[1:]
+    return _scalar_columns(ts, [_get_path(r, key_parts) for r in results])
@@ -1,10 +1,33 @@
 from util import *
-from werkzeug.exceptions import BadRequest, NotImplemented
+from werkzeug.exceptions import BadRequest, HTTPException, InternalServerError, NotImplemented
+from aggregation import aggregation_hits, aggregation_metrics, build_aggregation, build_window_filter, check_window_count
 from filters import build_time_filter
+from indices import build_data_index, learn_test_type
+from columns import docvalue, docvalue_timestamp, extract_columns, parse_timestamps, np
+from histogram import Histogram, merge, to_esmond_stats
+from metrics import PARSE_SECONDS, add_search_timing, data_labels, observe_search, timed_search
+from timing import TIMING_FILTERS, TIMING_PARSE, Timer, add_timing
 import re
+import time
 
 DEFAULT_RESULT_LIMIT=1000
 MAX_RESULT_LIMIT=10000
+#Most raw results merged into statistics for one request that isn't streamed
+DEFAULT_MAX_MERGED_RESULTS=100000
+#How long elastic keeps a point-in-time open between pages when streaming
+STREAM_KEEP_ALIVE="1m"
+#Unique keyword written at ingest that breaks ties between results with the
+# same time when paging without a point-in-time. Sorting on _id would load
+# fielddata for it.
+STREAM_TIEBREAKER_FIELD="pscheduler.run_href.keyword"
+#Most lookups allowed in one batch request
+DEFAULT_MAX_BATCH_SIZE=1000
+#Fields of a lookup in a batch request. Anything else is a filter.
+BATCH_ID_FIELD="id"
+BATCH_METADATA_KEY_FIELD="metadata-key"
+BATCH_EVENT_TYPE_FIELD="event-type"
+BATCH_SUMMARY_TYPE_FIELD="summary-type"
+BATCH_SUMMARY_WINDOW_FIELD="summary-window"
 DEFAULT_SUMMARY_WINDOW_ROLLUP_NAME = {
     "300": "5m",
     "3600": "1h",
@@ -46,6 +69,23 @@ DATA_FIELD_MAP = {
     "throughput-subintervals/base": "result.intervals.json",
     "time-error-estimates/base": "result.max_clock_error"
 }
+#Event types with a single number for a value. With DOCVALUE_FIELDS set the
+# time and value of their base data are read from doc values instead of _source
+DOCVALUE_EVENT_TYPES = [
+    "packet-count-lost",
+    "packet-count-lost-bidir",
+    "packet-count-sent",
+    "packet-duplicates",
+    "packet-duplicates-bidir",
+    "packet-loss-rate",
+    "packet-loss-rate-bidir",
+    "packet-reorders",
+    "packet-reorders-bidir",
+    "packet-retransmits",
+    "path-mtu",
+    "throughput",
+    "time-error-estimates"
+]
 CONVERSION_FACTOR_MAP = {
     "histogram-rtt": 1000 #convert rtt to ms
 }
@@ -277,34 +317,120 @@ def _extract_packet_loss_rate(obj, key):
     
     return float(lost_val)/sent_val
 
-class EsmondData:
+def _get_rollup_names():
+    sw_map = app.config.get('ELMOND', {}).get('SUMMARY_WINDOW_ROLLUP_NAMES', None)
+    if not sw_map:
+        sw_map = DEFAULT_SUMMARY_WINDOW_ROLLUP_NAME
+    return sw_map
 
-    def __init__(self, es):
-        self.es = es
+def build_batch_lookups(body):
+    '''
+    Converts the body of a batch request to a list of (id, lookup) tuples 
+    where lookup can be passed to EsmondData.fetch_batch. The body is a list 
+    of objects, or an object with the list in requests, with the metadata-key,
+    event-type, summary-type and summary-window of each lookup and any 
+    filters like time-start. The id defaults to the URI of the data.
+    '''
+    if isinstance(body, dict):
+        body = body.get("requests", None)
+    if not isinstance(body, list):
+        raise BadRequest("Batch request must be a list of requests")
+    max_size = app.config.get('ELMOND', {}).get("MAX_BATCH_SIZE", DEFAULT_MAX_BATCH_SIZE)
+    if len(body) > max_size:
+        raise BadRequest("Batch request cannot have more than {0} requests".format(max_size))
     
-    def fetch(self, metadata_key, event_type, summary_type, summary_window, q={}):
-        log.debug("{0} {1}".format(summary_type, summary_window))
-        #convert summary window to int
-        try:
-            summary_window = int(summary_window)
-        except ValueError as e:
-            raise BadRequest("Summary window must be an int")
+    lookups = []
+    ids = set()
+    for item in body:
+        if not isinstance(item, dict):
+            raise BadRequest("Each request in a batch must be an object")
+        q = { k: str(v) for k, v in item.items() if v is not None }
+        lookup_id = q.pop(BATCH_ID_FIELD, None)
+        metadata_key = q.pop(BATCH_METADATA_KEY_FIELD, None)
+        event_type = q.pop(BATCH_EVENT_TYPE_FIELD, None)
+        summary_type = q.pop(BATCH_SUMMARY_TYPE_FIELD, "base")
+        summary_window = q.pop(BATCH_SUMMARY_WINDOW_FIELD, "0")
+        if not metadata_key or not event_type:
+            raise BadRequest("Each request in a batch must have a {0} and {1}".format(BATCH_METADATA_KEY_FIELD, BATCH_EVENT_TYPE_FIELD))
+        if lookup_id is None:
+            lookup_id = build_uri(metadata_key, event_type=event_type, summary_type=summary_type, summary_window=summary_window)
+        if lookup_id in ids:
+            raise BadRequest("Duplicate request {0}. Give each request a unique {1}".format(lookup_id, BATCH_ID_FIELD))
+        ids.add(lookup_id)
+        lookups.append((lookup_id, (metadata_key, event_type, summary_type, summary_window, q)))
+    
+    return lookups
+
+def build_batch_response(lookups, results):
+    '''
+    Builds the response for a batch request, keyed by the id of each lookup. 
+    Lookups that failed have an object with the error instead of a list.
+    '''
+    response = {}
+    for (lookup_id, lookup), data in zip(lookups, results):
+        if isinstance(data, HTTPException):
+            response[lookup_id] = { "error": data.description }
+        else:
+            response[lookup_id] = list(data)
+    
+    return response
+
+class EsmondDataQuery:
+    '''
+    Everything needed to run a data query and parse the hits it returns
+    '''
+    
+    def __init__(self, index_name, dsl, event_type, summary_type, is_rollup=False, time_field="pscheduler.start_time", summary_window=0, docvalue_field=None, metrics=None, result_size=None, result_offset=0):
+        self.index_name = index_name
+        self.dsl = dsl
+        self.event_type = event_type
+        self.summary_type = summary_type
+        self.summary_window = summary_window
+        self.is_rollup = is_rollup
+        self.time_field = time_field
+        self.dfm_key = "{0}/{1}".format(event_type, summary_type)
+        self.raw_type = (self.dfm_key not in DATA_FIELD_MAP)
+        #field the value is read from in the doc values of each hit, if any
+        self.docvalue_field = docvalue_field
+        #(rollup key, metric, field) for each metric when windows are aggregated
+        # from raw results, and which of the windows to return
+        self.metrics = metrics
+        self.result_size = result_size
+        self.result_offset = result_offset
+    
+    def labels(self):
+        '''
+        Returns the labels for metrics about this query
+        '''
+        return data_labels(self.event_type, self.summary_type, self.summary_window)
         
-        #determine whether we are hitting normal or rollup index
-        #hit * because event types can belong to multiple test types
-        #probably a may efficient way to do this
-        is_rollup=False
-        index_name="pscheduler_*"
-        time_field = "pscheduler.start_time"
-        checksum_field = "pscheduler.test_checksum"
-        if summary_window > 0:
-            is_rollup=True
-            index_name = "rollup_{0}".format(index_name)
-            time_field = "{0}.date_histogram.timestamp".format(time_field)
-            checksum_field = "{0}.keyword.terms.value".format(checksum_field)
+class EsmondDataBatch:
+    '''
+    The msearch for a batch of lookups. results has the data or exception for
+    each lookup once the batch has been run.
+    '''
+    
+    def __init__(self, lookups):
+        self.lookups = lookups
+        self.results = [None] * len(lookups)
+        #(lookup index, metadata key, EsmondDataQuery) for each search in body
+        self.queries = []
+        self.body = []
+        #lookups that have to be fetched on their own
+        self.separate = []
 
+class EsmondData:
+
+    def __init__(self, es, test_types=None):
+        self.es = es
+        self.test_types = test_types
+    
+    def _get_paging(self, q, stream=False):
         #handle limit and offset
         result_size = DEFAULT_RESULT_LIMIT
+        if stream:
+            #no limit unless one is given
+            result_size = None
         result_offset = 0
         if q.get(LIMIT_FILTER, None):
             try:
@@ -316,8 +442,44 @@ class EsmondData:
                 result_offset = int(q[OFFSET_FILTER])
             except ValueError:
                 raise BadRequest("{0} parameter must be an integer".format(OFFSET_FILTER))
-        if result_size > MAX_RESULT_LIMIT:
+        if not stream and result_size > MAX_RESULT_LIMIT:
             raise BadRequest("{0} parameter cannot exceed {1}".format(LIMIT_FILTER, MAX_RESULT_LIMIT))
+        
+        return result_size, result_offset
+    
+    def prepare(self, metadata_key, event_type, summary_type, summary_window, q={}, result_size=DEFAULT_RESULT_LIMIT, result_offset=0):
+        '''
+        Builds the query for the requested data. Returns an EsmondDataQuery.
+        '''
+        log.debug("{0} {1}".format(summary_type, summary_window))
+        #convert summary window to int
+        try:
+            summary_window = int(summary_window)
+        except ValueError as e:
+            raise BadRequest("Summary window must be an int")
+        
+        #determine whether we are hitting normal or rollup index and only
+        # search the indices of test types that could have the data. Windows
+        # without a rollup are aggregated from the normal index.
+        metrics = None
+        if summary_window > 0 and str(summary_window) not in _get_rollup_names():
+            metrics = aggregation_metrics(event_type, summary_type, DATA_FIELD_MAP.get("{0}/{1}".format(event_type, summary_type), None))
+            if metrics is None:
+                raise BadRequest("{0} is not a supported summary_window".format(summary_window))
+            windows = check_window_count(result_size, result_offset)
+        is_rollup = (summary_window > 0 and metrics is None)
+        index_name = build_data_index(
+            metadata_key, 
+            event_type, 
+            is_rollup=is_rollup, 
+            test_types=self.test_types, 
+            time_filters=handle_time_filters(q)
+        )
+        time_field = "pscheduler.start_time"
+        checksum_field = "pscheduler.test_checksum"
+        if is_rollup:
+            time_field = "{0}.date_histogram.timestamp".format(time_field)
+            checksum_field = "{0}.keyword.terms.value".format(checksum_field)
 
         #data query
         dsl = {
@@ -346,9 +508,7 @@ class EsmondData:
         #Add rollup and non-rollup specific filters
         if is_rollup:
             #make sure we are getting the right window
-            sw_map = app.config.get('ELMOND', {}).get('SUMMARY_WINDOW_ROLLUP_NAMES', None)
-            if not sw_map:
-                sw_map = DEFAULT_SUMMARY_WINDOW_ROLLUP_NAME
+            sw_map = _get_rollup_names()
             sw=str(summary_window)
             if sw not in sw_map:
                 raise BadRequest("{0} is not a supported summary_window".format(sw))
@@ -359,15 +519,17 @@ class EsmondData:
             dsl["query"]["bool"]["filter"].append({ "term": { "result.succeeded": succeeded_filter_val } })
         
         #handle time filters
-        time_filter = build_time_filter(q, time_field=time_field)
+        with Timer(TIMING_FILTERS):
+            if metrics is not None:
+                time_filter = build_window_filter(q, summary_window, time_field=time_field)
+            else:
+                time_filter = build_time_filter(q, time_field=time_field)
         if time_filter:
             dsl["query"]["bool"]["filter"].append(time_filter)
         
         #limit fields returned
         dfm_key = "{0}/{1}".format(event_type, summary_type)
-        raw_type = True
         if dfm_key in DATA_FIELD_MAP:
-            raw_type = False
             if isinstance(DATA_FIELD_MAP[dfm_key], list):
                 dsl["_source"].extend(DATA_FIELD_MAP[dfm_key])
             else:
@@ -377,71 +539,457 @@ class EsmondData:
         else:
             raise BadRequest("Unrecognized event type {0}".format(event_type))
         
+        #optimization: numbers and the time as epoch seconds can be read from
+        # doc values without loading and parsing _source
+        docvalue_field = None
+        if (not is_rollup and summary_type == "base" and event_type in DOCVALUE_EVENT_TYPES
+                and app.config.get('ELMOND', {}).get('DOCVALUE_FIELDS', False)):
+            docvalue_field = DATA_FIELD_MAP[dfm_key]
+            dsl["_source"] = False
+            dsl["docvalue_fields"] = [
+                { "field": time_field, "format": "epoch_second" },
+                { "field": docvalue_field }
+            ]
+        
+        if metrics is not None:
+            #elastic calculates each window, parsed like rollups once converted
+            dsl = {
+                "size": 0,
+                "query": dsl["query"],
+                "aggs": build_aggregation(metrics, summary_window, windows, time_field=time_field)
+            }
+            return EsmondDataQuery(index_name, dsl, event_type, summary_type, is_rollup=True, time_field=time_field, summary_window=summary_window,
+                metrics=metrics, result_size=result_size, result_offset=result_offset)
+        
+        return EsmondDataQuery(index_name, dsl, event_type, summary_type, is_rollup=is_rollup, time_field=time_field, summary_window=summary_window, docvalue_field=docvalue_field)
+    
+    def parse_hit(self, hit, query):
+        '''
+        Converts a search hit to an esmond datum. Returns None if there is no
+        value for the hit.
+        '''
+        event_type = query.event_type
+        summary_type = query.summary_type
+        dfm_key = query.dfm_key
+        is_rollup = query.is_rollup
+        if query.docvalue_field:
+            #only has the time and a number
+            fields = hit.get("fields", {})
+            ts = docvalue_timestamp(docvalue(fields, query.time_field))
+            val = docvalue(fields, query.docvalue_field)
+            if not ts or val is None:
+                return None
+            return { "ts": ts, "val": val }
+        #get timestamp
+        result={}
+        if is_rollup:
+            #already a timestamp
+            ts = hit.get("_source", {}).get("pscheduler.start_time.date_histogram.timestamp", None)
+            if ts:
+                ts = int(ts/1000)
+            result = hit.get("_source", None)
+        else:
+            #date string we have to convert
+            ts = datestr_to_timestamp(hit.get("_source", {}).get("pscheduler", {}).get("start_time", None))
+            result = hit.get("_source", {}).get("result", None)
+        if not ts or not result:
+            return None
+        datum = { "ts": ts }
+        #get value - event type specific. 
+        # Note: right now it either spits out an empty string or just gives raw results for unsupported event types
+        if query.raw_type:
+            datum["val"] = result
+        elif event_type.startswith("histogram-") and summary_type == "statistics":
+            conversion_factor = CONVERSION_FACTOR_MAP.get(event_type, 1)
+            datum["val"] = _extract_result_stats(DATA_FIELD_MAP[dfm_key], result, is_rollup=is_rollup, conversion_factor=conversion_factor)
+        elif event_type.startswith("histogram-"):
+            conversion_factor = CONVERSION_FACTOR_MAP.get(event_type, 1)
+            hist = _extract_result_field(DATA_FIELD_MAP[dfm_key], result)
+            if not hist:
+                return None
+            datum["val"] = _build_esmond_histogram(hist, conversion_factor=conversion_factor)
+        elif event_type.startswith("streams") and event_type.endswith("subintervals"):
+            datum["val"] = _extract_result_subintervals(DATA_FIELD_MAP[dfm_key], result, event_type, streams=True)
+        elif event_type.startswith("streams"):
+            datum["val"] = _extract_result_streams(DATA_FIELD_MAP[dfm_key], result, event_type)
+        elif event_type.endswith("subintervals"):
+            datum["val"] = _extract_result_subintervals(DATA_FIELD_MAP[dfm_key], result, event_type)
+        elif event_type.startswith("packet-trace"):
+            datum["val"] = _extract_packet_trace(DATA_FIELD_MAP[dfm_key], result, event_type)
+        elif event_type == 'failures':
+            err_msg =  _extract_result_field(DATA_FIELD_MAP[dfm_key], result)
+            if err_msg is None:
+                return None
+            datum["val"] = { "error": err_msg }
+        elif event_type.startswith("packet-loss-rate") and summary_type == "aggregations":
+            datum["val"] = _extract_packet_loss_rate(result, DATA_FIELD_MAP[dfm_key])
+        elif summary_type == "averages":
+            datum["val"] = _calc_rollup_average(result, DATA_FIELD_MAP[dfm_key])
+        elif is_rollup:
+            #rollups just have dotted string keys
+            datum["val"] = result.get(DATA_FIELD_MAP[dfm_key], None)
+        else:
+            #extract from the map
+            datum["val"] = _extract_result_field(DATA_FIELD_MAP[dfm_key], result)
+        
+        #if we didn't find anything continue - esmond never has a null point (i think)
+        if datum["val"] is None:
+            return None
+        
+        return datum
+    
+    def _iter_pages(self, metadata_key, query, page_size, use_pit=False):
+        '''
+        Generator that pages through all the hits of query in time order with
+        search_after, yielding one list of hits per page. Uses a point-in-time
+        if use_pit is set (requires elastic 7.10 or later) so pages are 
+        consistent with each other. Results are sorted by a unique value after
+        the time so search_after doesn't skip any.
+        '''
+        #search_after can't be combined with from
+        query.dsl.pop("from", None)
+        query.dsl["size"] = page_size
+        pit_id = None
+        try:
+            if use_pit:
+                pit_id = self.es.open_point_in_time(index=query.index_name, keep_alive=STREAM_KEEP_ALIVE, ignore_unavailable=True).get("id")
+            #results with the same time would be skipped at a page boundary 
+            # without a unique value to break ties. _shard_doc needs a 
+            # point-in-time (and elastic 7.12 or later), otherwise use the 
+            # run href, which has doc values.
+            if pit_id:
+                tiebreaker = { "_shard_doc": "asc" }
+            else:
+                tiebreaker = { STREAM_TIEBREAKER_FIELD: { "order": "asc", "missing": "_last" } }
+            query.dsl["sort"] = query.dsl.get("sort", []) + [ tiebreaker ]
+            while True:
+                if pit_id:
+                    query.dsl["pit"] = { "id": pit_id, "keep_alive": STREAM_KEEP_ALIVE }
+                    res = timed_search(self.es, "page", query.labels(), body=query.dsl)
+                    pit_id = res.get("pit_id", pit_id)
+                else:
+                    res = self._search(query, kind="page")
+                hits = res.get("hits", {}).get("hits", [])
+                learn_test_type(metadata_key, hits, test_types=self.test_types)
+                yield hits
+                if len(hits) < page_size:
+                    break
+                query.dsl["search_after"] = hits[-1]["sort"]
+        finally:
+            if pit_id:
+                try:
+                    self.es.close_point_in_time(body={ "id": pit_id })
+                except Exception as e:
+                    log.warning("Unable to close point-in-time: {0}".format(e))
+    
+    def _merges_histograms(self, event_type, summary_type, summary_window):
+        '''
+        Returns True if the request is for histogram statistics over a summary
+        window that has no rollup. Those are calculated from the raw histograms.
+        '''
+        if np is None or not event_type.startswith("histogram-") or summary_type != "statistics":
+            return False
+        try:
+            summary_window = int(summary_window)
+        except ValueError:
+            return False
+        if summary_window <= 0 or str(summary_window) in _get_rollup_names():
+            return False
+        
+        return "{0}/base".format(event_type) in DATA_FIELD_MAP
+    
+    def _aggregates(self, summary_window):
+        '''
+        Returns True if the summary window has no rollup, so prepare builds
+        an aggregation over the raw results. Histogram statistics that are
+        merged from the raw histograms are checked for first.
+        '''
+        try:
+            summary_window = int(summary_window)
+        except ValueError:
+            return False
+        return summary_window > 0 and str(summary_window) not in _get_rollup_names()
+    
+    def _iter_merged_stats(self, metadata_key, event_type, summary_window, q={}, result_size=None, result_offset=0, max_results=None):
+        '''
+        Returns a generator of esmond statistics for each summary window, 
+        calculated by merging the histograms of all the results that started 
+        in the window. Windows are aligned to the epoch. Raises BadRequest 
+        once more than max_results results have been read, if set.
+        '''
+        ec = app.config.get('ELMOND', {})
+        page_size = ec.get("STREAM_PAGE_SIZE", MAX_RESULT_LIMIT)
+        use_pit = ec.get("USE_POINT_IN_TIME", False)
+        summary_window = int(summary_window)
+        query = self.prepare(metadata_key, event_type, "base", 0, q=q, result_size=page_size)
+        key_parts = DATA_FIELD_MAP[query.dfm_key].split('.')[1:]
+        conversion_factor = CONVERSION_FACTOR_MAP.get(event_type, 1)
+        
+        def build_datum(window_ts, histos):
+            stats = merge(histos).stats()
+            if not stats:
+                return None
+            #converted after the statistics are calculated, like stored ones
+            return { "ts": window_ts, "val": to_esmond_stats(stats, conversion_factor=conversion_factor) }
+        
+        def generate():
+            skip = result_offset
+            remaining = result_size
+            window_ts = None
+            histos = []
+            count = 0
+            for hits in self._iter_pages(metadata_key, query, page_size, use_pit=use_pit):
+                count += len(hits)
+                if max_results is not None and count > max_results:
+                    raise BadRequest("Requested time range has more than {0} results to merge. Use a shorter time range or {1}=true.".format(max_results, STREAM_FILTER))
+                sources = [hit.get("_source", {}) for hit in hits]
+                ts, valid = parse_timestamps([s.get("pscheduler", {}).get("start_time", None) for s in sources])
+                hit_windows = (ts - (ts % summary_window)).tolist()
+                for i, source in enumerate(sources):
+                    histo = source.get("result", None)
+                    for key_part in key_parts:
+                        if not isinstance(histo, dict):
+                            break
+                        histo = histo.get(key_part, None)
+                    histo = Histogram.from_elastic(histo)
+                    if not valid[i] or histo is None:
+                        continue
+                    if window_ts is not None and hit_windows[i] != window_ts:
+                        #results are in time order so the last window is done
+                        datum = build_datum(window_ts, histos)
+                        histos = []
+                        if datum is not None and skip > 0:
+                            skip -= 1
+                        elif datum is not None:
+                            yield datum
+                            if remaining is not None:
+                                remaining -= 1
+                                if remaining == 0:
+                                    return
+                    window_ts = hit_windows[i]
+                    histos.append(histo)
+            if histos and skip == 0:
+                datum = build_datum(window_ts, histos)
+                if datum is not None:
+                    yield datum
+        
+        return generate()
+    
+    def prepare_fetch(self, metadata_key, event_type, summary_type, summary_window, q={}):
+        '''
+        Builds the query that fetch runs. Returns None if the data can't be 
+        fetched with a single search (i.e. merged histogram statistics).
+        '''
+        result_size, result_offset = self._get_paging(q)
+        if self._merges_histograms(event_type, summary_type, summary_window):
+            return None
+        return self.prepare(metadata_key, event_type, summary_type, summary_window, q=q, result_size=result_size, result_offset=result_offset)
+    
+    def fetch(self, metadata_key, event_type, summary_type, summary_window, q={}):
+        query = self.prepare_fetch(metadata_key, event_type, summary_type, summary_window, q=q)
+        if query is None:
+            result_size, result_offset = self._get_paging(q)
+            max_results = app.config.get('ELMOND', {}).get("MAX_MERGED_RESULTS", DEFAULT_MAX_MERGED_RESULTS)
+            return list(self._iter_merged_stats(metadata_key, event_type, summary_window, q=q, result_size=result_size, result_offset=result_offset, max_results=max_results))
+        
         #exec query
-        res = self.es.search(index=index_name, body=dsl)
-        hits = res.get("hits", {}).get("hits", [])
+        res = self._search(query)
+        
+        return self.parse_response(metadata_key, query, res)
+    
+    def prepare_version(self, metadata_key, event_type, summary_type, summary_window, q={}):
+        '''
+        Builds a search for the newest time and number of documents matching a
+        data request. The data can only have changed if one of them has.
+        '''
+        if self._merges_histograms(event_type, summary_type, summary_window):
+            query = self.prepare(metadata_key, event_type, "base", 0, q=q)
+        else:
+            query = self.prepare(metadata_key, event_type, summary_type, summary_window, q=q)
+        dsl = {
+            "size": 0,
+            "track_total_hits": True,
+            "query": query.dsl["query"],
+            "aggs": {
+                "newest": {
+                    "max": {
+                        "field": query.time_field
+                    }
+                }
+            }
+        }
+        return EsmondDataQuery(query.index_name, dsl, event_type, summary_type, is_rollup=query.is_rollup, time_field=query.time_field, summary_window=query.summary_window)
+    
+    def parse_version(self, res):
+        '''
+        Returns a string for the newest time and count in a response to the
+        search from prepare_version
+        '''
+        total = res.get("hits", {}).get("total", {})
+        if isinstance(total, dict):
+            total = total.get("value", 0)
+        newest = res.get("aggregations", {}).get("newest", {}).get("value", None)
+        return "{0}:{1}".format(newest, total)
+    
+    def version(self, metadata_key, event_type, summary_type, summary_window, q={}):
+        query = self.prepare_version(metadata_key, event_type, summary_type, summary_window, q=q)
+        res = self._search(query, kind="version")
+        return self.parse_version(res)
+    
+    def prepare_batch(self, lookups):
+        '''
+        Builds the msearch for a list of (metadata_key, event_type, 
+        summary_type, summary_window, q) tuples. Returns an EsmondDataBatch.
+        '''
+        batch = EsmondDataBatch(lookups)
+        for i, (metadata_key, event_type, summary_type, summary_window, q) in enumerate(lookups):
+            try:
+                query = self.prepare_fetch(metadata_key, event_type, summary_type, summary_window, q=q)
+            except HTTPException as e:
+                batch.results[i] = e
+                continue
+            if query is None:
+                #merged statistics can take more than one search
+                batch.separate.append(i)
+                continue
+            batch.queries.append((i, metadata_key, query))
+            batch.body.append({ "index": query.index_name, "ignore_unavailable": True, "allow_no_indices": True })
+            batch.body.append(query.dsl)
+        
+        return batch
+    
+    def parse_batch(self, batch, res):
+        '''
+        Parses the msearch response for a batch into its results
+        '''
+        for (i, metadata_key, query), response in zip(batch.queries, res.get("responses", [])):
+            if "error" in response:
+                log.error("Error fetching {0} {1}: {2}".format(metadata_key, query.dfm_key, response["error"]))
+                batch.results[i] = InternalServerError("Error searching for data")
+                continue
+            batch.results[i] = self.parse_response(metadata_key, query, response)
+    
+    def observe_batch(self, batch, res, wall):
+        '''
+        Records metrics for each search in the msearch response for a batch
+        '''
+        for (i, metadata_key, query), response in zip(batch.queries, res.get("responses", [])):
+            observe_search(response, wall, "batch", **query.labels())
+        add_search_timing(res.get("responses", []), wall)
+    
+    def fetch_lookup(self, lookup):
+        '''
+        Fetches one lookup of a batch on its own. Returns the HTTPException 
+        instead of raising it.
+        '''
+        try:
+            return self.fetch(*lookup[:4], q=lookup[4])
+        except HTTPException as e:
+            return e
+    
+    def fetch_batch(self, lookups):
+        '''
+        Fetches the data for a list of (metadata_key, event_type, summary_type,
+        summary_window, q) tuples with a single msearch. Returns a list with
+        the data for each lookup in the same order, or the HTTPException for
+        lookups that could not be run.
+        '''
+        batch = self.prepare_batch(lookups)
+        for i in batch.separate:
+            batch.results[i] = self.fetch_lookup(lookups[i])
+        if batch.body:
+            #exec all the queries at once
+            start = time.time()
+            res = self.es.msearch(body=batch.body)
+            self.observe_batch(batch, res, time.time() - start)
+            self.parse_batch(batch, res)
         
-        #parse results
+        return batch.results
+    
+    def _search(self, query, kind="data"):
+        '''
+        Runs the search for query and records metrics for it
+        '''
+        return timed_search(self.es, kind, query.labels(), index=query.index_name, body=query.dsl, ignore_unavailable=True, allow_no_indices=True)
+    
+    def parse_response(self, metadata_key, query, res):
+        '''
+        Converts the response to the search for query to esmond data
+        '''
+        if query.metrics is not None:
+            hits = aggregation_hits(res, query.metrics, result_size=query.result_size, result_offset=query.result_offset)
+        else:
+            hits = res.get("hits", {}).get("hits", [])
+        return self.parse_hits(metadata_key, query, hits)
+    
+    def parse_hits(self, metadata_key, query, hits):
+        '''
+        Converts the hits of a query to esmond data. Returns a DataColumns 
+        object if they could be parsed all at once, otherwise a list.
+        '''
+        start = time.time()
+        data = self._parse_hits(metadata_key, query, hits)
+        elapsed = time.time() - start
+        PARSE_SECONDS.observe(elapsed, **query.labels())
+        add_timing(TIMING_PARSE, elapsed)
+        return data
+    
+    def _parse_hits(self, metadata_key, query, hits):
+        learn_test_type(metadata_key, hits, test_types=self.test_types)
+        
+        #parse results, all at once with numpy if we can
+        if app.config.get('ELMOND', {}).get('COLUMNAR', np is not None):
+            field = DATA_FIELD_MAP.get(query.dfm_key, None)
+            conversion_factor = CONVERSION_FACTOR_MAP.get(query.event_type, 1)
+            columns = extract_columns(hits, query, field, conversion_factor=conversion_factor)
+            if columns is not None:
+                return columns
         data = []
         for hit in hits:
-            #get timestamp
-            result={}
-            if is_rollup:
-                #already a timestamp
-                ts = hit.get("_source", {}).get("pscheduler.start_time.date_histogram.timestamp", None)
-                if ts:
-                    ts = int(ts/1000)
-                result = hit.get("_source", None)
-            else:
-                #date string we have to convert
-                ts = datestr_to_timestamp(hit.get("_source", {}).get("pscheduler", {}).get("start_time", None))
-                result = hit.get("_source", {}).get("result", None)
-            if not ts or not result:
+            datum = self.parse_hit(hit, query)
+            if datum is None:
                 continue
-            datum = { "ts": ts }
-            #get value - event type specific. 
-            # Note: right now it either spits out an empty string or just gives raw results for unsupported event types
-            if raw_type:
-                datum["val"] = result
-            elif event_type.startswith("histogram-") and summary_type == "statistics":
-                conversion_factor = CONVERSION_FACTOR_MAP.get(event_type, 1)
-                datum["val"] = _extract_result_stats(DATA_FIELD_MAP[dfm_key], result, is_rollup=is_rollup, conversion_factor=conversion_factor)
-            elif event_type.startswith("histogram-"):
-                conversion_factor = CONVERSION_FACTOR_MAP.get(event_type, 1)
-                hist = _extract_result_field(DATA_FIELD_MAP[dfm_key], result)
-                if not hist:
-                    continue
-                datum["val"] = _build_esmond_histogram(hist, conversion_factor=conversion_factor)
-            elif event_type.startswith("streams") and event_type.endswith("subintervals"):
-                datum["val"] = _extract_result_subintervals(DATA_FIELD_MAP[dfm_key], result, event_type, streams=True)
-            elif event_type.startswith("streams"):
-                datum["val"] = _extract_result_streams(DATA_FIELD_MAP[dfm_key], result, event_type)
-            elif event_type.endswith("subintervals"):
-                datum["val"] = _extract_result_subintervals(DATA_FIELD_MAP[dfm_key], result, event_type)
-            elif event_type.startswith("packet-trace"):
-                datum["val"] = _extract_packet_trace(DATA_FIELD_MAP[dfm_key], result, event_type)
-            elif event_type == 'failures':
-                err_msg =  _extract_result_field(DATA_FIELD_MAP[dfm_key], result)
-                if err_msg is None:
-                    continue
-                datum["val"] = { "error": err_msg }
-            elif event_type.startswith("packet-loss-rate") and summary_type == "aggregations":
-                datum["val"] = _extract_packet_loss_rate(result, DATA_FIELD_MAP[dfm_key])
-            elif summary_type == "averages":
-                datum["val"] = _calc_rollup_average(result, DATA_FIELD_MAP[dfm_key])
-            elif is_rollup:
-                #rollups just have dotted string keys
-                datum["val"] = result.get(DATA_FIELD_MAP[dfm_key], None)
-            else:
-                #extract from the map
-                datum["val"] = _extract_result_field(DATA_FIELD_MAP[dfm_key], result)
-            
-            #if we didn't find anything continue - esmond never has a null point (i think)
-            if datum["val"] is None:
-                continue
-            
             #add to list of data
             data.append(datum)    
 
         return data
-
+    
+    def stream(self, metadata_key, event_type, summary_type, summary_window, q={}):
+        '''
+        Returns a generator that pages through the data in time order with 
+        search_after so there is no limit on how much data can be returned. 
+        Uses a point-in-time if USE_POINT_IN_TIME is set (requires elastic 
+        7.10 or later) so pages are consistent with each other. The query is 
+        built before returning so bad requests are caught up front.
+        '''
+        result_size, result_offset = self._get_paging(q, stream=True)
+        if self._merges_histograms(event_type, summary_type, summary_window):
+            return self._iter_merged_stats(metadata_key, event_type, summary_window, q=q, result_size=result_size, result_offset=result_offset)
+        if self._aggregates(summary_window):
+            #the number of windows is limited so they come from one search
+            query = self.prepare(metadata_key, event_type, summary_type, summary_window, q=q, result_size=result_size, result_offset=result_offset)
+            return iter(self.parse_response(metadata_key, query, self._search(query)))
+        ec = app.config.get('ELMOND', {})
+        page_size = ec.get("STREAM_PAGE_SIZE", MAX_RESULT_LIMIT)
+        use_pit = ec.get("USE_POINT_IN_TIME", False)
+        #search_after can't be combined with from, so offset is handled as we go
+        query = self.prepare(metadata_key, event_type, summary_type, summary_window, q=q, result_size=page_size)
+        
+        def generate():
+            skip = result_offset
+            remaining = result_size
+            for hits in self._iter_pages(metadata_key, query, page_size, use_pit=use_pit):
+                for hit in hits:
+                    datum = self.parse_hit(hit, query)
+                    if datum is None:
+                        continue
+                    if skip > 0:
+                        skip -= 1
+                        continue
+                    yield datum
+                    if remaining is not None:
+                        remaining -= 1
+                        if remaining == 0:
+                            return
+        
+        return generate()
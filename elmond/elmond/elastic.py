@@ -0,0 +1,83 @@
+'''
+Builds the elasticsearch client from the ELASTIC_HOSTS and ELASTIC_PARAMS
+config. ELASTIC_PARAMS are given to the client as they are, so any client or
+connection option like timeout, maxsize or http_compress can be set, plus:
+
+    tcp_keepalive: seconds a pooled connection can be idle before TCP sends
+        keep-alive probes, so firewalls and load balancers don't silently
+        drop it. null turns it off.
+'''
+import logging
+import socket
+from elasticsearch import Elasticsearch
+from elasticsearch.connection import Urllib3HttpConnection
+
+log = logging.getLogger('elmond')
+
+#Threads per worker process when served by gunicorn, see gunicorn.conf.py
+DEFAULT_SERVER_THREADS=8
+#Connections kept open to each elastic node by each process. urllib3 closes
+# connections beyond this after use, so it's raised to the number of threads.
+DEFAULT_ELASTIC_MAXSIZE=10
+DEFAULT_ELASTIC_TCP_KEEPALIVE=60
+
+def keepalive_socket_options(idle):
+    '''
+    Returns urllib3 socket options that turn on TCP keep-alive after idle
+    seconds
+    '''
+    options = [
+        (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    ]
+    #the timers can only be set on some platforms
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, int(idle)))
+    if hasattr(socket, "TCP_KEEPINTVL"):
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(int(idle) // 4, 1)))
+    if hasattr(socket, "TCP_KEEPCNT"):
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 4))
+    return options
+
+class KeepAliveConnection(Urllib3HttpConnection):
+    '''
+    Connection that turns on TCP keep-alive for the sockets in its pool
+    '''
+
+    def __init__(self, tcp_keepalive=DEFAULT_ELASTIC_TCP_KEEPALIVE, **kwargs):
+        super().__init__(**kwargs)
+        if tcp_keepalive:
+            self.pool.conn_kw["socket_options"] = keepalive_socket_options(tcp_keepalive)
+
+def elastic_params(config):
+    '''
+    Returns the ELASTIC_PARAMS config with the pool sized for the threads of
+    a process
+    '''
+    params = dict(config.get("ELASTIC_PARAMS", {}))
+    threads = config.get("SERVER", {}).get("threads", DEFAULT_SERVER_THREADS)
+    params.setdefault("maxsize", max(DEFAULT_ELASTIC_MAXSIZE, threads))
+    return params
+
+def build_elastic(config):
+    '''
+    Returns an elasticsearch client for the ELASTIC_HOSTS and ELASTIC_PARAMS
+    config
+    '''
+    params = elastic_params(config)
+    tcp_keepalive = params.pop("tcp_keepalive", DEFAULT_ELASTIC_TCP_KEEPALIVE)
+    if tcp_keepalive and "connection_class" not in params:
+        params["connection_class"] = KeepAliveConnection
+        params["tcp_keepalive"] = tcp_keepalive
+    return Elasticsearch(config.get("ELASTIC_HOSTS", ['localhost']), **params)
+
+def reset_elastic(es):
+    '''
+    Gives es new connections to the same nodes. A process forked from one that
+    used es must not share its sockets.
+    '''
+    transport = es.transport
+    hosts = [opts for conn, opts in transport.connection_pool.connection_opts]
+    #without the old pool set_connections creates every connection again
+    del transport.connection_pool
+    transport.set_connections(hosts)
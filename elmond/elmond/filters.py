@@ -1,5 +1,7 @@
+import ipaddress
 import logging
 import re
+from resolver import get_resolver
 from socket import AF_INET, AF_INET6
 from summaries import DEFAULT_SUMMARIES
 from util import *
@@ -100,6 +102,10 @@ RESERVED_GET_PARAMS = [
     "format", 
     LIMIT_FILTER, 
     OFFSET_FILTER, 
+    CURSOR_FILTER,
+    STREAM_FILTER,
+    PRETTY_FILTER,
+    PROFILE_FILTER,
     DNS_MATCH_RULE_FILTER, 
     TIME_FILTER,
     TIME_START_FILTER, 
@@ -149,27 +155,23 @@ def _build_val_or(key, values):
     return filter
 
 def _build_ip_filter(key, host, dns_match_rule=DNS_MATCH_V4_V6):
-    #get IP address
+    #get IP address. Look up every family the rule might use at the same time
     addrs = []
-    addr4 = None
-    addr6 = None
     if dns_match_rule == DNS_MATCH_ONLY_V6:
-        addr6 = lookup_hostname(host, AF_INET6)
+        families = [AF_INET6]
     elif dns_match_rule == DNS_MATCH_ONLY_V4:
-        addr4 = lookup_hostname(host, AF_INET)
-    elif dns_match_rule == DNS_MATCH_PREFER_V6:
-        addr6 = lookup_hostname(host, AF_INET6)
-        if addr6 is None:
-            addr4 = lookup_hostname(host, AF_INET)
-    elif dns_match_rule == DNS_MATCH_PREFER_V4:
-        addr4 = lookup_hostname(host, AF_INET)
-        if addr4 is None:
-            addr6 = lookup_hostname(host, AF_INET6)
-    elif dns_match_rule == DNS_MATCH_V4_V6:
-        addr6 = lookup_hostname(host, AF_INET6)
-        addr4 = lookup_hostname(host, AF_INET)
+        families = [AF_INET]
+    elif dns_match_rule in [DNS_MATCH_PREFER_V6, DNS_MATCH_PREFER_V4, DNS_MATCH_V4_V6]:
+        families = [AF_INET6, AF_INET]
     else:
         raise BadRequest("Invalid dns-match-rule parameter {0}".format(dns_match_rule))
+    found = get_resolver().resolve(host, families)
+    addr4 = found.get(AF_INET, None)
+    addr6 = found.get(AF_INET6, None)
+    if dns_match_rule == DNS_MATCH_PREFER_V6 and addr6:
+        addr4 = None
+    elif dns_match_rule == DNS_MATCH_PREFER_V4 and addr4:
+        addr6 = None
         
     #add results to list
     if addr4: addrs.append(addr4)
@@ -316,16 +318,84 @@ def build_time_filter(params, time_field="pscheduler.start_time"):
     else:
         return None
 
-def build_filters(params):
+def _local_equals(md_val, value):
+    #query string values are always strings so compare string forms
+    if md_val is None:
+        return False
+    if isinstance(md_val, bool):
+        return str(md_val).lower() == value.lower()
+    return str(md_val) == value
+
+def _local_ip(value):
+    try:
+        return str(ipaddress.ip_address(value))
+    except ValueError:
+        return None
+
+def build_local_filter(params):
+    '''
+    Builds a function that takes an esmond metadata object and returns whether
+    it matches params. Returns None if one or more of the params cannot be 
+    evaluated without going to elastic (e.g. time filters or hostnames that 
+    need a DNS lookup). 
+    '''
+    checks = []
+    for param in (params or {}):
+        value = params[param]
+        if param in [LIMIT_FILTER, OFFSET_FILTER, CURSOR_FILTER, STREAM_FILTER, PRETTY_FILTER, "format", DNS_MATCH_RULE_FILTER]:
+            continue
+        elif param in MAPPED_FILTERS:
+            checks.append(lambda md, p=param, v=value: _local_equals(md.get(p, None), v))
+        elif param in IP_FILTERS:
+            #only literal addresses, hostnames require a lookup
+            ip = _local_ip(value)
+            if ip is None:
+                return None
+            checks.append(lambda md, p=param, v=ip: _local_ip(str(md.get(p, ""))) == v)
+        elif param == "tool-name":
+            tool = "pscheduler/{0}".format(re.sub(r'^pscheduler/', "", value))
+            checks.append(lambda md, v=tool: md.get("tool-name", None) == v)
+        elif param == "subject-type":
+            if value not in ["point-to-point", "network-element"]:
+                raise BadRequest("Invalid subject-type {0}.".format(value))
+            p2p = (value == "point-to-point")
+            checks.append(lambda md, v=p2p: (md.get("pscheduler-test-type", None) in P2P_TESTS) == v)
+        elif param == "event-type":
+            checks.append(lambda md, v=value: v in [et.get("event-type") for et in md.get("event-types", [])])
+        else:
+            return None
+    
+    return lambda md: all(check(md) for check in checks)
+
+def build_seen_time_filter(params, first_field="first_seen", last_field="last_seen"):
+    '''
+    Time filter for documents that summarize a test over a span of time, such as 
+    the metadata index. Matches tests that have run at some point between 
+    first_field and last_field which overlaps the requested time range.
+    '''
+    time_filters = handle_time_filters(params)
+    if not time_filters["has_filters"]:
+        return None
+    filter = { "bool": { "filter": [] } }
+    begin = datetime.datetime.utcfromtimestamp(time_filters['begin'])
+    filter["bool"]["filter"].append({ "range": { last_field: { "gte": begin } } })
+    if time_filters['end'] is not None:
+        end = datetime.datetime.utcfromtimestamp(time_filters['end'])
+        filter["bool"]["filter"].append({ "range": { first_field: { "lte": end } } })
+    
+    return filter
+
+def build_filters(params, include_time=True):
     #initialize
     filters = []
     if not params:
         return filters
     
     #handle time filters
-    time_filter = build_time_filter(params)
-    if time_filter:
-        filters.append(time_filter)
+    if include_time:
+        time_filter = build_time_filter(params)
+        if time_filter:
+            filters.append(time_filter)
     
     # Get dns-match-rule filter
     dns_match_rule = params.get("dns-match-rule", DNS_MATCH_V4_V6)
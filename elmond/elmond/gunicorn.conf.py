@@ -0,0 +1,61 @@
+'''
+Settings for serving elmond with gunicorn:
+
+    gunicorn --config gunicorn.conf.py wsgi:app
+
+Settings are read from the SERVER object in elmond.json and can be overridden
+on the command line or in GUNICORN_CMD_ARGS. Each worker process runs a
+number of threads and gets its own pool of elasticsearch connections, sized
+from ELASTIC_PARAMS.
+
+The app is loaded once by the master and the workers are forked from it, so
+they start quickly and share the loaded code. SIGHUP gracefully replaces the
+workers with new ones forked from the loaded app. Changes to the code or
+elmond.json need a restart, or SIGUSR2 to start a new master then SIGTERM to
+the old one.
+'''
+import json
+import multiprocessing
+import os
+import sys
+
+#the app directory has to be importable for the hooks
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from elastic import DEFAULT_SERVER_THREADS, reset_elastic
+
+#Defaults for the SERVER config
+DEFAULT_SERVER_BIND="0.0.0.0:5000"
+DEFAULT_SERVER_TIMEOUT=60
+DEFAULT_SERVER_GRACEFUL_TIMEOUT=60
+DEFAULT_SERVER_KEEPALIVE=5
+
+def _load_server_config():
+    config_filename = "{0}/elmond.json".format(os.environ.get('ELMOND_ROOT', '/etc/elmond'))
+    try:
+        with open(config_filename) as config_file:
+            return json.load(config_file).get("SERVER", {})
+    except (OSError, ValueError):
+        return {}
+
+_server = _load_server_config()
+
+bind = _server.get("bind", DEFAULT_SERVER_BIND)
+workers = _server.get("workers", multiprocessing.cpu_count())
+threads = _server.get("threads", DEFAULT_SERVER_THREADS)
+worker_class = "gthread"
+preload_app = _server.get("preload", True)
+timeout = _server.get("timeout", DEFAULT_SERVER_TIMEOUT)
+graceful_timeout = _server.get("graceful_timeout", DEFAULT_SERVER_GRACEFUL_TIMEOUT)
+keepalive = _server.get("keepalive", DEFAULT_SERVER_KEEPALIVE)
+#restart workers after this many requests, 0 never does
+max_requests = _server.get("max_requests", 0)
+max_requests_jitter = _server.get("max_requests_jitter", 0)
+#elmond logs through logging.conf
+accesslog = _server.get("accesslog", None)
+
+def post_fork(server, worker):
+    #the app may have connected to elastic in the master while loading
+    wsgi = sys.modules.get("wsgi", None)
+    if wsgi is not None:
+        reset_elastic(wsgi.app.extensions['elmond']['es'])
@@ -0,0 +1,210 @@
+import logging
+import math
+
+#numpy is optional. Without it histograms are converted one bucket at a time
+# and statistics can't be calculated for merged histograms.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+log = logging.getLogger('elmond')
+
+#Same defaults as the pscheduler_histogram.rb logstash filter
+DEFAULT_QUANTILES = [25, 50, 75, 95]
+#The statistics calculated by logstash and their esmond names
+ESMOND_STATS = [
+    ("maximum", "max"),
+    ("mean", "mean"),
+    ("median", "median"),
+    ("minimum", "min"),
+    ("mode", "mode"),
+    ("percentile-25", "p_25"),
+    ("percentile-75", "p_75"),
+    ("percentile-95", "p_95"),
+    ("standard-deviation", "stddev"),
+    ("variance", "variance")
+]
+
+def _percentile_key(percentile):
+    if percentile == 50:
+        return "median"
+    return "p_{0}".format(percentile)
+
+class Histogram:
+    '''
+    A histogram stored as a sorted array of bucket values and an array of
+    counts. Statistics are calculated the same way as the logstash pipeline
+    so they match what is stored with each result.
+    '''
+
+    def __init__(self, values, counts):
+        self.values = values
+        self.counts = counts
+
+    @classmethod
+    def from_elastic(cls, elastic_histo, conversion_factor=1):
+        '''
+        Builds a histogram from an elastic histogram field with values and
+        counts lists. Returns None if the lists are not valid.
+        '''
+        if not isinstance(elastic_histo, dict):
+            return None
+        try:
+            values = np.asarray(elastic_histo.get("values", []), dtype=np.float64)
+            counts = np.asarray(elastic_histo.get("counts", []), dtype=np.float64).astype(np.int64)
+        except (TypeError, ValueError):
+            return None
+        if values.ndim != 1 or values.shape != counts.shape:
+            return None
+        if conversion_factor != 1:
+            values = values * conversion_factor
+        order = np.argsort(values, kind="stable")
+        histo = cls(values[order], counts[order])
+        if len(values) > 1 and not np.all(np.diff(histo.values)):
+            #combine buckets with the same value
+            histo = merge([histo], force=True)
+        return histo
+
+    def __len__(self):
+        return len(self.values)
+
+    def sample_size(self):
+        return int(self.counts.sum())
+
+    def stats(self, quantiles=DEFAULT_QUANTILES):
+        '''
+        Returns the min, max, mean, mode, variance, stddev and quantiles of the
+        histogram with the same keys as the logstash pipeline. Quantiles use
+        the NIST method (http://www.itl.nist.gov/div898/handbook/prc/section2/prc252.htm).
+        Returns an empty dict if the histogram is empty.
+        '''
+        values = self.values
+        counts = self.counts
+        sample_size = int(counts.sum()) if len(counts) else 0
+        if sample_size == 0:
+            return {}
+        stats = {}
+
+        #pass one: mode, mean, min and max. Sums are accumulated in order like
+        # logstash so floating point results match exactly.
+        stats["mode"] = values[counts == counts.max()].tolist()
+        stats["mean"] = float(np.cumsum(values * counts)[-1]) / (1.0 * sample_size)
+        stats["min"] = float(values[0])
+        stats["max"] = float(values[-1])
+
+        #pass two: quantiles, variance and standard deviation
+        cum_counts = np.cumsum(counts)
+        pos = 0
+        for q in quantiles:
+            n = (q / 100.0) * (sample_size + 1)
+            k = math.floor(n)
+            d = n - k
+            #a quantile is never found before the bucket the last one was found in
+            i = max(pos, int(np.searchsorted(cum_counts, k, side="left")))
+            if i >= len(values):
+                break
+            curr_count = int(cum_counts[i])
+            if k == 0 or (curr_count >= sample_size and k >= sample_size) or (k + d) < curr_count:
+                value = float(values[i])
+            elif i + 1 < len(values):
+                #interpolate with the next bucket
+                value = float(values[i])
+                value += d * (float(values[i + 1]) - value)
+                i += 1
+            else:
+                break
+            stats[_percentile_key(q)] = value
+            pos = i
+        #squared with libm pow like logstash since it can differ from x*x (and 
+        # numpy) in the last digit
+        sum_squares = 0
+        for diff, count in zip((values - stats["mean"]).tolist(), counts.tolist()):
+            sum_squares += (diff ** 2) * count
+        stats["variance"] = sum_squares / sample_size
+        stats["stddev"] = math.sqrt(stats["variance"])
+
+        return stats
+
+def merge(histograms, force=False):
+    '''
+    Merges histograms by summing the counts of each bucket value across all of
+    them. Returns None if there are no histograms.
+    '''
+    histograms = [h for h in histograms if h is not None]
+    if not histograms:
+        return None
+    elif len(histograms) == 1 and not force:
+        return histograms[0]
+    values = np.concatenate([h.values for h in histograms])
+    counts = np.concatenate([h.counts for h in histograms])
+    merged_values, inverse = np.unique(values, return_inverse=True)
+    merged_counts = np.bincount(inverse.ravel(), weights=counts, minlength=len(merged_values))
+    return Histogram(merged_values, merged_counts.astype(np.int64))
+
+def to_esmond_stats(stats, conversion_factor=1):
+    '''
+    Renames the statistics of a histogram to the names used by esmond and 
+    multiplies each by conversion_factor the same way stored statistics are
+    converted
+    '''
+    esmond_stats = {}
+    for name, key in ESMOND_STATS:
+        val = stats.get(key, None)
+        if val is not None and key == "mode":
+            val = [float(m) * conversion_factor for m in val]
+        elif val is not None:
+            val = float(val) * conversion_factor
+        esmond_stats[name] = val
+    return esmond_stats
+
+def build_esmond_histograms(elastic_histos, conversion_factor=1):
+    '''
+    Converts a list of elastic histograms with values and counts lists to
+    esmond histograms that map the string of each value to its count. Does the
+    math for all the histograms at once. The result has None in place of any
+    histogram that isn't valid.
+    '''
+    results = [None] * len(elastic_histos)
+    idx = []
+    values = []
+    counts = []
+    for i, histo in enumerate(elastic_histos):
+        if not histo or not isinstance(histo, dict):
+            continue
+        v = histo.get("values", [])
+        c = histo.get("counts", [])
+        if len(v) != len(c):
+            continue
+        try:
+            c = np.asarray(c).astype(np.int64)
+        except (TypeError, ValueError):
+            continue
+        v = np.asarray(v)
+        if v.dtype.kind not in "iuf":
+            continue
+        idx.append(i)
+        values.append(v)
+        counts.append(c)
+    if not idx:
+        return results
+
+    #integer and float values are kept apart so keys look the same as before
+    if len(set(v.dtype.kind for v in values)) == 1:
+        all_values = [np.concatenate(values)]
+    else:
+        all_values = values
+    keys = []
+    for v in all_values:
+        if conversion_factor != 1:
+            v = v * conversion_factor
+        keys.extend([str(k) for k in v.tolist()])
+    lengths = [len(v) for v in values]
+    all_counts = np.concatenate(counts).tolist()
+    start = 0
+    for i, length in zip(idx, lengths):
+        end = start + length
+        results[i] = dict(zip(keys[start:end], all_counts[start:end]))
+        start = end
+
+    return results
@@ -0,0 +1,150 @@
+import hashlib
+import logging
+import threading
+import time
+from cache import LRUCache
+from flask import Response, request
+from response import DEFAULT_MAX_BUFFERED_BYTES, buffer_response
+from util import handle_time_filters
+from werkzeug.exceptions import BadRequest
+
+log = logging.getLogger('elmond')
+
+#Defaults for the RESPONSE_CACHE config
+DEFAULT_RESPONSE_CACHE_SIZE=10000
+DEFAULT_RESPONSE_CACHE_BYTES=256*1024*1024
+#How long to keep a response for a window that can still change. The ETag
+# catches new results but not results that are replaced in place.
+DEFAULT_RESPONSE_CACHE_TTL=3600
+#How long after its end before a window is treated as closed. Covers results
+# that are archived late and the rollup job delay.
+DEFAULT_CLOSED_DELAY=3600
+#Cache-Control max-age for closed and open windows. Closed windows are not
+# immutable since results can still be archived late or an index be missing
+# when the search ran.
+DEFAULT_CLOSED_MAX_AGE=86400
+DEFAULT_OPEN_MAX_AGE=0
+#Set on a response for a closed window with no results so it is cached like an
+# open one. Removed before the response is sent.
+EMPTY_RESULTS_HEADER="X-Elmond-Empty-Results"
+
+def build_request_key(writer):
+    '''
+    Returns a string that identifies the current request and the format it
+    will be written in. The host is part of it since metadata has links.
+    '''
+    parts = [ request.base_url, writer.mimetype, str(getattr(writer, "pretty", "")) ]
+    parts.extend(["{0}={1}".format(k, v) for k, v in sorted(request.args.items(multi=True))])
+    return "\n".join(parts)
+
+class ResponseCache:
+    '''
+    Caches rendered responses by ETag. The ETag of a request is a hash of the
+    request and a version of the data it reads, e.g. the newest matching time
+    and the number of matching results. Requests for windows that ended long
+    enough ago are closed and don't need a version, so they are answered
+    without going to elastic. Windows that are still open need a search for
+    their version on every request, so they are only cached if open_windows
+    is set. Entries are evicted least-recently-used once there are max_size
+    of them or their bodies add up to max_bytes. Bodies bigger than 
+    max_entry_bytes are streamed and not cached.
+    '''
+
+    def __init__(self,
+                    max_size=DEFAULT_RESPONSE_CACHE_SIZE,
+                    max_bytes=DEFAULT_RESPONSE_CACHE_BYTES,
+                    ttl=DEFAULT_RESPONSE_CACHE_TTL,
+                    closed_delay=DEFAULT_CLOSED_DELAY,
+                    closed_max_age=DEFAULT_CLOSED_MAX_AGE,
+                    open_max_age=DEFAULT_OPEN_MAX_AGE,
+                    open_windows=False,
+                    max_entry_bytes=DEFAULT_MAX_BUFFERED_BYTES,
+                    entries=None
+                ):
+        self.ttl = ttl
+        self.open_windows = open_windows
+        self.max_entry_bytes = max_entry_bytes
+        self.closed_delay = closed_delay
+        self.closed_max_age = closed_max_age
+        self.open_max_age = open_max_age
+        #entries are (body, mimetype, closed) tuples keyed by etag
+        self.entries = entries
+        if self.entries is None:
+            self.entries = LRUCache(max_size=max_size, max_bytes=max_bytes, sizeof=lambda entry: len(entry[0]))
+        self.not_modified = 0
+        self._lock = threading.Lock()
+
+    def is_closed(self, q, summary_window=0):
+        '''
+        Returns True if the time filters in q end far enough in the past that
+        the results can't change
+        '''
+        try:
+            time_filters = handle_time_filters(q)
+            summary_window = max(int(summary_window), 0)
+        except (BadRequest, ValueError):
+            #let the request itself report the error
+            return False
+        end = time_filters["end"]
+        if end is None or not time_filters["has_filters"]:
+            return False
+        #the last window has to be over before it is rolled up
+        return (end + summary_window + self.closed_delay) < time.time()
+
+    def build_etag(self, key, version=None):
+        etag = hashlib.sha1(key.encode('utf-8'))
+        if version is not None:
+            etag.update("\n{0}".format(version).encode('utf-8'))
+        return etag.hexdigest()
+
+    def _finish(self, response, etag, closed):
+        response.set_etag(etag)
+        if closed:
+            response.headers["Cache-Control"] = "public, max-age={0}".format(self.closed_max_age)
+        elif self.open_max_age:
+            response.headers["Cache-Control"] = "public, max-age={0}".format(self.open_max_age)
+        else:
+            response.headers["Cache-Control"] = "no-cache"
+        #the format can come from the Accept header
+        response.vary.add("Accept")
+        return response
+
+    def lookup(self, etag, closed=False):
+        '''
+        Returns a 304 response if the client already has etag, the cached
+        response if we have it or None if the response needs to be built
+        '''
+        entry = self.entries.get(etag, None)
+        if entry is not None and not entry[2]:
+            #e.g. a closed window that had no results
+            closed = False
+        if request.if_none_match.contains(etag):
+            with self._lock:
+                self.not_modified += 1
+            return self._finish(Response(status=304), etag, closed)
+        if entry is None:
+            return None
+        body, mimetype, entry_closed = entry
+        return self._finish(Response(body, mimetype=mimetype), etag, closed)
+
+    def store(self, etag, response, closed=False):
+        '''
+        Saves the body of a successful response under etag. Streaming
+        responses are read if they are no bigger than max_entry_bytes. Returns
+        the response with caching headers. Closed windows without results 
+        are kept like open ones in case the results show up later.
+        '''
+        if response.headers.pop(EMPTY_RESULTS_HEADER, None) is not None:
+            closed = False
+        if response.status_code == 200:
+            body, response = buffer_response(response, max_bytes=self.max_entry_bytes)
+            if body is not None:
+                ttl = None if closed else self.ttl
+                self.entries.set(etag, (body, response.mimetype, closed), ttl=ttl)
+        return self._finish(response, etag, closed)
+
+    def stats(self):
+        stats = self.entries.stats()
+        with self._lock:
+            stats["not_modified"] = self.not_modified
+        return stats
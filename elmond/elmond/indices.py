@@ -0,0 +1,123 @@
+import datetime
+import logging
+import re
+import time
+from filters import TRANSLATE_EVENT_TYPE
+from flask import current_app as app
+
+log = logging.getLogger('elmond')
+
+#Raw result indices are named pscheduler_<test type>-<date>. The hyphen keeps
+# the metadata index maintained by pselastic out of the pattern.
+RESULT_INDEX_PATTERN="pscheduler_*-*"
+ROLLUP_INDEX_PATTERN="rollup_pscheduler_*"
+RESULT_INDEX_PREFIX_FORMAT="pscheduler_{0}"
+ROLLUP_INDEX_FORMAT="rollup_pscheduler_{0}"
+INDEX_TYPE_RE = re.compile(r'^(?:rollup_)?pscheduler_(.+?)(?:-\d{4}\.\d{2}\.\d{2})?$')
+DEFAULT_TEST_TYPE_CACHE_SIZE=100000
+#Logstash names daily indices with the time the result was archived, which is 
+# after the start time of the test. This is how far past the end of the 
+# requested time range to look for indices to account for that delay.
+DEFAULT_INDEX_DATE_SLACK=86400
+#If a time range needs more daily indices than this, use one wildcard per month
+DEFAULT_MAX_DAILY_INDICES=31
+#If a time range needs more monthly wildcards than this, use one wildcard for all
+DEFAULT_MAX_MONTHLY_INDICES=12
+
+def index_test_type(index_name):
+    '''
+    Returns the test type from the name of a result or rollup index
+    '''
+    if not index_name:
+        return None
+    m = INDEX_TYPE_RE.match(index_name)
+    if not m:
+        return None
+    return m.group(1)
+
+def get_test_types(metadata_key, event_type, test_types=None):
+    '''
+    Returns the list of test types that could contain the data for the given
+    metadata key and event type or None if it could be any of them. Uses the
+    checksum to test type map if we know the test, otherwise what we know
+    about the test types that produce the event type.
+    '''
+    if test_types is not None:
+        test_type = test_types.get(metadata_key)
+        if test_type:
+            return [ test_type ]
+
+    return TRANSLATE_EVENT_TYPE.get(event_type, None)
+
+def build_result_index(prefixes=None, time_filters=None):
+    '''
+    Builds the index string for the daily result indices with the given 
+    prefixes (e.g. pscheduler_latencybg or pscheduler_*) that cover the time 
+    range returned by handle_time_filters. Uses monthly wildcards if there are 
+    a lot of days and falls back to a wildcard for all dates if the range is 
+    open-ended or very long. 
+    '''
+    if not prefixes:
+        prefixes = [ RESULT_INDEX_PREFIX_FORMAT.format("*") ]
+    all_dates = ",".join(["{0}-*".format(p) for p in prefixes])
+    if not time_filters or not time_filters["has_filters"] or not time_filters["begin"]:
+        return all_dates
+    
+    ec = app.config.get('ELMOND', {})
+    slack = ec.get("INDEX_DATE_SLACK", DEFAULT_INDEX_DATE_SLACK)
+    max_daily = ec.get("MAX_DAILY_INDICES", DEFAULT_MAX_DAILY_INDICES)
+    max_monthly = ec.get("MAX_MONTHLY_INDICES", DEFAULT_MAX_MONTHLY_INDICES)
+    end = time_filters["end"]
+    if end is None:
+        end = time.time()
+    
+    #list the days, stopping early if it is more than we'll use
+    day = datetime.datetime.utcfromtimestamp(time_filters["begin"]).date()
+    last_day = datetime.datetime.utcfromtimestamp(end + slack).date()
+    #don't look for indices that can't exist yet, but always have at least one
+    last_day = max(min(last_day, datetime.datetime.utcnow().date()), day)
+    days = []
+    months = []
+    while day <= last_day and len(months) <= max_monthly:
+        days.append(day)
+        month = day.strftime("%Y.%m")
+        if not months or months[-1] != month:
+            months.append(month)
+        day += datetime.timedelta(days=1)
+    
+    if len(days) <= max_daily:
+        return ",".join(["{0}-{1}".format(p, d.strftime("%Y.%m.%d")) for p in prefixes for d in days])
+    elif len(months) <= max_monthly:
+        return ",".join(["{0}-{1}.*".format(p, m) for p in prefixes for m in months])
+    
+    return all_dates
+
+def build_data_index(metadata_key, event_type, is_rollup=False, test_types=None, time_filters=None):
+    '''
+    Builds the index string to search for data, limiting to only the indices
+    of the test types that could have the requested data and the days in the 
+    requested time range. Falls back to all result indices if we can't narrow 
+    it down.
+    '''
+    types = get_test_types(metadata_key, event_type, test_types=test_types)
+    if is_rollup:
+        #rollup indices are not time-based
+        if not types:
+            return ROLLUP_INDEX_PATTERN
+        return ",".join([ROLLUP_INDEX_FORMAT.format(t) for t in types])
+    
+    prefixes = None
+    if types:
+        prefixes = [RESULT_INDEX_PREFIX_FORMAT.format(t) for t in types]
+    
+    return build_result_index(prefixes, time_filters=time_filters)
+
+def learn_test_type(metadata_key, hits, test_types=None):
+    '''
+    Records the test type of metadata_key using the index of the search hits
+    '''
+    if test_types is None or not hits or metadata_key in test_types:
+        return
+    test_type = index_test_type(hits[0].get("_index", None))
+    if test_type:
+        test_types.set(metadata_key, test_type)
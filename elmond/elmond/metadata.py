@@ -1,47 +1,70 @@
 import logging
 import re
-from filters import build_filters
+import threading
+import time
+from cache import LRUCache
+from filters import build_filters, build_local_filter, build_seen_time_filter
 from flask import current_app as app
+from indices import build_result_index
+from metrics import timed_search
 from summaries import DEFAULT_SUMMARIES
+from timing import TIMING_FILTERS, Timer
 from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse
 from util import *
 
 DEFAULT_RESULT_LIMIT=1000
 MAX_RESULT_LIMIT=10000
-#The following value is a bit of a hack. The terms aggregation returns the top 
-# 10 by default. When we use the terms aggregation on test_checksum we want it
-# over ALL tests and then we use a sorted_bucket aggregation to paginate. The
-# number below is an arbitrarily high number for the terms aggregation to make
-# sure we are paginating over all tests. If the number below is exceeded then
-# pagination won't work right. You can still get at the test, you'll just need
-# to filter down more. There is probably a more efficient way to do this using
-# a composite aggregation or similar.
-TERM_AGG_SIZE=999999 
+#Tests are paged with a composite aggregation over test_checksum, so each
+# request only builds the buckets for the page being returned instead of a
+# terms aggregation over every test followed by a bucket_sort. Composite
+# aggregations are always ordered by key, so pages are ordered by checksum.
+# The after_key of a page is handed back to clients as an opaque cursor
+# token. Plain limit/offset requests without a cursor still work: we walk
+# to the offset with lightweight composite pages (no top_hits) that only
+# return keys, SKIP_PAGE_SIZE buckets at a time.
+CHECKSUM_FIELD="pscheduler.test_checksum.keyword"
+SKIP_PAGE_SIZE=10000
+#METADATA_SOURCE options. aggregation builds metadata from the raw results,
+# index does a plain search of the one document per test index
+METADATA_SOURCE_AGGREGATION="aggregation"
+METADATA_SOURCE_INDEX="index"
+DEFAULT_METADATA_INDEX="pscheduler_metadata"
+#Default index.max_result_window of elastic. Offsets of the metadata index 
+# that would page past it are walked to with search_after instead of from.
+INDEX_MAX_RESULT_WINDOW=10000
+#Number of tests per request when loading every test into the metadata cache
+LOAD_PAGE_SIZE=1000
+DEFAULT_METADATA_CACHE_SIZE=100000
+DEFAULT_METADATA_CACHE_TTL=86400
+DEFAULT_METADATA_CACHE_REFRESH=60
+DEFAULT_METADATA_CACHE_OVERLAP=300
 
 log = logging.getLogger('elmond')
 
 class EsmondMetadata:
 
-    def __init__(self, es):
+    def __init__(self, es, cache=None, test_types=None):
         self.es = es
+        self.cache = cache
+        self.test_types = test_types
     
-    def _get_next_link(self, request_url, result_size, result_offset, metadata_count):
-        if (result_size + result_offset) >= metadata_count:
+    def _get_next_link(self, request_url, result_size, result_offset, after_key):
+        #composite aggregation tells us when there is nothing left
+        if after_key is None:
             return None
         new_offset = result_size + result_offset
-        new_limit = result_size
-        if (new_offset + new_limit) > metadata_count and new_offset < metadata_count:
-            #if someone specifies an offset too big just ignore it
-            new_limit =   metadata_count - new_offset
-             
         url_parts = list(urlparse(request_url))
         query = dict(parse_qsl(url_parts[4]))
-        query.update({ "limit": new_limit, "offset": new_offset})
+        query.update({
+            LIMIT_FILTER: result_size,
+            OFFSET_FILTER: new_offset,
+            CURSOR_FILTER: encode_cursor({ "after": after_key, "offset": new_offset })
+        })
         url_parts[4] = urlencode(query)
         
         return urlunparse(url_parts)
     
-    def _get_prev_link(self, request_url, result_size, result_offset, metadata_count):
+    def _get_prev_link(self, request_url, result_size, result_offset):
         if result_offset == 0:
             return None
         new_offset = result_offset - result_size
@@ -52,7 +75,9 @@ class EsmondMetadata:
              
         url_parts = list(urlparse(request_url))
         query = dict(parse_qsl(url_parts[4]))
-        query.update({ "limit": new_limit, "offset": new_offset})
+        #can't page backwards with a composite aggregation so fallback to offset
+        query.pop(CURSOR_FILTER, None)
+        query.update({ LIMIT_FILTER: new_limit, OFFSET_FILTER: new_offset})
         url_parts[4] = urlencode(query)
         
         return urlunparse(url_parts)
@@ -79,11 +104,14 @@ class EsmondMetadata:
         url_parts[2] = url_parts[2].replace("//", "/")
         
         return urlunparse(url_parts)
-        
-    def search(self, q=None, request_url=None, paginate=False):
-        #get pagination options
+    
+    def _get_paging(self, q):
+        '''
+        Returns the size, offset and composite after_key for the requested page
+        '''
         result_size = DEFAULT_RESULT_LIMIT
         result_offset = 0
+        after_key = None
         if q.get(LIMIT_FILTER, None):
             try:
                 result_size = int(q[LIMIT_FILTER])
@@ -94,23 +122,411 @@ class EsmondMetadata:
                 result_offset = int(q[OFFSET_FILTER])
             except ValueError:
                 raise BadRequest("{0} parameter must be an integer".format(OFFSET_FILTER))
+        if q.get(CURSOR_FILTER, None):
+            cursor = decode_cursor(q[CURSOR_FILTER])
+            after_key = cursor.get("after", None)
+            try:
+                result_offset = int(cursor.get("offset", result_offset))
+            except ValueError:
+                raise BadRequest("Invalid {0} parameter".format(CURSOR_FILTER))
         if result_size > MAX_RESULT_LIMIT:
             raise BadRequest("{0} parameter cannot exceed {1}".format(LIMIT_FILTER, MAX_RESULT_LIMIT))
+        if result_size < 1 or result_offset < 0:
+            raise BadRequest("{0} and {1} parameters must be positive".format(LIMIT_FILTER, OFFSET_FILTER))
+        
+        return result_size, result_offset, after_key
+    
+    def _build_composite(self, size, after_key=None):
+        composite = {
+            "size": size,
+            "sources": [
+                { "checksum": { "terms": { "field": CHECKSUM_FIELD } } }
+            ]
+        }
+        if after_key:
+            composite["after"] = after_key
+        return composite
+    
+    def _skip_to_offset(self, query, result_offset, index=None):
+        '''
+        Walks the composite aggregation until reaching result_offset and returns
+        the after_key to start from. Only keys are returned so this is much
+        cheaper than building the skipped pages.
+        '''
+        after_key = None
+        skipped = 0
+        while skipped < result_offset:
+            size = min(SKIP_PAGE_SIZE, result_offset - skipped)
+            dsl = {
+                "size": 0,
+                "aggs": {
+                    "tests": { "composite": self._build_composite(size, after_key=after_key) }
+                }
+            }
+            if query:
+                dsl["query"] = query
+            res = timed_search(self.es, "metadata",
+                index=index or build_result_index(),
+                body=dsl,
+                filter_path="aggregations.tests.after_key",
+                ignore_unavailable=True,
+                allow_no_indices=True
+            )
+            after_key = res.get("aggregations", {}).get("tests", {}).get("after_key", None)
+            if after_key is None:
+                #offset is past the last test
+                return None
+            skipped += size
+        
+        return after_key
+    
+    def _build_md_obj(self, md_key, hit):
+        '''
+        Builds the esmond metadata object from the source of a result document.
+        Returns None if the document can't be represented as esmond metadata.
+        '''
+        #metadata key
+        md_obj={
+            'metadata-key': md_key,
+            'uri': build_uri(md_key)
+        }
+        
+        #extract meta, test and schedule 
+        meta=hit.get("meta",{})
+        test=hit.get("test",{})
+        pscheduler=hit.get("pscheduler",{})
+        reference=hit.get("reference",{})
+        
+        #parse measurement-agent
+        observer_ip = meta.get("observer", {}).get("ip", None)
+        if observer_ip:
+            md_obj['measurement-agent'] = observer_ip
+        else:
+            return None
+        
+        #parse source and dest
+        source_ip = meta.get("source", {}).get("ip", None)
+        dest_ip = meta.get("destination", {}).get("ip", None)
+        if source_ip and dest_ip:
+            md_obj['subject-type'] = "point-to-point"
+            md_obj['source'] = source_ip
+            md_obj['destination'] = dest_ip
+        elif source_ip:
+            md_obj['subject-type'] = "network-element"
+            md_obj['source'] = source_ip
+        elif observer_ip:
+            md_obj['subject-type'] = "network-element"
+            md_obj['source'] = observer_ip
+        else:
+            return None
+            
+        #parse pschedule object
+        tool=pscheduler.get("tool", None)
+        if tool:
+            md_obj['tool-name'] = "pscheduler/{0}".format(tool)
+        else:
+            return None
+        #this matches the old esmond archive behavior, though not sure it is
+        #the desired value since includes scheduling fluff time
+        md_obj['time-duration'] = pscheduler.get("duration", None)
+        
+        #parse test parameters
+        test_type = test.get("type", None)
+        md_obj['pscheduler-test-type'] = test_type
+        if test_type and self.test_types is not None and self.test_types.peek(md_key) != test_type:
+            #remember so data requests only have to search the right indices.
+            # only written when new since a shared cache has to lock to write.
+            self.test_types.set(md_key, test_type)
+        spec = test.get("spec", None)
+        if not spec:
+            return None
+        md_obj['input-source'] = spec.get("source", None)
+        if not md_obj['input-source']:
+            #this matches old behavior, though not sure it is desired
+            md_obj['input-source'] = md_obj['measurement-agent']
+        if spec.get("dest", None):
+            md_obj['input-destination'] = spec["dest"]
+        
+        #add type specific parameters
+        field_parser = None
+        if test_type == 'throughput':
+            field_parser = EsmondThroughputMetadataFieldParser()
+        elif test_type == 'latency' or test_type == 'latencybg':
+            field_parser = EsmondLatencyMetadataFieldParser()
+        elif test_type == 'disk-to-disk':
+            field_parser = EsmondDiskToDiskMetadataFieldParser()
+        elif test_type == 'trace':
+            field_parser = EsmondTraceMetadataFieldParser()
+        elif test_type == 'rtt':
+            field_parser = EsmondRttMetadataFieldParser()
+        else:
+            field_parser = EsmondRawMetadataFieldParser(test_type)
+        
+        time_added = None
+        if pscheduler.get("added", None):
+            time_added = datestr_to_timestamp(pscheduler['added'])
+        
+        field_parser.parse(spec, md_obj, reference=reference, md_key=md_key, time_added=time_added)
+        
+        return md_obj
+        
+    def _get_source(self):
+        ec = app.config.get('ELMOND', {})
+        source = ec.get("METADATA_SOURCE", METADATA_SOURCE_AGGREGATION)
+        if source not in [METADATA_SOURCE_AGGREGATION, METADATA_SOURCE_INDEX]:
+            raise BadRequest("Invalid METADATA_SOURCE {0}".format(source))
+        return source, ec.get("METADATA_INDEX", DEFAULT_METADATA_INDEX)
+    
+    def _build_index_search(self, size, query=None, after_key=None):
+        dsl = {
+            "size": size,
+            "_source": ["test.*", "meta.*", "pscheduler.*", "reference.*"],
+            "sort": [ { CHECKSUM_FIELD: { "order": "asc" } } ]
+        }
+        if after_key:
+            dsl["search_after"] = [ after_key.get("checksum", "") ]
+        if query:
+            dsl["query"] = query
+        return dsl
+    
+    def _iter_index_tests(self, query=None, page_size=LOAD_PAGE_SIZE):
+        _, metadata_index = self._get_source()
+        after_key = None
+        while True:
+            dsl = self._build_index_search(page_size, query=query, after_key=after_key)
+            res = timed_search(self.es, "metadata", index=metadata_index, body=dsl)
+            hits = res.get("hits", {}).get("hits", [])
+            for hit in hits:
+                md_key = hit.get("_id")
+                md_obj = self._build_md_obj(md_key, hit.get("_source", {}))
+                if md_obj:
+                    yield md_key, md_obj
+            if len(hits) < page_size:
+                break
+            after_key = { "checksum": hits[-1].get("_id") }
+    
+    def _skip_index_to_offset(self, query, result_offset, index):
+        '''
+        Walks the metadata index in checksum order until reaching result_offset
+        and returns the after_key to start from. Only ids are returned so this 
+        is much cheaper than building the skipped pages.
+        '''
+        after_key = None
+        skipped = 0
+        while skipped < result_offset:
+            size = min(SKIP_PAGE_SIZE, result_offset - skipped)
+            dsl = self._build_index_search(size, query=query, after_key=after_key)
+            dsl["_source"] = False
+            res = timed_search(self.es, "metadata", index=index, body=dsl, filter_path="hits.hits._id")
+            hits = res.get("hits", {}).get("hits", [])
+            if len(hits) < size:
+                #offset is past the last test
+                return None
+            after_key = { "checksum": hits[-1].get("_id") }
+            skipped += size
+        
+        return after_key
+    
+    def _search_index(self, q, request_url=None, paginate=False):
+        '''
+        Search the metadata index which has one document per test
+        '''
+        _, metadata_index = self._get_source()
+        result_size, result_offset, after_key = self._get_paging(q)
+        
+        #build search filters
+        with Timer(TIMING_FILTERS):
+            filters = build_filters(q, include_time=False)
+            time_filter = build_seen_time_filter(q)
+        if time_filter:
+            filters.append(time_filter)
+        query = None
+        if len(filters) > 0:
+            query = { "bool": { "filter": filters } }
+        
+        #from can't page past the max_result_window of the index
+        if after_key is None and result_offset + result_size > INDEX_MAX_RESULT_WINDOW:
+            after_key = self._skip_index_to_offset(query, result_offset, metadata_index)
+            if after_key is None:
+                return []
+        dsl = self._build_index_search(result_size, query=query, after_key=after_key)
+        dsl["track_total_hits"] = True
+        if after_key is None and result_offset > 0:
+            dsl["from"] = result_offset
+        res = timed_search(self.es, "metadata", index=metadata_index, body=dsl)
+        
+        metadata=[]
+        found=[]
+        hits = res.get("hits", {}).get("hits", [])
+        for hit in hits:
+            md_key = hit.get("_id")
+            md_obj = self._build_md_obj(md_key, hit.get("_source",{}))
+            if not md_obj:
+                continue
+            found.append((md_key, md_obj))
+            if request_url:
+                md_obj = dict(md_obj)
+                md_obj['url'] = self._get_md_url(request_url, md_key)
+            metadata.append(md_obj)
+        
+        if self.cache and not time_filter:
+            self.cache.put_many(found)
+        metadata_count = res.get("hits", {}).get("total", {}).get("value", 0)
+        next_after_key = None
+        if len(hits) >= result_size:
+            next_after_key = { "checksum": hits[-1].get("_id") }
+        
+        if paginate and metadata_count != 0 and len(metadata) > 0:
+            metadata[0]["metadata-count-total"] = metadata_count
+            metadata[0]["metadata-previous-page"] = self._get_prev_link(request_url, result_size, result_offset)
+            metadata[0]["metadata-next-page"] = self._get_next_link(request_url, result_size, result_offset, next_after_key)
+        
+        return metadata
+    
+    def iter_tests(self, query=None, page_size=LOAD_PAGE_SIZE, time_filters=None):
+        '''
+        Generator that walks every test matching query and yields a tuple with 
+        the metadata key and the esmond metadata object for each test. If 
+        time_filters are given only the indices in that range are searched.
+        '''
+        source, _ = self._get_source()
+        if source == METADATA_SOURCE_INDEX:
+            yield from self._iter_index_tests(query=query, page_size=page_size)
+            return
+        
+        after_key = None
+        while True:
+            dsl = {
+                "size": 0,
+                "aggs" : {
+                    "tests" : {
+                        "composite" : self._build_composite(page_size, after_key=after_key),
+                        "aggs": {
+                          "test_params": {
+                            "top_hits": {
+                              "size": 1,
+                              "sort": [ { "pscheduler.start_time": { "order": "desc" } } ],
+                              "_source": ["test.*", "meta.*", "pscheduler.*", "reference.*"]
+                            }
+                          }
+                        }
+                    }
+                }
+            }
+            if query:
+                dsl["query"] = query
+            res = timed_search(self.es, "metadata",
+                index=build_result_index(time_filters=time_filters),
+                body=dsl,
+                ignore_unavailable=True,
+                allow_no_indices=True
+            )
+            tests_agg = res.get("aggregations",{}).get("tests",{})
+            buckets = tests_agg.get("buckets",[])
+            for bucket in buckets:
+                hits = bucket.get("test_params",{}).get("hits",{}).get("hits", [])
+                if len(hits) == 0:
+                    continue
+                md_key = bucket.get("key", {}).get("checksum")
+                md_obj = self._build_md_obj(md_key, hits[0].get("_source",{}))
+                if md_obj:
+                    yield md_key, md_obj
+            after_key = tests_agg.get("after_key", None)
+            if len(buckets) < page_size or after_key is None:
+                break
+    
+    def _search_cache(self, q, request_url=None, paginate=False):
+        '''
+        Answers the search from the metadata cache. Returns None if the cache
+        can't answer the query.
+        '''
+        #single lookup by key
+        if list(q.keys()) == ['metadata-key']:
+            md_obj = self.cache.get(q['metadata-key'])
+            if md_obj is None:
+                return None
+            md_obj = dict(md_obj)
+            if request_url:
+                md_obj['url'] = self._get_md_url(request_url, md_obj['metadata-key'])
+            return [md_obj]
+        
+        #list of tests
+        md_list = self.cache.list(q)
+        if md_list is None:
+            return None
+        result_size, result_offset, after_key = self._get_paging(q)
+        start = result_offset
+        if after_key:
+            #cache is sorted by key the same as the composite aggregation
+            after = after_key.get("checksum", "")
+            start = 0
+            while start < len(md_list) and md_list[start]['metadata-key'] <= after:
+                start += 1
+        page = md_list[start:start + result_size]
+        
+        metadata = []
+        for md_obj in page:
+            md_obj = dict(md_obj)
+            if request_url:
+                md_obj['url'] = self._get_md_url(request_url, md_obj['metadata-key'])
+            metadata.append(md_obj)
+        
+        if paginate and len(metadata) > 0:
+            next_after_key = None
+            if start + result_size < len(md_list):
+                next_after_key = { "checksum": metadata[-1]['metadata-key'] }
+            metadata[0]["metadata-count-total"] = len(md_list)
+            metadata[0]["metadata-previous-page"] = self._get_prev_link(request_url, result_size, result_offset)
+            metadata[0]["metadata-next-page"] = self._get_next_link(request_url, result_size, result_offset, next_after_key)
+        
+        return metadata
+    
+    def search(self, q=None, request_url=None, paginate=False):
+        #try the cache first
+        if self.cache:
+            metadata = self._search_cache(q, request_url=request_url, paginate=paginate)
+            if metadata is not None:
+                return metadata
+        
+        #use the metadata index if configured
+        source, _ = self._get_source()
+        if source == METADATA_SOURCE_INDEX:
+            return self._search_index(q, request_url=request_url, paginate=paginate)
+        
+        #get pagination options
+        result_size, result_offset, after_key = self._get_paging(q)
+
+        #build search filters
+        with Timer(TIMING_FILTERS):
+            filters = build_filters(q)
+        query = None
+        if len(filters) > 0:
+            query = {
+                "bool": {
+                    "filter": filters
+                }
+            }
+        
+        #only search the daily indices in the requested time range
+        index = build_result_index(time_filters=handle_time_filters(q))
+        
+        #jump to offset if we were not given a cursor
+        if after_key is None and result_offset > 0:
+            after_key = self._skip_to_offset(query, result_offset, index=index)
+            if after_key is None:
+                return []
 
-        #base search
+        #page of tests
         dsl = {
             "size": 0,
             "aggs" : {
                 "tests_total_count" : {
                   "cardinality": {
-                    "field": "pscheduler.test_checksum.keyword"
+                    "field": CHECKSUM_FIELD
                   }
                 },
                 "tests" : {
-                    "terms" : { 
-                      "field" : "pscheduler.test_checksum.keyword",
-                      "size": TERM_AGG_SIZE
-                    },
+                    "composite" : self._build_composite(result_size, after_key=after_key),
                     "aggs": {
                       "test_params": {
                         "top_hits": {
@@ -118,138 +534,279 @@ class EsmondMetadata:
                           "sort": [ { "pscheduler.start_time": { "order": "desc" } } ],
                           "_source": ["test.*", "meta.*", "pscheduler.*", "reference.*"]
                         }
-                      },
-                      "latest_test": {
-                        "max": {
-                          "field":"pscheduler.start_time"
-                        }
-                      },
-                      "sorted_test": {
-                        "bucket_sort": {
-                          "sort": [
-                            {"latest_test": {"order": "desc"}}
-                          ],
-                          "size": result_size,
-                          "from": result_offset
-                        }
                       }
                     }
                 }
             }
         }
-        
-        #build seatch filters
-        filters = build_filters(q)
-        if len(filters) > 0:
-            dsl["query"] = {
-                "bool": {
-                    "filter": filters
-                }
-            }
+        if query:
+            dsl["query"] = query
 
         #Get list of tests
-        res = self.es.search(index="pscheduler_*", body=dsl)
+        res = timed_search(self.es, "metadata", index=index, body=dsl, ignore_unavailable=True, allow_no_indices=True)
         
         #format JSON
         metadata=[]
-        buckets = res.get("aggregations",{}).get("tests",{}).get("buckets",[])
+        found=[]
+        tests_agg = res.get("aggregations",{}).get("tests",{})
+        buckets = tests_agg.get("buckets",[])
         for bucket in buckets:
-            #metadata key
-            md_obj={
-                'metadata-key': bucket.get("key"),
-                'uri': build_uri(bucket.get("key"))
-            }
-            
-            #extract meta, test and schedule 
             hits = bucket.get("test_params",{}).get("hits",{}).get("hits", [])
             if len(hits) == 0:
                 continue
-            hit=hits[0].get("_source",{})
-            meta=hit.get("meta",{})
-            test=hit.get("test",{})
-            pscheduler=hit.get("pscheduler",{})
-            reference=hit.get("reference",{})
-            
-            #parse measurement-agent
-            observer_ip = meta.get("observer", {}).get("ip", None)
-            if observer_ip:
-                md_obj['measurement-agent'] = observer_ip
-            else:
-                continue
-            
-            #parse source and dest
-            source_ip = meta.get("source", {}).get("ip", None)
-            dest_ip = meta.get("destination", {}).get("ip", None)
-            if source_ip and dest_ip:
-                md_obj['subject-type'] = "point-to-point"
-                md_obj['source'] = source_ip
-                md_obj['destination'] = dest_ip
-            elif source_ip:
-                md_obj['subject-type'] = "network-element"
-                md_obj['source'] = source_ip
-            elif observer_ip:
-                md_obj['subject-type'] = "network-element"
-                md_obj['source'] = observer_ip
-            else:
+            md_key = bucket.get("key", {}).get("checksum")
+            md_obj = self._build_md_obj(md_key, hits[0].get("_source",{}))
+            if not md_obj:
                 continue
-                
-            #parse pschedule object
-            tool=pscheduler.get("tool", None)
-            if tool:
-                md_obj['tool-name'] = "pscheduler/{0}".format(tool)
-            else:
-                continue
-            #this matches the old esmond archive behavior, though not sure it is
-            #the desired value since includes scheduling fluff time
-            md_obj['time-duration'] = pscheduler.get("duration", None)
-            
-            #parse test parameters
-            test_type = test.get("type", None)
-            md_obj['pscheduler-test-type'] = test_type
-            spec = test.get("spec", None)
-            if not spec:
-                continue
-            md_obj['input-source'] = spec.get("source", None)
-            if not md_obj['input-source']:
-                #this matches old behavior, though not sure it is desired
-                md_obj['input-source'] = md_obj['measurement-agent']
-            if spec.get("dest", None):
-                md_obj['input-destination'] = spec["dest"]
-            
-            #add type specific parameters
-            field_parser = None
-            if test_type == 'throughput':
-                field_parser = EsmondThroughputMetadataFieldParser()
-            elif test_type == 'latency' or test_type == 'latencybg':
-                field_parser = EsmondLatencyMetadataFieldParser()
-            elif test_type == 'disk-to-disk':
-                field_parser = EsmondDiskToDiskMetadataFieldParser()
-            elif test_type == 'trace':
-                field_parser = EsmondTraceMetadataFieldParser()
-            elif test_type == 'rtt':
-                field_parser = EsmondRttMetadataFieldParser()
-            else:
-                field_parser = EsmondRawMetadataFieldParser(test_type)
-                
-            if pscheduler.get("added", None):
-                time_added = datestr_to_timestamp(pscheduler['added'])
-                print("time_added={0}".format(time_added))
-            
-            field_parser.parse(spec, md_obj, reference=reference, md_key=md_obj['metadata-key'], time_added=time_added)
+            found.append((md_key, md_obj))
             if request_url:
-                md_obj['url'] = self._get_md_url(request_url, md_obj['metadata-key'])
+                md_obj = dict(md_obj)
+                md_obj['url'] = self._get_md_url(request_url, md_key)
             metadata.append(md_obj)
         
+        #with a time filter the latest run in the range may not be the latest one
+        if self.cache and not handle_time_filters(q)["has_filters"]:
+            self.cache.put_many(found)
+        
         #add the metadata count and pagination fields to first element. this is how esmond did it.
         metadata_count = res.get("aggregations", {}).get("tests_total_count",{}).get("value",0)
+        #a short page means we reached the end
+        next_after_key = None
+        if len(buckets) >= result_size:
+            next_after_key = tests_agg.get("after_key", None)
         
         if paginate and metadata_count != 0 and len(metadata) > 0:
             metadata[0]["metadata-count-total"] = metadata_count
-            metadata[0]["metadata-previous-page"] = self._get_prev_link(request_url, result_size, result_offset, metadata_count)
-            metadata[0]["metadata-next-page"] = self._get_next_link(request_url, result_size, result_offset, metadata_count)
+            metadata[0]["metadata-previous-page"] = self._get_prev_link(request_url, result_size, result_offset)
+            metadata[0]["metadata-next-page"] = self._get_next_link(request_url, result_size, result_offset, next_after_key)
         
         return metadata
         
+class EsmondMetadataCache:
+    '''
+    In-process cache of rendered esmond metadata objects keyed by metadata key. 
+    The full list of tests is loaded once every ttl seconds. In between, it 
+    is refreshed every refresh_interval seconds by only looking at tests that 
+    have run since the last refresh. List requests are answered from the 
+    cache as long as every filter can be evaluated locally and no entries were
+    evicted since the last full load.
+
+    entries can be a cache shared with other processes, e.g. a SQLiteCache.
+    The times of the last load and refresh and the version are then kept in
+    the state cache so only one process loads or refreshes at a time and a
+    restarted process picks up where the others are.
+    '''
+
+    def __init__(self, es, 
+                    test_types=None,
+                    max_size=DEFAULT_METADATA_CACHE_SIZE, 
+                    ttl=DEFAULT_METADATA_CACHE_TTL, 
+                    refresh_interval=DEFAULT_METADATA_CACHE_REFRESH,
+                    refresh_overlap=DEFAULT_METADATA_CACHE_OVERLAP,
+                    entries=None,
+                    state=None
+                ):
+        self.es = es
+        self.test_types = test_types
+        self.max_size = max_size
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        #how far before the last refresh to look to account for ingest lag
+        self.refresh_overlap = refresh_overlap
+        self.entries = entries
+        if self.entries is None:
+            self.entries = LRUCache(max_size=max_size)
+        self.state = state
+        self.loaded = None
+        self.last_refresh = None
+        self.complete = False
+        self.list_hits = 0
+        self.list_misses = 0
+        #bumped whenever the contents change so responses can be revalidated
+        self.version = 0
+        self._sorted = None
+        #held while loading or refreshing
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+    
+    def _read_state(self):
+        #another process may have loaded or refreshed
+        if self.state is None:
+            return
+        state = self.state.peek("state", None)
+        if state is not None:
+            self.loaded, self.last_refresh, self.complete = state
+        self.version = self.state.peek("version", self.version)
+
+    def _write_state(self):
+        if self.state is not None:
+            self.state.set("state", (self.loaded, self.last_refresh, self.complete))
+
+    def _changed(self):
+        self._sorted = None
+        if self.state is None:
+            self.version += 1
+        else:
+            #every process has to see a new version
+            version = self.state.incr("version")
+            self.version = version if version is not None else self.version + 1
+
+    def _load(self):
+        start = time.time()
+        if self.state is None:
+            entries = LRUCache(max_size=self.max_size)
+        else:
+            #shared entries are replaced in place and tests that are gone removed after
+            entries = self.entries
+        evictions = entries.evictions
+        #set all at once so a shared cache is written in one transaction
+        tests = list(EsmondMetadata(self.es, test_types=self.test_types).iter_tests())
+        entries.set_many(tests)
+        seen = set(md_key for md_key, md_obj in tests)
+        if self.state is not None:
+            entries.delete_many([md_key for md_key, md_obj in entries.items() if md_key not in seen])
+        self.entries = entries
+        self.complete = (entries.evictions == evictions)
+        self.loaded = start
+        self.last_refresh = start
+        self._changed()
+        log.debug("Loaded {0} tests into metadata cache in {1:.3f}s".format(len(seen), time.time() - start))
+    
+    def _refresh(self):
+        start = time.time()
+        since_ts = int(self.last_refresh - self.refresh_overlap)
+        since = datetime.datetime.utcfromtimestamp(since_ts)
+        time_filters = { "begin": since_ts, "end": None, "has_filters": True }
+        query = {
+            "bool": {
+                "filter": [ { "range": { "pscheduler.start_time": { "gte": since } } } ]
+            }
+        }
+        evictions = self.entries.evictions
+        tests = list(EsmondMetadata(self.es, test_types=self.test_types).iter_tests(query=query, time_filters=time_filters))
+        count = len(tests)
+        changed = sum(1 for md_key, md_obj in tests if self.entries.peek(md_key) != md_obj)
+        self.entries.set_many(tests)
+        if self.entries.evictions > evictions:
+            self.complete = False
+        self.last_refresh = start
+        if changed:
+            self._changed()
+        log.debug("Refreshed {0} tests in metadata cache in {1:.3f}s".format(count, time.time() - start))
+    
+    def refresh(self):
+        '''
+        Starts loading or refreshing the cache in the background if it is 
+        due, unless another thread (or process when the cache is shared) is 
+        already doing it. The current contents are used in the meantime, so
+        until the first load is done searches go to elastic.
+        '''
+        self._read_state()
+        now = time.time()
+        if self.loaded is not None and (now - self.loaded) < self.ttl and (now - self.last_refresh) < self.refresh_interval:
+            return
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            #searches need the config of the app
+            threading.Thread(target=self._run_refresh, args=(app._get_current_object(),), name="elmond-metadata-cache", daemon=True).start()
+        except:
+            self._lock.release()
+            raise
+    
+    def _run_refresh(self, flask_app):
+        try:
+            with flask_app.app_context():
+                if self.state is None:
+                    self._refresh_due()
+                else:
+                    with self.state.lock(blocking=False) as locked:
+                        if locked:
+                            self._read_state()
+                            self._refresh_due()
+        except Exception as e:
+            log.error("Unable to refresh metadata cache: {0}".format(e))
+        finally:
+            self._lock.release()
+
+    def _refresh_due(self):
+        now = time.time()
+        if self.loaded is None or (now - self.loaded) >= self.ttl:
+            self._load()
+            self._write_state()
+        elif (now - self.last_refresh) >= self.refresh_interval:
+            self._refresh()
+            self._write_state()
+    
+    def get(self, md_key):
+        self.refresh()
+        return self.entries.get(md_key)
+    
+    def put(self, md_key, md_obj):
+        self.put_many([(md_key, md_obj)])
+    
+    def put_many(self, items):
+        '''
+        Adds the (md_key, md_obj) pairs found by a search to the cache with 
+        one write and at most one version change
+        '''
+        items = [(md_key, md_obj) for md_key, md_obj in items if self.entries.peek(md_key) != md_obj]
+        if not items:
+            return
+        evictions = self.entries.evictions
+        self.entries.set_many(items)
+        if self.entries.evictions > evictions:
+            #lists would be missing the evicted test until the next full load
+            self.complete = False
+            self._write_state()
+        self._changed()
+    
+    def answers(self, q):
+        '''
+        Returns True if a search for q would be answered from the cache as it
+        is now, so the response only changes when version does. Does not load
+        or refresh the cache.
+        '''
+        self._read_state()
+        if list(q.keys()) == ['metadata-key']:
+            return q['metadata-key'] in self.entries
+        return self.complete and build_local_filter(q) is not None
+    
+    def list(self, q):
+        '''
+        Returns the cached metadata objects matching q sorted by key or None if
+        the query can't be answered from the cache
+        '''
+        with Timer(TIMING_FILTERS):
+            match = build_local_filter(q)
+        if match is None:
+            self._count("list_misses")
+            return None
+        self.refresh()
+        if not self.complete:
+            self._count("list_misses")
+            return None
+        self._count("list_hits")
+        #the sorted list is rebuilt when this or another process changed the entries
+        if self._sorted is None or self._sorted[0] != self.version:
+            self._sorted = (self.version, [md_obj for md_key, md_obj in sorted(self.entries.items(), key=lambda i: i[0])])
+        md_list = self._sorted[1]
+        
+        return [md_obj for md_obj in md_list if match(md_obj)]
+    
+    def _count(self, counter):
+        with self._stats_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+    
+    def stats(self):
+        stats = self.entries.stats()
+        with self._stats_lock:
+            stats["list_hits"] = self.list_hits
+            stats["list_misses"] = self.list_misses
+        stats["complete"] = self.complete
+        stats["version"] = self.version
+        return stats
+        
 class EsmondMetadataFieldParser:
     field_map={}
     
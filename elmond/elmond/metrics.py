@@ -0,0 +1,273 @@
+'''
+Counters and histograms for the hot paths of elmond, written in the
+Prometheus text format by the /metrics route. Metrics are kept per process.
+'''
+import bisect
+import logging
+import threading
+import time
+from filters import TRANSLATE_EVENT_TYPE
+from flask import has_request_context, request
+from summaries import SUMMARY_TYPES
+from timing import TIMING_ES, TIMING_ES_TOOK, TIMING_SERIALIZE, add_timing, get_timings
+
+log = logging.getLogger('elmond')
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+DEFAULT_HITS_BUCKETS = [0, 1, 10, 100, 1000, 10000, 100000]
+DEFAULT_BYTES_BUCKETS = [1024 * (4 ** i) for i in range(9)]
+#Label sets a metric can have before new ones are counted as OTHER_LABEL
+MAX_LABEL_SETS = 2000
+OTHER_LABEL = "other"
+#Event types that are not in TRANSLATE_EVENT_TYPE but can be requested
+EXTRA_EVENT_TYPES = ["failures", "pscheduler-raw"]
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(k, _escape(v)) for k, v in labels) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+class Metric:
+    '''
+    Base class for a metric with a fixed list of label names
+    '''
+    type_name = None
+
+    def __init__(self, name, help, labelnames=[]):
+        self.name = name
+        self.help = help
+        self.labelnames = list(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        key = tuple(str(labels.get(l, "")) for l in self.labelnames)
+        if key not in self._values and len(self._values) >= MAX_LABEL_SETS:
+            key = tuple(OTHER_LABEL for l in self.labelnames)
+        return key
+
+    def _samples(self, key, value):
+        raise NotImplementedError()
+
+    def collect(self):
+        lines = [
+            "# HELP {0} {1}".format(self.name, self.help),
+            "# TYPE {0} {1}".format(self.name, self.type_name)
+        ]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                for suffix, extra, sample in self._samples(key, value):
+                    labels = list(zip(self.labelnames, key)) + extra
+                    lines.append("{0}{1}{2} {3}".format(self.name, suffix, _format_labels(labels), _format_value(sample)))
+        return lines
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def inc(self, amount=1, **labels):
+        with self._lock:
+            key = self._key(labels)
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self, key, value):
+        return [("", [], value)]
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(self, name, help, labelnames=[], buckets=DEFAULT_LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames=labelnames)
+        self.buckets = sorted(buckets)
+
+    def observe(self, value, **labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            key = self._key(labels)
+            entry = self._values.get(key, None)
+            if entry is None:
+                #count per bucket plus one for +Inf, then the sum
+                entry = [[0] * (len(self.buckets) + 1), 0]
+                self._values[key] = entry
+            entry[0][i] += 1
+            entry[1] += value
+
+    def _samples(self, key, value):
+        counts, total = value
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + [float("inf")], counts):
+            cumulative += count
+            samples.append(("_bucket", [("le", _format_value(float(bound)))], cumulative))
+        samples.append(("_sum", [], total))
+        samples.append(("_count", [], cumulative))
+        return samples
+
+class Registry:
+    '''
+    The metrics of a process. Collectors passed to render are functions that
+    return lines for values kept elsewhere, like cache statistics.
+    '''
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help, labelnames=[]):
+        metric = Counter(name, help, labelnames=labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labelnames=[], buckets=DEFAULT_LATENCY_BUCKETS):
+        metric = Histogram(name, help, labelnames=labelnames, buckets=buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self, collectors=[]):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.collect())
+        for collector in collectors:
+            try:
+                lines.extend(collector())
+            except Exception as e:
+                log.error("Unable to collect metrics: {0}".format(e))
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+REGISTRY = Registry()
+
+DATA_LABELS = ["event_type", "summary_type", "summary_window"]
+REQUEST_SECONDS = REGISTRY.histogram("elmond_request_duration_seconds", "Time to handle a request including writing the response", ["endpoint", "method", "status"] + DATA_LABELS)
+RESPONSE_BYTES = REGISTRY.histogram("elmond_response_bytes", "Size of response bodies", ["endpoint", "format"] + DATA_LABELS, buckets=DEFAULT_BYTES_BUCKETS)
+ES_TOOK_SECONDS = REGISTRY.histogram("elmond_es_took_seconds", "Time elasticsearch reports a search took", ["kind"] + DATA_LABELS)
+ES_WALL_SECONDS = REGISTRY.histogram("elmond_es_wall_seconds", "Time elmond waited for a search including the network and decoding", ["kind"] + DATA_LABELS)
+ES_HITS = REGISTRY.histogram("elmond_es_hits", "Hits returned by a search", ["kind"] + DATA_LABELS, buckets=DEFAULT_HITS_BUCKETS)
+PARSE_SECONDS = REGISTRY.histogram("elmond_parse_seconds", "Time to turn search hits into esmond data", DATA_LABELS)
+ES_ERRORS = REGISTRY.counter("elmond_es_errors_total", "Searches that raised an error", ["kind"] + DATA_LABELS)
+SERIALIZE_SECONDS = REGISTRY.histogram("elmond_serialize_seconds", "Time spent encoding response bodies", ["format"] + DATA_LABELS)
+
+def data_labels(event_type=None, summary_type=None, summary_window=None):
+    '''
+    Returns the event type, summary type and window labels. They default to
+    the ones in the URL of the current request. Values that aren't valid are
+    replaced so clients can't create any number of them.
+    '''
+    if event_type is None and has_request_context() and request.view_args:
+        event_type = request.view_args.get("event_type", None)
+        summary_type = request.view_args.get("summary_type", None)
+        summary_window = request.view_args.get("summary_window", None)
+    if event_type is None:
+        return { "event_type": "", "summary_type": "", "summary_window": "" }
+    if event_type not in TRANSLATE_EVENT_TYPE and event_type not in EXTRA_EVENT_TYPES:
+        event_type = OTHER_LABEL
+    if summary_type not in SUMMARY_TYPES:
+        summary_type = OTHER_LABEL
+    try:
+        summary_window = str(int(summary_window))
+    except (TypeError, ValueError):
+        summary_window = OTHER_LABEL
+    return { "event_type": event_type, "summary_type": summary_type, "summary_window": summary_window }
+
+def observe_search(res, wall, kind, **labels):
+    '''
+    Records the took and wall time of a search response and how many hits it
+    returned
+    '''
+    labels = dict(labels, kind=kind)
+    if "took" in res:
+        ES_TOOK_SECONDS.observe(res["took"] / 1000.0, **labels)
+    ES_HITS.observe(len(res.get("hits", {}).get("hits", [])), **labels)
+    ES_WALL_SECONDS.observe(wall, **labels)
+
+def add_search_timing(responses, wall):
+    '''
+    Adds the wall time of a search and the took time of its responses to the
+    timings of the current request
+    '''
+    add_timing(TIMING_ES, wall)
+    add_timing(TIMING_ES_TOOK, sum(r.get("took", 0) for r in responses) / 1000.0)
+
+def timed_search(es, kind, labels={}, **kwargs):
+    '''
+    Runs es.search with kwargs and records metrics for it
+    '''
+    start = time.time()
+    try:
+        res = es.search(**kwargs)
+    except Exception:
+        ES_ERRORS.inc(kind=kind, **labels)
+        raise
+    wall = time.time() - start
+    observe_search(res, wall, kind, **labels)
+    add_search_timing([res], wall)
+    return res
+
+def stats_collector(name, help, get_stats):
+    '''
+    Returns a collector that writes the numbers in the dicts returned by
+    get_stats as a gauge with a label for each dict key
+    '''
+    def collect():
+        lines = [ "# HELP {0} {1}".format(name, help), "# TYPE {0} gauge".format(name) ]
+        for label, stats in get_stats().items():
+            if stats is None:
+                continue
+            for stat, value in sorted(stats.items()):
+                if isinstance(value, bool):
+                    value = int(value)
+                if isinstance(value, (int, float)):
+                    lines.append("{0}{1} {2}".format(name, _format_labels([("cache", label), ("stat", stat)]), _format_value(value)))
+        return lines
+    return collect
+
+def _other_time():
+    #es-took is part of the es wall time
+    return sum(seconds for name, seconds in get_timings().items() if name not in (TIMING_ES_TOOK, TIMING_SERIALIZE))
+
+def time_iter(iterable, metric, **labels):
+    '''
+    Wraps a generator and records the time spent running it, not counting the
+    time the consumer spends between items or the time the generator records
+    for other steps, e.g. searches made while paging through results
+    '''
+    elapsed = 0.0
+    iterator = iter(iterable)
+    try:
+        while True:
+            start = time.time()
+            other = _other_time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                item = StopIteration
+            elapsed += (time.time() - start) - (_other_time() - other)
+            if item is StopIteration:
+                break
+            yield item
+    finally:
+        metric.observe(elapsed, **labels)
+        add_timing(TIMING_SERIALIZE, elapsed)
+
+def count_bytes(iterable, done):
+    '''
+    Wraps the body of a streamed response and calls done with its size once
+    it has been written
+    '''
+    size = 0
+    try:
+        for chunk in iterable:
+            size += len(chunk)
+            yield chunk
+    finally:
+        if hasattr(iterable, "close"):
+            iterable.close()
+        done(size)
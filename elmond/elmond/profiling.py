@@ -0,0 +1,78 @@
+'''
+Debug mode that profiles a single data request. Named so it doesn't hide the
+standard library profile module that cProfile uses.
+'''
+import cProfile
+import io
+import json
+import logging
+import pstats
+import threading
+import time
+from flask import Response, current_app as app, request
+from metrics import timed_search
+from timing import get_timings
+from util import PROFILE_FILTER
+from werkzeug.exceptions import Forbidden
+
+log = logging.getLogger('elmond')
+
+#Functions listed in the cProfile summary
+PROFILE_STATS_LINES=40
+#Only one profiler can run at a time
+_profile_lock = threading.Lock()
+
+def wants_profile():
+    '''
+    Returns True if the current request asks for a profile. Raises Forbidden
+    if ALLOW_PROFILE is not set.
+    '''
+    if request.args.get(PROFILE_FILTER, "").lower() not in ["1", "true"]:
+        return False
+    if not app.config.get('ELMOND', {}).get("ALLOW_PROFILE", False):
+        raise Forbidden("Profiling is not enabled on this server")
+    return True
+
+def profile_data(esd, writer, metadata_key, event_type, summary_type, summary_window, q={}):
+    '''
+    Runs a data request with elastic and python profiling turned on. Returns
+    a JSON response with the query, the indices searched, the elastic profile,
+    the time spent on each step and a cProfile summary instead of the data.
+    '''
+    start = time.time()
+    with _profile_lock:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            query = esd.prepare_fetch(metadata_key, event_type, summary_type, summary_window, q=q)
+            es_profile = None
+            if query is None:
+                #merged statistics page through the raw histograms so there is
+                # no single search to profile
+                query = esd.prepare(metadata_key, event_type, "base", 0, q=q)
+                data = esd.fetch(metadata_key, event_type, summary_type, summary_window, q=q)
+            else:
+                dsl = dict(query.dsl, profile=True)
+                res = timed_search(esd.es, "profile", query.labels(), index=query.index_name, body=dsl, ignore_unavailable=True, allow_no_indices=True)
+                es_profile = res.get("profile", None)
+                data = esd.parse_response(metadata_key, query, res)
+            body = writer.write_list(data).get_data()
+        finally:
+            profiler.disable()
+    elapsed = time.time() - start
+
+    stats = io.StringIO()
+    pstats.Stats(profiler, stream=stats).sort_stats("cumulative").print_stats(PROFILE_STATS_LINES)
+    result = {
+        "dsl": query.dsl,
+        "indices": query.index_name.split(","),
+        "result-count": len(data),
+        "response-bytes": len(body),
+        "timings-ms": { name: seconds * 1000 for name, seconds in get_timings().items() },
+        "total-ms": elapsed * 1000,
+        "elastic-profile": es_profile,
+        "cprofile": stats.getvalue()
+    }
+    log.debug("Profiled {0} in {1:.3f}s".format(request.path, elapsed))
+
+    return Response(json.dumps(result, sort_keys=True, indent=4, default=str) + "\n", mimetype="application/json")
@@ -0,0 +1,146 @@
+import logging
+import threading
+import time
+from cache import LRUCache
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from flask import current_app as app
+from timing import TIMING_DNS, add_timing
+from util import lookup_hostname
+
+log = logging.getLogger('elmond')
+
+#Defaults for the DNS_RESOLVER config
+DEFAULT_DNS_CACHE_SIZE=10000
+#How long to remember an address
+DEFAULT_DNS_TTL=300
+#How long to remember that a host has no address
+DEFAULT_DNS_NEGATIVE_TTL=60
+#How long to wait for a lookup before giving up on it
+DEFAULT_DNS_TIMEOUT=2.0
+#Lookups that can run at the same time
+DEFAULT_DNS_THREADS=8
+#Stored in the cache for hosts with no address since the cache can't hold None
+NO_ADDRESS=""
+
+class Resolver:
+    '''
+    Looks up the addresses of hostnames with a cache. Lookups for more than
+    one address family run at the same time, each bounded by a timeout.
+    Callers that miss on a host that is already being looked up wait on the
+    same lookup. Hosts without an address are also cached, for a shorter time.
+    '''
+
+    def __init__(self, max_size=DEFAULT_DNS_CACHE_SIZE, ttl=DEFAULT_DNS_TTL, negative_ttl=DEFAULT_DNS_NEGATIVE_TTL, timeout=DEFAULT_DNS_TIMEOUT, threads=DEFAULT_DNS_THREADS, cache=None):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.timeout = timeout
+        self.cache = cache
+        if self.cache is None:
+            self.cache = LRUCache(max_size=max_size, ttl=ttl)
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="elmond-dns")
+        self._lock = threading.Lock()
+        #lookups running now by (host, family)
+        self._in_flight = {}
+        self.lookups = 0
+        self.shared = 0
+        self.negative_hits = 0
+        self.timeouts = 0
+        self.lookup_time = 0.0
+
+    def _lookup(self, host, family):
+        try:
+            start = time.time()
+            addr = lookup_hostname(host, family)
+            elapsed = time.time() - start
+            with self._lock:
+                self.lookups += 1
+                self.lookup_time += elapsed
+            log.debug("Looked up {0} (family {1}) in {2:.3f}s: {3}".format(host, family, elapsed, addr))
+            if addr:
+                self.cache.set((host, family), addr, ttl=self.ttl)
+            else:
+                self.cache.set((host, family), NO_ADDRESS, ttl=self.negative_ttl)
+            return addr
+        finally:
+            #removed once the result is cached so later callers find it there
+            with self._lock:
+                self._in_flight.pop((host, family), None)
+
+    def _start_lookup(self, host, family):
+        '''
+        Returns the future of the lookup of host in family, joining the one
+        already running if there is one
+        '''
+        key = (host, family)
+        with self._lock:
+            future = self._in_flight.get(key, None)
+            if future is not None:
+                self.shared += 1
+                return future
+            future = self.executor.submit(self._lookup, host, family)
+            self._in_flight[key] = future
+            return future
+
+    def resolve(self, host, families):
+        '''
+        Returns a map of each address family in families to the address of host
+        in that family, or None if it has no address or the lookup timed out
+        '''
+        start = time.time()
+        addrs = {}
+        futures = {}
+        for family in families:
+            cached = self.cache.get((host, family), None)
+            if cached is None:
+                futures[family] = self._start_lookup(host, family)
+            elif cached == NO_ADDRESS:
+                with self._lock:
+                    self.negative_hits += 1
+                addrs[family] = None
+            else:
+                addrs[family] = cached
+        #lookups run in parallel so the timeout is for all of them together
+        deadline = time.time() + self.timeout
+        for family, future in futures.items():
+            try:
+                addrs[family] = future.result(timeout=max(deadline - time.time(), 0))
+            except TimeoutError:
+                log.warning("Timed out looking up {0} (family {1}) after {2}s".format(host, family, self.timeout))
+                with self._lock:
+                    self.timeouts += 1
+                addrs[family] = None
+        add_timing(TIMING_DNS, time.time() - start)
+
+        return addrs
+
+    def stats(self):
+        cache_stats = self.cache.stats()
+        with self._lock:
+            return {
+                "size": cache_stats["size"],
+                "hits": cache_stats["hits"],
+                "misses": cache_stats["misses"],
+                "evictions": cache_stats["evictions"],
+                "negative_hits": self.negative_hits,
+                "lookups": self.lookups,
+                "shared": self.shared,
+                "timeouts": self.timeouts,
+                "lookup_time": self.lookup_time
+            }
+
+_resolver_lock = threading.Lock()
+
+def get_resolver():
+    '''
+    Returns the resolver shared by the app, creating it from the DNS_RESOLVER
+    config if create_app didn't
+    '''
+    state = app.extensions.setdefault('elmond', {})
+    resolver = state.get("resolver", None)
+    if resolver is None:
+        with _resolver_lock:
+            resolver = state.get("resolver", None)
+            if resolver is None:
+                resolver = Resolver(**app.config.get('ELMOND', {}).get("DNS_RESOLVER", {}))
+                state["resolver"] = resolver
+    return resolver
@@ -0,0 +1,375 @@
+import csv
+import io
+import itertools
+import json
+import logging
+import math
+import time
+from columns import DataColumns, np
+from flask import Response, stream_with_context
+from metrics import SERIALIZE_SECONDS, data_labels, time_iter
+from timing import TIMING_SERIALIZE, add_timing
+from werkzeug.exceptions import BadRequest, NotAcceptable
+
+#orjson is optional but a lot faster if installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+#msgpack is optional and only needed for the msgpack format
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+log = logging.getLogger('elmond')
+
+#Constants
+ENCODER_AUTO = "auto"
+ENCODER_JSON = "json"
+ENCODER_ORJSON = "orjson"
+#Size of the chunks written when streaming a list
+CHUNK_SIZE = 65536
+#How much of a streamed response is read into memory when it is shared or 
+# cached. Bigger responses are streamed instead.
+DEFAULT_MAX_BUFFERED_BYTES=4*1024*1024
+#Output formats
+FORMAT_JSON = "json"
+FORMAT_NDJSON = "ndjson"
+FORMAT_CSV = "csv"
+FORMAT_MSGPACK = "msgpack"
+#Most results a msgpack response can have when the number of results isn't
+# known up front, e.g. when streaming, since they have to be read first
+DEFAULT_MSGPACK_MAX_RESULTS=1000000
+
+def get_encoder_name(name=ENCODER_AUTO):
+    '''
+    Picks the JSON encoder to use. auto uses orjson if it is installed.
+    '''
+    if name == ENCODER_AUTO:
+        if orjson is not None:
+            return ENCODER_ORJSON
+        return ENCODER_JSON
+    elif name == ENCODER_ORJSON and orjson is None:
+        log.warning("orjson is not installed, using json encoder")
+        return ENCODER_JSON
+    elif name not in [ENCODER_JSON, ENCODER_ORJSON]:
+        log.warning("Unknown JSON encoder {0}, using json encoder".format(name))
+        return ENCODER_JSON
+    return name
+
+def finite(obj):
+    '''
+    Returns a copy of obj with NaN and infinite floats replaced by None, the
+    same as orjson writes them, since JSON has no way to write them
+    '''
+    if isinstance(obj, float):
+        return obj if math.isfinite(obj) else None
+    elif isinstance(obj, dict):
+        return { k: finite(v) for k, v in obj.items() }
+    elif isinstance(obj, (list, tuple)):
+        return [finite(v) for v in obj]
+    return obj
+
+def _json_dumps(obj, **kwargs):
+    try:
+        return json.dumps(obj, allow_nan=False, **kwargs)
+    except ValueError:
+        #only copy when there are values JSON can't have
+        return json.dumps(finite(obj), allow_nan=False, **kwargs)
+
+def buffer_response(response, max_bytes=DEFAULT_MAX_BUFFERED_BYTES):
+    '''
+    Reads the body of a streamed response if it is no more than max_bytes. 
+    Returns the body and a response with it, or None and a response that 
+    writes what was read followed by the rest if it is bigger, so large 
+    responses still go out as they are written.
+    '''
+    if not response.is_streamed:
+        return response.get_data(), response
+    chunks = []
+    size = 0
+    iterator = iter(response.response)
+    for chunk in iterator:
+        chunks.append(chunk)
+        size += len(chunk)
+        if max_bytes is not None and size > max_bytes:
+            streamed = Response(itertools.chain(chunks, iterator), status=response.status_code, headers=response.headers)
+            streamed.call_on_close(response.close)
+            return None, streamed
+    body = b''.join(chunks)
+    response.close()
+    return body, Response(body, status=response.status_code, headers=response.headers)
+
+class ResponseWriter:
+    '''
+    Base class for writers that turn results into responses. Subclasses 
+    implement iter_list and dumps.
+    '''
+    mimetype = None
+    format = None
+
+    def dumps(self, obj):
+        raise NotImplementedError()
+
+    def iter_list(self, items):
+        raise NotImplementedError()
+
+    def timed_dumps(self, obj):
+        '''
+        Returns dumps(obj) and records how long it took
+        '''
+        start = time.time()
+        body = self.dumps(obj)
+        elapsed = time.time() - start
+        SERIALIZE_SECONDS.observe(elapsed, format=self.format, **data_labels())
+        add_timing(TIMING_SERIALIZE, elapsed)
+        return body
+
+    def write(self, obj):
+        '''
+        Returns a response with a single object
+        '''
+        return Response(self.timed_dumps(obj), mimetype=self.mimetype)
+
+    def write_list(self, items):
+        '''
+        Returns a streaming response for a list or generator of objects
+        '''
+        chunks = time_iter(self.iter_list(items), SERIALIZE_SECONDS, format=self.format, **data_labels())
+        return Response(stream_with_context(chunks), mimetype=self.mimetype)
+
+class JSONWriter(ResponseWriter):
+    '''
+    Writes objects as JSON responses. Output is compact by default. Pretty
+    output is indented with sorted keys, the same as esmond. NaN and infinite
+    values are written as null with either encoder.
+    '''
+    mimetype = 'application/json'
+    format = FORMAT_JSON
+
+    def __init__(self, pretty=False, encoder=ENCODER_AUTO):
+        self.pretty = pretty
+        self.encoder = get_encoder_name(encoder)
+
+    def dumps(self, obj):
+        '''
+        Returns obj as JSON encoded bytes
+        '''
+        if self.pretty:
+            return _json_dumps(obj, sort_keys=True, indent=4, separators=(',', ': ')).encode('utf-8')
+        if self.encoder == ENCODER_ORJSON:
+            try:
+                return orjson.dumps(obj)
+            except TypeError:
+                #things like integers larger than 64 bits
+                pass
+        return _json_dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    def iter_list(self, items):
+        '''
+        Generator that encodes a list one item at a time, yielding chunks of
+        roughly CHUNK_SIZE bytes so we never build the whole document
+        '''
+        sep = b','
+        if self.pretty:
+            sep = b',\n'
+        chunk = [b'[']
+        chunk_len = 1
+        first = True
+        for item in items:
+            text = self.dumps(item)
+            if self.pretty:
+                #indent the same as dumping the whole list at once
+                text = b'    ' + text.replace(b'\n', b'\n    ')
+            if not first:
+                chunk.append(sep)
+            elif self.pretty:
+                chunk.append(b'\n')
+            first = False
+            chunk.append(text)
+            chunk_len += len(text) + 2
+            if chunk_len >= CHUNK_SIZE:
+                yield b''.join(chunk)
+                chunk = []
+                chunk_len = 0
+        if self.pretty and not first:
+            chunk.append(b'\n')
+        chunk.append(b']\n')
+        yield b''.join(chunk)
+
+    def write(self, obj):
+        return Response(self.timed_dumps(obj) + b'\n', mimetype=self.mimetype)
+
+class NDJSONWriter(JSONWriter):
+    '''
+    Writes lists as newline-delimited JSON, one compact object per line
+    '''
+    mimetype = 'application/x-ndjson'
+    format = FORMAT_NDJSON
+
+    def __init__(self, encoder=ENCODER_AUTO):
+        super().__init__(pretty=False, encoder=encoder)
+
+    def iter_list(self, items):
+        chunk = []
+        chunk_len = 0
+        for item in items:
+            text = self.dumps(item)
+            chunk.append(text)
+            chunk.append(b'\n')
+            chunk_len += len(text) + 1
+            if chunk_len >= CHUNK_SIZE:
+                yield b''.join(chunk)
+                chunk = []
+                chunk_len = 0
+        if chunk:
+            yield b''.join(chunk)
+
+class CSVWriter(ResponseWriter):
+    '''
+    Writes data points as CSV with a ts and val column. Values that are not
+    numbers or strings (e.g. histograms and statistics) are written as 
+    compact JSON in the val column.
+    '''
+    mimetype = 'text/csv'
+    format = FORMAT_CSV
+    columns = ["ts", "val"]
+
+    def __init__(self, encoder=ENCODER_AUTO):
+        self.json_writer = JSONWriter(encoder=encoder)
+
+    def _cell(self, val):
+        if isinstance(val, float) and not math.isfinite(val):
+            return None
+        if val is None or isinstance(val, (str, int, float)):
+            return val
+        return self.json_writer.dumps(val).decode('utf-8')
+
+    def dumps(self, obj):
+        return b''.join(self.iter_list([obj]))
+
+    def iter_list(self, items):
+        buf = io.StringIO()
+        writer = csv.writer(buf, lineterminator='\n')
+        writer.writerow(self.columns)
+        for item in items:
+            writer.writerow([self._cell(item.get(c, None)) for c in self.columns])
+            if buf.tell() >= CHUNK_SIZE:
+                yield buf.getvalue().encode('utf-8')
+                buf.seek(0)
+                buf.truncate()
+        yield buf.getvalue().encode('utf-8')
+
+class MsgpackWriter(ResponseWriter):
+    '''
+    Writes data points as a columnar msgpack map. ts is delta-encoded: the 
+    first element is a timestamp and every following element is the 
+    difference from the previous timestamp. val has one entry per timestamp.
+    '''
+    mimetype = 'application/msgpack'
+    format = FORMAT_MSGPACK
+
+    def __init__(self, max_results=DEFAULT_MSGPACK_MAX_RESULTS):
+        if msgpack is None:
+            raise NotAcceptable("The {0} format is not supported by this server".format(FORMAT_MSGPACK))
+        self.max_results = max_results
+
+    def dumps(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def _iter_array(self, packer, col):
+        '''
+        Packs col as an array, yielding chunks of roughly CHUNK_SIZE bytes
+        '''
+        chunk = [packer.pack_array_header(len(col))]
+        chunk_len = 0
+        for val in col:
+            packed = packer.pack(val)
+            chunk.append(packed)
+            chunk_len += len(packed)
+            if chunk_len >= CHUNK_SIZE:
+                yield b''.join(chunk)
+                chunk = []
+                chunk_len = 0
+        if chunk:
+            yield b''.join(chunk)
+
+    def _read(self, items, max_results=None):
+        '''
+        Reads items into delta-encoded ts and val lists. Raises BadRequest 
+        if there are more than max_results.
+        '''
+        ts = []
+        vals = []
+        prev_ts = 0
+        for item in items:
+            if max_results is not None and len(ts) >= max_results:
+                raise BadRequest("The {0} format can't be streamed and is limited to {1} results. Use a smaller time range or another format.".format(FORMAT_MSGPACK, max_results))
+            curr_ts = item.get("ts", 0)
+            ts.append(curr_ts - prev_ts)
+            prev_ts = curr_ts
+            vals.append(item.get("val", None))
+        return ts, vals
+
+    def iter_list(self, items):
+        '''
+        Generator that packs the columns as they are written. msgpack arrays
+        start with their length, so anything but columns and lists (e.g. 
+        streamed results) has to be read before anything is written.
+        '''
+        if isinstance(items, DataColumns) and (items.val is not None or items.stats is not None):
+            #already have the columns so no need to build the rows
+            ts = items.ts
+            if len(ts):
+                ts = np.concatenate((ts[:1], np.diff(ts)))
+            ts = ts.tolist()
+            vals = items.values()
+        elif isinstance(items, (list, tuple)):
+            ts, vals = self._read(items, max_results=None)
+        else:
+            ts, vals = self._read(items, max_results=self.max_results)
+        packer = msgpack.Packer(use_bin_type=True)
+        yield packer.pack_map_header(3) + packer.pack("ts-encoding") + packer.pack("delta") + packer.pack("ts")
+        yield from self._iter_array(packer, ts)
+        yield packer.pack("val")
+        yield from self._iter_array(packer, vals)
+
+#The formats data can be written in and their mimetypes in order of preference 
+# when negotiating with the Accept header
+FORMAT_MIMETYPES = [
+    (FORMAT_JSON, JSONWriter.mimetype),
+    (FORMAT_NDJSON, NDJSONWriter.mimetype),
+    (FORMAT_CSV, CSVWriter.mimetype),
+    (FORMAT_MSGPACK, MsgpackWriter.mimetype)
+]
+
+def get_format(req, allowed=None):
+    '''
+    Determines the output format from the format parameter or, if that is 
+    not given, the Accept header of the request
+    '''
+    if allowed is None:
+        allowed = [f for f, m in FORMAT_MIMETYPES]
+    fmt = req.args.get("format", None)
+    if fmt:
+        fmt = fmt.lower()
+        if fmt not in allowed:
+            raise BadRequest("Invalid format {0}. Valid values are: {1}".format(fmt, ", ".join(allowed)))
+        return fmt
+    mimetypes = [m for f, m in FORMAT_MIMETYPES if f in allowed]
+    best = req.accept_mimetypes.best_match(mimetypes, default=JSONWriter.mimetype)
+    for f, m in FORMAT_MIMETYPES:
+        if m == best:
+            return f
+    return FORMAT_JSON
+
+def build_writer(fmt, pretty=False, encoder=ENCODER_AUTO, msgpack_max_results=DEFAULT_MSGPACK_MAX_RESULTS):
+    if fmt == FORMAT_NDJSON:
+        return NDJSONWriter(encoder=encoder)
+    elif fmt == FORMAT_CSV:
+        return CSVWriter(encoder=encoder)
+    elif fmt == FORMAT_MSGPACK:
+        return MsgpackWriter(max_results=msgpack_max_results)
+    return JSONWriter(pretty=pretty, encoder=encoder)
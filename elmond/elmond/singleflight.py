@@ -0,0 +1,296 @@
+import asyncio
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+import threading
+import time
+from flask import Response
+from response import DEFAULT_MAX_BUFFERED_BYTES, buffer_response
+
+#file locks are only needed to share results between processes
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+log = logging.getLogger('elmond')
+
+#Defaults for the COALESCE config
+#How long to wait for another caller before running it ourselves
+DEFAULT_COALESCE_TIMEOUT=60
+#How long a result file is kept for other processes
+DEFAULT_COALESCE_RESULT_TTL=60
+#How often to check if another process released a lock
+LOCK_POLL_INTERVAL=0.01
+
+class _Call:
+    '''
+    A call in flight that other threads can wait on
+    '''
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    '''
+    Coalesces identical calls that run at the same time. The first caller
+    with a key runs the function and everyone that asks for the same key
+    before it finishes gets the same result or exception. If lock_dir is set
+    it also works across processes, e.g. gunicorn workers, with a lock file
+    per key and the result saved to a file for the processes that waited.
+    Results shared between processes must be picklable.
+    '''
+
+    def __init__(self, timeout=DEFAULT_COALESCE_TIMEOUT, lock_dir=None, result_ttl=DEFAULT_COALESCE_RESULT_TTL, max_response_bytes=DEFAULT_MAX_BUFFERED_BYTES):
+        self.timeout = timeout
+        #responses are only shared if they are no bigger than this
+        self.max_response_bytes = max_response_bytes
+        self.lock_dir = lock_dir
+        self.result_ttl = result_ttl
+        if self.lock_dir:
+            if fcntl is None:
+                raise RuntimeError("Coalescing across processes requires fcntl file locks")
+            os.makedirs(self.lock_dir, exist_ok=True)
+        self.leaders = 0
+        self.shared = 0
+        self.timeouts = 0
+        self._calls = {}
+        self._async_calls = {}
+        self._lock = threading.Lock()
+        self._last_cleanup = time.time()
+
+    def do(self, key, func):
+        '''
+        Returns the result of func(), sharing it with any other callers of the
+        same key that are waiting
+        '''
+        with self._lock:
+            call = self._calls.get(key, None)
+            leader = (call is None)
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+                self.leaders += 1
+        if not leader:
+            if not call.done.wait(self.timeout):
+                log.warning("Timed out after {0}s waiting on {1}, running it again".format(self.timeout, key))
+                with self._lock:
+                    self.timeouts += 1
+                return func()
+            with self._lock:
+                self.shared += 1
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            if self.lock_dir:
+                call.result = self._do_shared(key, func)
+            else:
+                call.result = func()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        return call.result
+
+    async def do_async(self, key, func):
+        '''
+        Like do for a coroutine function run on one event loop. Only callers on
+        the same loop are coalesced. If the caller running func is cancelled
+        one of the others runs it instead.
+        '''
+        future = self._async_calls.get(key, None)
+        if future is not None:
+            try:
+                result = await asyncio.wait_for(asyncio.shield(future), self.timeout)
+            except asyncio.TimeoutError:
+                log.warning("Timed out after {0}s waiting on {1}, running it again".format(self.timeout, key))
+                with self._lock:
+                    self.timeouts += 1
+                return await func()
+            except asyncio.CancelledError:
+                #only the leader was cancelled if the future was
+                if not future.cancelled():
+                    raise
+                return await self.do_async(key, func)
+            with self._lock:
+                self.shared += 1
+            return result
+        future = asyncio.get_running_loop().create_future()
+        self._async_calls[key] = future
+        with self._lock:
+            self.leaders += 1
+        try:
+            result = await func()
+        except Exception as e:
+            future.set_exception(e)
+            #mark it retrieved so there's no warning when nobody was waiting
+            future.exception()
+            raise
+        except BaseException:
+            #e.g. cancelled, which is not an answer for anyone else
+            future.cancel()
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            del self._async_calls[key]
+
+        return result
+
+    def _paths(self, key):
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.lock_dir, "{0}.lock".format(name)), os.path.join(self.lock_dir, "{0}.result".format(name))
+
+    def _lock_file(self, lock_file):
+        '''
+        Locks lock_file, waiting up to timeout. Returns True if another process
+        had it locked.
+        '''
+        deadline = time.time() + self.timeout
+        waited = False
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return waited
+            except BlockingIOError:
+                if time.time() >= deadline:
+                    raise TimeoutError()
+                waited = True
+                time.sleep(LOCK_POLL_INTERVAL)
+
+    def _read_result(self, result_path, since):
+        try:
+            with open(result_path, "rb") as result_file:
+                if os.fstat(result_file.fileno()).st_mtime < since:
+                    return False, None
+                return True, pickle.load(result_file)
+        except FileNotFoundError:
+            return False, None
+        except Exception as e:
+            log.warning("Unable to read coalesced result {0}: {1}".format(result_path, e))
+            return False, None
+
+    def _write_result(self, result_path, result):
+        fd, tmp_path = tempfile.mkstemp(dir=self.lock_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                pickle.dump(result, tmp_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, result_path)
+        except Exception as e:
+            log.warning("Unable to save coalesced result {0}: {1}".format(result_path, e))
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+    def _cleanup(self):
+        '''
+        Removes result files other processes are done with
+        '''
+        now = time.time()
+        if (now - self._last_cleanup) < self.result_ttl:
+            return
+        self._last_cleanup = now
+        for entry in os.scandir(self.lock_dir):
+            if not entry.name.endswith(".result"):
+                continue
+            try:
+                if (now - entry.stat().st_mtime) <= self.result_ttl:
+                    continue
+                os.unlink(entry.path)
+                #the lock file goes too unless someone is holding it. at worst
+                # a process that opened it already runs the call again.
+                lock_path = "{0}.lock".format(entry.path[:-len(".result")])
+                with open(lock_path, "a") as lock_file:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    os.unlink(lock_path)
+            except OSError:
+                pass
+
+    def _do_shared(self, key, func):
+        '''
+        Runs func holding the lock file for key. If another process was
+        already running it then its result is used instead.
+        '''
+        lock_path, result_path = self._paths(key)
+        start = time.time()
+        with open(lock_path, "a") as lock_file:
+            try:
+                waited = self._lock_file(lock_file)
+            except TimeoutError:
+                log.warning("Timed out after {0}s waiting on lock for {1}, running it again".format(self.timeout, key))
+                with self._lock:
+                    self.timeouts += 1
+                return func()
+            try:
+                if waited:
+                    found, result = self._read_result(result_path, start)
+                    if found:
+                        with self._lock:
+                            self.shared += 1
+                        return result
+                result = func()
+                self._write_result(result_path, result)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        self._cleanup()
+
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": len(self._calls) + len(self._async_calls),
+                "leaders": self.leaders,
+                "shared": self.shared,
+                "timeouts": self.timeouts
+            }
+
+def read_response(response, max_bytes=None):
+    '''
+    Reads a response into a tuple that can be shared between callers and
+    turned back into a response by build_response. Returns the tuple and the
+    response to send, or None and a response that streams the body if it is
+    bigger than max_bytes.
+    '''
+    body, response = buffer_response(response, max_bytes=max_bytes)
+    if body is None:
+        return None, response
+    #the length is set again for the body
+    headers = [(k, v) for k, v in response.headers.items() if k.lower() != "content-length"]
+    return (body, response.status_code, headers), response
+
+def build_response(shared):
+    body, status, headers = shared
+    return Response(body, status=status, headers=headers)
+
+def coalesce_response(flight, key, build):
+    '''
+    Returns the response from build, sharing it with identical requests in
+    flight. Each caller gets its own copy of the response. Responses bigger
+    than the max_response_bytes of flight are streamed to the caller that 
+    built them and every other caller builds its own.
+    '''
+    if flight is None:
+        return build()
+    own = []
+    def run():
+        shared, response = read_response(build(), max_bytes=flight.max_response_bytes)
+        own.append(response)
+        return shared
+    shared = flight.do(key, run)
+    if own:
+        return own[0]
+    elif shared is None:
+        return build()
+    return build_response(shared)
@@ -0,0 +1,356 @@
+'''
+Caches stored in a SQLite file so every worker process on a host shares them
+and they survive restarts. SQLiteCache has the same interface as LRUCache so
+it can be used wherever one is.
+'''
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+#file locks are only needed to keep processes from doing the same work
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+log = logging.getLogger('elmond')
+
+#Defaults for the SHARED_CACHE config
+DEFAULT_SHARED_CACHE_PATH="/var/lib/elmond/cache.sqlite"
+#Seconds to wait for another process that is writing
+DEFAULT_SHARED_CACHE_TIMEOUT=5.0
+#Recently-used order is only updated if an entry wasn't used for this many
+# seconds, so reads don't all turn into writes
+DEFAULT_SHARED_CACHE_TOUCH_INTERVAL=60
+#Expired entries are skipped when read and deleted by the next write after
+# this many seconds
+DEFAULT_SHARED_CACHE_PURGE_INTERVAL=60
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS entries (
+        cache TEXT NOT NULL,
+        key TEXT NOT NULL,
+        value BLOB NOT NULL,
+        size INTEGER NOT NULL,
+        expires REAL,
+        used REAL NOT NULL,
+        UNIQUE (cache, key)
+    )''',
+    "CREATE INDEX IF NOT EXISTS entries_used ON entries (cache, used)",
+    "CREATE INDEX IF NOT EXISTS entries_expires ON entries (cache, expires)",
+    '''CREATE TABLE IF NOT EXISTS totals (
+        cache TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        bytes INTEGER NOT NULL
+    )'''
+]
+
+class SQLiteCacheStore:
+    '''
+    A SQLite file that holds any number of named caches. Each thread of each
+    process has its own connection.
+    '''
+
+    def __init__(self,
+                    path=DEFAULT_SHARED_CACHE_PATH,
+                    timeout=DEFAULT_SHARED_CACHE_TIMEOUT,
+                    touch_interval=DEFAULT_SHARED_CACHE_TOUCH_INTERVAL,
+                    purge_interval=DEFAULT_SHARED_CACHE_PURGE_INTERVAL
+                ):
+        self.path = path
+        self.timeout = timeout
+        self.touch_interval = touch_interval
+        self.purge_interval = purge_interval
+        self._local = threading.local()
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        conn = self.connection()
+        #readers don't block the writer and vice versa
+        conn.execute("PRAGMA journal_mode=WAL")
+        with self.transaction() as cur:
+            for statement in SCHEMA:
+                cur.execute(statement)
+
+    def connection(self):
+        #connections can't be used by a forked process
+        pid = os.getpid()
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != pid:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = pid
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Runs the block in a write transaction, committed if it doesn't raise
+        '''
+        conn = self.connection()
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            yield cur
+        except:
+            cur.execute("ROLLBACK")
+            raise
+        cur.execute("COMMIT")
+
+    def cache(self, name, **kwargs):
+        return SQLiteCache(self, name, **kwargs)
+
+class SQLiteCache:
+    '''
+    A cache in a SQLiteCacheStore with the interface of LRUCache. Values are
+    pickled. Entries are evicted least-recently-used once there are max_size
+    of them or, if max_bytes is set, the total of sizeof for each value goes
+    over it. Size and bytes are shared, the hit, miss and eviction counters
+    are for this process. Errors from SQLite are logged and treated as misses
+    so a broken file doesn't break requests.
+    '''
+
+    def __init__(self, store, name, max_size=1000, ttl=None, max_bytes=None, sizeof=len):
+        self.store = store
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.errors = 0
+        self._last_purge = 0
+        self._lock = threading.Lock()
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _error(self, action, e):
+        self._count("errors")
+        log.warning("Unable to {0} {1} cache in {2}: {3}".format(action, self.name, self.store.path, e))
+
+    def _read(self, key):
+        row = self.store.connection().execute(
+            "SELECT value, expires, used FROM entries WHERE cache = ? AND key = ?", (self.name, key)
+        ).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return None
+        return row
+
+    def get(self, key, default=None):
+        try:
+            row = self._read(key)
+            if row is None:
+                self._count("misses")
+                return default
+            now = time.time()
+            if row[2] < now - self.store.touch_interval:
+                self.store.connection().execute("UPDATE entries SET used = ? WHERE cache = ? AND key = ?", (now, self.name, key))
+            value = pickle.loads(row[0])
+        except (sqlite3.Error, pickle.UnpicklingError) as e:
+            self._error("read from", e)
+            return default
+        self._count("hits")
+        return value
+
+    def peek(self, key, default=None):
+        '''
+        Returns the value for key like get but does not affect the
+        recently-used order or the hit/miss counters
+        '''
+        try:
+            row = self._read(key)
+            if row is None:
+                return default
+            return pickle.loads(row[0])
+        except (sqlite3.Error, pickle.UnpicklingError) as e:
+            self._error("read from", e)
+            return default
+
+    def _remove(self, cur, key):
+        row = cur.execute("SELECT size FROM entries WHERE cache = ? AND key = ?", (self.name, key)).fetchone()
+        if row is None:
+            return
+        cur.execute("DELETE FROM entries WHERE cache = ? AND key = ?", (self.name, key))
+        self._add_totals(cur, -1, -row[0])
+
+    def _add_totals(self, cur, size, nbytes):
+        cur.execute("INSERT OR IGNORE INTO totals (cache, size, bytes) VALUES (?, 0, 0)", (self.name,))
+        cur.execute("UPDATE totals SET size = size + ?, bytes = bytes + ? WHERE cache = ?", (size, nbytes, self.name))
+
+    def _full(self, size, nbytes):
+        if self.max_size and size > self.max_size:
+            return True
+        return bool(self.max_bytes) and nbytes > self.max_bytes
+
+    def _write(self, cur, key, value, ttl):
+        if ttl is None:
+            ttl = self.ttl
+        expires = None
+        if ttl:
+            expires = time.time() + ttl
+        size = 0
+        if self.max_bytes:
+            size = self.sizeof(value)
+        self._remove(cur, key)
+        if self.max_bytes and size > self.max_bytes:
+            #would evict everything else and still not fit
+            return
+        cur.execute(
+            "INSERT INTO entries (cache, key, value, size, expires, used) VALUES (?, ?, ?, ?, ?, ?)",
+            (self.name, key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), size, expires, time.time())
+        )
+        self._add_totals(cur, 1, size)
+        total_size, total_bytes = cur.execute("SELECT size, bytes FROM totals WHERE cache = ?", (self.name,)).fetchone()
+        evicted = 0
+        while self._full(total_size, total_bytes):
+            rows = cur.execute(
+                "SELECT key, size FROM entries WHERE cache = ? ORDER BY used LIMIT ?", (self.name, max(total_size - (self.max_size or total_size), 1))
+            ).fetchall()
+            if not rows:
+                break
+            for evict_key, evict_size in rows:
+                if not self._full(total_size, total_bytes):
+                    break
+                cur.execute("DELETE FROM entries WHERE cache = ? AND key = ?", (self.name, evict_key))
+                total_size -= 1
+                total_bytes -= evict_size
+                evicted += 1
+        if evicted:
+            cur.execute("UPDATE totals SET size = ?, bytes = ? WHERE cache = ?", (total_size, total_bytes, self.name))
+            with self._lock:
+                self.evictions += evicted
+
+    def _purge(self, cur):
+        now = time.time()
+        with self._lock:
+            if (now - self._last_purge) < self.store.purge_interval:
+                return
+            self._last_purge = now
+        size, nbytes = cur.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries WHERE cache = ? AND expires < ?", (self.name, now)
+        ).fetchone()
+        if size:
+            cur.execute("DELETE FROM entries WHERE cache = ? AND expires < ?", (self.name, now))
+            self._add_totals(cur, -size, -nbytes)
+
+    def set(self, key, value, ttl=None):
+        self.set_many([(key, value)], ttl=ttl)
+
+    def set_many(self, items, ttl=None):
+        '''
+        Sets each (key, value) pair in items in one transaction
+        '''
+        try:
+            with self.store.transaction() as cur:
+                self._purge(cur)
+                for key, value in items:
+                    self._write(cur, key, value, ttl)
+        except sqlite3.Error as e:
+            self._error("write to", e)
+
+    def incr(self, key, amount=1):
+        '''
+        Adds amount to the number stored under key in one transaction, so
+        every process gets a different result. Returns the new value.
+        '''
+        try:
+            with self.store.transaction() as cur:
+                row = cur.execute("SELECT value FROM entries WHERE cache = ? AND key = ?", (self.name, key)).fetchone()
+                value = (pickle.loads(row[0]) if row is not None else 0) + amount
+                self._write(cur, key, value, None)
+            return value
+        except (sqlite3.Error, pickle.UnpicklingError) as e:
+            self._error("write to", e)
+            return None
+
+    def delete(self, key):
+        self.delete_many([key])
+
+    def delete_many(self, keys):
+        try:
+            with self.store.transaction() as cur:
+                for key in keys:
+                    self._remove(cur, key)
+        except sqlite3.Error as e:
+            self._error("delete from", e)
+
+    def clear(self):
+        try:
+            with self.store.transaction() as cur:
+                cur.execute("DELETE FROM entries WHERE cache = ?", (self.name,))
+                cur.execute("DELETE FROM totals WHERE cache = ?", (self.name,))
+        except sqlite3.Error as e:
+            self._error("clear", e)
+
+    def items(self):
+        '''
+        Returns a list of (key, value) pairs that have not expired. Does not
+        affect the recently-used order or the hit/miss counters.
+        '''
+        try:
+            rows = self.store.connection().execute(
+                "SELECT key, value FROM entries WHERE cache = ? AND (expires IS NULL OR expires >= ?)", (self.name, time.time())
+            ).fetchall()
+            return [(k, pickle.loads(v)) for k, v in rows]
+        except (sqlite3.Error, pickle.UnpicklingError) as e:
+            self._error("read from", e)
+            return []
+
+    @contextmanager
+    def lock(self, blocking=True):
+        '''
+        Holds a lock for this cache across processes. Yields False if blocking
+        is False and another process or thread has it.
+        '''
+        if fcntl is None:
+            yield True
+            return
+        with open("{0}.{1}.lock".format(self.store.path, self.name), "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _totals(self):
+        try:
+            row = self.store.connection().execute("SELECT size, bytes FROM totals WHERE cache = ?", (self.name,)).fetchone()
+        except sqlite3.Error as e:
+            self._error("read from", e)
+            row = None
+        return row or (0, 0)
+
+    def stats(self):
+        size, nbytes = self._totals()
+        with self._lock:
+            return {
+                "size": size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "bytes": nbytes,
+                "errors": self.errors
+            }
+
+    def __contains__(self, key):
+        try:
+            return self._read(key) is not None
+        except sqlite3.Error as e:
+            self._error("read from", e)
+            return False
+
+    def __len__(self):
+        return self._totals()[0]
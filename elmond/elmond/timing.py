@@ -0,0 +1,75 @@
+'''
+Time spent on each step of a request, kept in flask.g and written in the
+Server-Timing header
+'''
+import time
+from flask import g, has_app_context
+
+#Steps in the order they are written in the header
+TIMING_FILTERS = "filters"
+TIMING_DNS = "dns"
+TIMING_ES = "es"
+TIMING_ES_TOOK = "es-took"
+TIMING_PARSE = "parse"
+TIMING_SERIALIZE = "serialize"
+TIMING_NAMES = [TIMING_FILTERS, TIMING_DNS, TIMING_ES, TIMING_ES_TOOK, TIMING_PARSE, TIMING_SERIALIZE]
+TIMING_DESCRIPTIONS = {
+    TIMING_FILTERS: "Building filters",
+    TIMING_DNS: "DNS lookups",
+    TIMING_ES: "Elasticsearch wall time",
+    TIMING_ES_TOOK: "Elasticsearch took",
+    TIMING_PARSE: "Parsing hits",
+    TIMING_SERIALIZE: "Serializing response"
+}
+
+def add_timing(name, seconds):
+    '''
+    Adds seconds to the time the current request has spent on name. Does
+    nothing outside of a request.
+    '''
+    if not has_app_context():
+        return
+    timings = g.setdefault("timings", {})
+    timings[name] = timings.get(name, 0.0) + seconds
+
+def get_timings():
+    '''
+    Returns a map of step name to seconds for the current request
+    '''
+    if not has_app_context():
+        return {}
+    return g.get("timings", {})
+
+class Timer:
+    '''
+    Context manager that adds the time spent in its block to name
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        add_timing(self.name, time.time() - self.start)
+        return False
+
+def build_server_timing(timings, total=None):
+    '''
+    Returns the value of a Server-Timing header for timings in seconds.
+    Durations are in milliseconds.
+    '''
+    entries = []
+    for name in TIMING_NAMES + sorted(n for n in timings if n not in TIMING_NAMES):
+        if name not in timings:
+            continue
+        entry = "{0};dur={1:.3f}".format(name, timings[name] * 1000)
+        if name in TIMING_DESCRIPTIONS:
+            entry += ';desc="{0}"'.format(TIMING_DESCRIPTIONS[name])
+        entries.append(entry)
+    if total is not None:
+        entries.append("total;dur={0:.3f}".format(total * 1000))
+    return ", ".join(entries)
@@ -1,3 +1,5 @@
+import base64
+import json
 import logging
 import datetime
 import dateutil.parser
@@ -17,6 +19,10 @@ TIME_END_FILTER = "time-end"
 TIME_RANGE_FILTER = "time-range"
 LIMIT_FILTER = "limit"
 OFFSET_FILTER = "offset"
+CURSOR_FILTER = "cursor"
+STREAM_FILTER = "stream"
+PRETTY_FILTER = "pretty"
+PROFILE_FILTER = "profile"
 
 def iso8601_to_seconds(val):
     """Convert an ISO 8601 string to a timdelta"""
@@ -68,6 +74,21 @@ def lookup_hostname(host, family):
     
     return addr
 
+def encode_cursor(obj):
+    """Encode a paging position as an opaque, URL-safe token"""
+    text = json.dumps(obj, sort_keys=True, separators=(',', ':'))
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii')
+
+def decode_cursor(token):
+    """Decode a token built by encode_cursor. Raises BadRequest if invalid"""
+    try:
+        obj = json.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+    except Exception:
+        raise BadRequest("Invalid {0} parameter".format(CURSOR_FILTER))
+    if not isinstance(obj, dict):
+        raise BadRequest("Invalid {0} parameter".format(CURSOR_FILTER))
+    return obj
+
 def valid_time(t):
     try:
         t = int(t)
@@ -0,0 +1,9 @@
+'''
+Entry point for WSGI servers. In production elmond is served by gunicorn with
+the settings in gunicorn.conf.py:
+
+    gunicorn --config gunicorn.conf.py wsgi:app
+'''
+from app import create_app
+
+app = create_app()
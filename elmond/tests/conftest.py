@@ -0,0 +1,78 @@
+import os
+import sys
+
+import pytest
+from flask import Flask
+
+#elmond modules import each other by name like they do in the container
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "elmond"))
+
+def md_source(i):
+    ip = "10.0.0.{0}".format(i % 250)
+    return {
+        "test": { "type": "latencybg", "spec": { "source": ip, "dest": "10.0.1.1", "packet-count": 600 } },
+        "meta": { "observer": { "ip": ip }, "source": { "ip": ip }, "destination": { "ip": "10.0.1.1" } },
+        "pscheduler": { "tool": "owping", "duration": "PT60S", "added": "2020-05-01T00:00:00Z", "start_time": "2020-05-01T00:00:00Z", "test_checksum": "cs{0:05d}".format(i) },
+        "reference": { "foo": "bar" }
+    }
+
+class FakeMetadataES:
+    '''
+    Answers the composite aggregation metadata searches with num_tests tests
+    '''
+
+    def __init__(self, num_tests=50):
+        self.num_tests = num_tests
+        self.searches = 0
+
+    def search(self, index=None, body=None, **kwargs):
+        self.searches += 1
+        tests_agg = body["aggs"]["tests"]
+        after = tests_agg["composite"].get("after", {}).get("checksum", "")
+        keys = ["cs{0:05d}".format(i) for i in range(self.num_tests)]
+        keys = [k for k in keys if k > after][:tests_agg["composite"]["size"]]
+        buckets = []
+        for key in keys:
+            bucket = { "key": { "checksum": key }, "doc_count": 1 }
+            if "aggs" in tests_agg:
+                bucket["test_params"] = { "hits": { "hits": [{ "_index": "pscheduler_latencybg-2020.05.01", "_source": md_source(int(key[2:])) }] } }
+                bucket["latest_test"] = { "value": 1588291200000 }
+            buckets.append(bucket)
+        tests = { "buckets": buckets }
+        if keys:
+            tests["after_key"] = { "checksum": keys[-1] }
+        return { "took": 1, "aggregations": { "tests_total_count": { "value": self.num_tests }, "tests": tests } }
+
+class FakeMetadataIndexES:
+    '''
+    Answers searches of the metadata index with num_tests tests. Like elastic
+    it refuses to page past max_result_window with from.
+    '''
+
+    def __init__(self, num_tests=50, max_result_window=10000):
+        self.num_tests = num_tests
+        self.max_result_window = max_result_window
+        self.searches = 0
+
+    def search(self, index=None, body=None, **kwargs):
+        self.searches += 1
+        start = body.get("from", 0)
+        if start + body["size"] > self.max_result_window:
+            raise RuntimeError("Result window is too large")
+        after = body.get("search_after", [""])[0]
+        keys = ["cs{0:05d}".format(i) for i in range(self.num_tests)]
+        keys = [k for k in keys if k > after][start:start + body["size"]]
+        hits = []
+        for key in keys:
+            hit = { "_id": key }
+            if body.get("_source", True):
+                hit["_source"] = md_source(int(key[2:]))
+            hits.append(hit)
+        return { "took": 1, "hits": { "total": { "value": self.num_tests }, "hits": hits } }
+
+@pytest.fixture
+def flask_app():
+    app = Flask("elmond-tests")
+    app.config["ELMOND"] = {}
+    with app.app_context():
+        yield app
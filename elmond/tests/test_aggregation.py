@@ -0,0 +1,61 @@
+import datetime
+
+import pytest
+from aggregation import AGGREGATION_NAME, ROLLUP_TIME_FIELD, aggregation_hits, build_aggregation, build_window_filter, check_window_count
+from werkzeug.exceptions import BadRequest
+
+def test_window_count(flask_app):
+    flask_app.config["ELMOND"]["MAX_AGGREGATION_BUCKETS"] = 100
+    assert check_window_count(10) == 10
+    assert check_window_count(10, result_offset=90) == 100
+    #no limit aggregates as many windows as allowed
+    assert check_window_count(None) == 100
+    assert check_window_count(None, result_offset=50) == 100
+
+@pytest.mark.parametrize("size,offset", [(101, 0), (10, 91), (None, 100), (1, 100)])
+def test_window_count_too_many(flask_app, size, offset):
+    flask_app.config["ELMOND"]["MAX_AGGREGATION_BUCKETS"] = 100
+    with pytest.raises(BadRequest):
+        check_window_count(size, result_offset=offset)
+
+def test_window_count_default(flask_app):
+    assert check_window_count(1000) == 1000
+    with pytest.raises(BadRequest):
+        check_window_count(10001)
+
+def test_window_filter_aligned(flask_app):
+    range_dsl = build_window_filter({ "time-start": "1000", "time-end": "2000" }, 300)
+    time_range = range_dsl["range"]["pscheduler.start_time"]
+    #windows that start in the range, each of them whole
+    assert time_range["gte"] == datetime.datetime.utcfromtimestamp(1200)
+    assert time_range["lt"] == datetime.datetime.utcfromtimestamp(2100)
+
+def test_window_filter_on_boundary(flask_app):
+    time_range = build_window_filter({ "time-start": "900", "time-end": "1800" }, 300)["range"]["pscheduler.start_time"]
+    assert time_range["gte"] == datetime.datetime.utcfromtimestamp(900)
+    assert time_range["lt"] == datetime.datetime.utcfromtimestamp(2100)
+
+def test_window_filter_open_ended(flask_app):
+    time_range = build_window_filter({ "time-start": "1000" }, 300)["range"]["pscheduler.start_time"]
+    assert "lt" not in time_range
+    assert build_window_filter({}, 300) is None
+
+def test_build_aggregation():
+    metrics = [("f.avg.value", "sum", "f"), ("f.avg._count", "value_count", "f")]
+    aggs = build_aggregation(metrics, 600, 50)
+    composite = aggs[AGGREGATION_NAME]["composite"]
+    assert composite["size"] == 50
+    assert composite["sources"] == [{ "ts": { "date_histogram": { "field": "pscheduler.start_time", "fixed_interval": "600s" } } }]
+    assert aggs[AGGREGATION_NAME]["aggs"] == { "m0": { "sum": { "field": "f" } }, "m1": { "value_count": { "field": "f" } } }
+
+def test_aggregation_hits():
+    metrics = [("f.avg.value", "sum", "f"), ("f.avg._count", "value_count", "f")]
+    buckets = [{ "key": { "ts": i * 600000 }, "m0": { "value": i * 2.0 }, "m1": { "value": 2 } } for i in range(5)]
+    res = { "aggregations": { AGGREGATION_NAME: { "buckets": buckets } } }
+    hits = aggregation_hits(res, metrics, result_size=2, result_offset=1)
+    assert hits == [
+        { "_source": { ROLLUP_TIME_FIELD: 600000, "f.avg.value": 2.0, "f.avg._count": 2 } },
+        { "_source": { ROLLUP_TIME_FIELD: 1200000, "f.avg.value": 4.0, "f.avg._count": 2 } }
+    ]
+    assert len(aggregation_hits(res, metrics)) == 5
+    assert aggregation_hits({}, metrics) == []
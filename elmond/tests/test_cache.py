@@ -0,0 +1,100 @@
+import time
+
+from cache import LRUCache
+from conftest import FakeMetadataES
+from metadata import EsmondMetadata, EsmondMetadataCache
+
+def test_lru_evicts_least_recently_used():
+    cache = LRUCache(max_size=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert "b" not in cache
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.evictions == 1
+
+def test_peek_does_not_change_order():
+    cache = LRUCache(max_size=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.peek("a") == 1
+    cache.set("c", 3)
+    assert "a" not in cache
+
+def test_max_bytes():
+    cache = LRUCache(max_size=None, max_bytes=10)
+    cache.set("a", b"12345")
+    cache.set("b", b"12345")
+    cache.set("c", b"1")
+    assert "a" not in cache
+    assert cache.bytes == 6
+    #too big to ever fit
+    cache.set("d", b"12345678901")
+    assert "d" not in cache
+
+def test_ttl_expires():
+    cache = LRUCache(ttl=0.05)
+    cache.set("a", 1)
+    cache.set("b", 2, ttl=60)
+    assert cache.get("a") == 1
+    time.sleep(0.1)
+    assert cache.get("a") is None
+    assert "a" not in cache
+    assert cache.get("b") == 2
+    assert cache.items() == [("b", 2)]
+
+def test_set_many_counts_evictions():
+    cache = LRUCache(max_size=3)
+    cache.set_many([(str(i), i) for i in range(5)])
+    assert [k for k, v in cache.items()] == ["2", "3", "4"]
+    assert cache.evictions == 2
+
+def test_metadata_complete_when_everything_fits(flask_app):
+    md_cache = EsmondMetadataCache(FakeMetadataES(num_tests=50), max_size=100)
+    md_cache._refresh_due()
+    assert md_cache.complete
+    assert md_cache.answers({})
+    assert len(md_cache.list({})) == 50
+
+def test_metadata_incomplete_after_load_evicts(flask_app):
+    md_cache = EsmondMetadataCache(FakeMetadataES(num_tests=50), max_size=10)
+    md_cache._refresh_due()
+    assert not md_cache.complete
+    assert not md_cache.answers({})
+    assert md_cache.list({}) is None
+
+def test_metadata_incomplete_after_put_evicts(flask_app):
+    md_cache = EsmondMetadataCache(FakeMetadataES(num_tests=10), max_size=10)
+    md_cache._refresh_due()
+    assert md_cache.complete
+    version = md_cache.version
+    md_cache.put("new", { "metadata-key": "new" })
+    assert not md_cache.complete
+    assert md_cache.version > version
+
+def _unloaded_cache(es):
+    md_cache = EsmondMetadataCache(es, max_size=100)
+    #not due for a load so searches go to elastic
+    md_cache.loaded = md_cache.last_refresh = time.time()
+    return md_cache
+
+def test_search_fills_cache_in_one_change(flask_app):
+    es = FakeMetadataES(num_tests=5)
+    md_cache = _unloaded_cache(es)
+    metadata = EsmondMetadata(es, cache=md_cache).search(q={})
+    assert len(metadata) == 5
+    assert len(md_cache.entries) == 5
+    assert md_cache.version == 1
+    #the same results don't change anything
+    EsmondMetadata(es, cache=md_cache).search(q={})
+    assert md_cache.version == 1
+
+def test_time_filtered_search_not_cached(flask_app):
+    es = FakeMetadataES(num_tests=5)
+    md_cache = _unloaded_cache(es)
+    metadata = EsmondMetadata(es, cache=md_cache).search(q={ "time-start": "1588291200", "time-end": "1588294800" })
+    assert len(metadata) == 5
+    assert len(md_cache.entries) == 0
+    assert md_cache.version == 0
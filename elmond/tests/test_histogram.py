@@ -0,0 +1,62 @@
+import pytest
+from histogram import Histogram, merge, to_esmond_stats
+
+#histograms and the statistics pscheduler_histogram.rb calculates for them,
+# without the histogram it stores with them
+RUBY_STATS = [
+    (
+        {"1": 1, "2": 1, "3": 1},
+        {"mode": [1.0, 2.0, 3.0], "mean": 2.0, "min": 1.0, "max": 3.0, "p_25": 1.0, "median": 2.0, "p_75": 3.0, "p_95": 3.0, "variance": 0.6666666666666666, "stddev": 0.816496580927726}
+    ),
+    (
+        {"0.5": 3, "1.25": 10, "2": 7, "10": 1},
+        {"mode": [1.25], "mean": 1.8095238095238095, "min": 0.5, "max": 10.0, "p_25": 1.25, "median": 1.25, "p_75": 2.0, "p_95": 9.199999999999989, "variance": 3.60062358276644, "stddev": 1.8975309174731356}
+    ),
+    (
+        {"5": 2, "7": 2},
+        {"mode": [5.0, 7.0], "mean": 6.0, "min": 5.0, "max": 7.0, "p_25": 5.0, "median": 6.0, "p_75": 7.0, "p_95": 7.0, "variance": 1.0, "stddev": 1.0}
+    ),
+    (
+        {"42": 1},
+        {"mode": [42.0], "mean": 42.0, "min": 42.0, "max": 42.0, "p_25": 42.0, "median": 42.0, "p_75": 42.0, "p_95": 42.0, "variance": 0.0, "stddev": 0.0}
+    ),
+    (
+        {"19.3": 4, "19.5": 17, "19.7": 33, "19.9": 61, "20.1": 29, "20.3": 11, "20.9": 2, "24.2": 1, "31.7": 1, "0.81": 1},
+        {"mode": [19.9], "mean": 19.858812500000003, "min": 0.81, "max": 31.7, "p_25": 19.7, "median": 19.9, "p_75": 20.1, "p_95": 20.3, "variance": 3.3267917148437505, "stddev": 1.823949482536112}
+    )
+]
+
+def to_elastic(hist):
+    #the order logstash stores them in doesn't matter
+    return { "values": [float(k) for k in hist], "counts": list(hist.values()) }
+
+@pytest.mark.parametrize("hist,expected", RUBY_STATS)
+def test_stats_match_ruby(hist, expected):
+    assert Histogram.from_elastic(to_elastic(hist)).stats() == expected
+
+def test_empty_histogram():
+    assert Histogram.from_elastic({ "values": [], "counts": [] }).stats() == {}
+
+def test_invalid_histogram():
+    assert Histogram.from_elastic({ "values": [1.0], "counts": [1, 2] }) is None
+    assert Histogram.from_elastic("nope") is None
+
+def test_duplicate_buckets_combined():
+    histo = Histogram.from_elastic({ "values": [2.0, 1.0, 2.0], "counts": [1, 1, 1] })
+    assert histo.values.tolist() == [1.0, 2.0]
+    assert histo.counts.tolist() == [1, 2]
+
+def test_merge_matches_combined_histogram():
+    hist, expected = RUBY_STATS[4]
+    items = list(hist.items())
+    first = Histogram.from_elastic(to_elastic(dict(items[:5])))
+    second = Histogram.from_elastic(to_elastic(dict(items[5:])))
+    assert merge([first, second]).stats() == expected
+
+def test_esmond_stats_converted_after_calculating():
+    hist, expected = RUBY_STATS[1]
+    stats = to_esmond_stats(Histogram.from_elastic(to_elastic(hist)).stats(), conversion_factor=1000)
+    #the same as converting the stored statistics
+    assert stats["percentile-95"] == expected["p_95"] * 1000
+    assert stats["standard-deviation"] == expected["stddev"] * 1000
+    assert stats["mode"] == [1250.0]
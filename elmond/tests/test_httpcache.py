@@ -0,0 +1,92 @@
+import time
+from unittest import mock
+
+import app as appmod
+import pytest
+from flask import Flask, Response
+from httpcache import EMPTY_RESULTS_HEADER, ResponseCache
+
+#a day of results that ended a week ago
+CLOSED = { "time-start": str(int(time.time()) - 8 * 86400), "time-end": str(int(time.time()) - 7 * 86400) }
+
+class FakeDataES:
+    '''
+    Answers data searches with num_hits throughput results and counts them
+    '''
+
+    def __init__(self, num_hits=3):
+        self.num_hits = num_hits
+        self.searches = []
+
+    def search(self, index=None, body=None, **kwargs):
+        self.searches.append(body)
+        hits = [{ "_source": { "pscheduler": { "start_time": "2020-05-01T00:0{0}:00Z".format(i) }, "result": { "throughput": 1e9 } } } for i in range(self.num_hits)]
+        res = { "took": 1, "hits": { "total": { "value": len(hits) }, "hits": hits[:body.get("size", 10)] } }
+        if "newest" in body.get("aggs", {}):
+            res["aggregations"] = { "newest": { "value": 1588291200000 } }
+        return res
+
+def build_client(es, response_cache={}):
+    with mock.patch.object(appmod, "build_elastic", lambda *args, **kwargs: es):
+        app = appmod.create_app(test_config={ "ELASTIC_HOSTS": ["localhost"], "METADATA_CACHE": { "enabled": False }, "RESPONSE_CACHE": response_cache })
+    return app.test_client()
+
+@pytest.fixture
+def request_context():
+    app = Flask("elmond-tests")
+    with app.test_request_context("/"):
+        yield
+
+def test_closed_window_cached(request_context):
+    cache = ResponseCache()
+    response = cache.store("etag", Response(iter([b"[1]"]), mimetype="application/json"), closed=True)
+    assert response.headers["Cache-Control"] == "public, max-age=86400"
+    cached = cache.lookup("etag", closed=True)
+    assert cached.get_data() == b"[1]"
+    assert "immutable" not in cached.headers["Cache-Control"]
+
+def test_empty_closed_window_cached_like_open(request_context):
+    cache = ResponseCache()
+    response = Response(b"[]", mimetype="application/json")
+    response.headers[EMPTY_RESULTS_HEADER] = "1"
+    response = cache.store("etag", response, closed=True)
+    assert EMPTY_RESULTS_HEADER not in response.headers
+    assert response.headers["Cache-Control"] == "no-cache"
+    assert cache.lookup("etag", closed=True).headers["Cache-Control"] == "no-cache"
+
+def test_big_responses_streamed_not_cached(request_context):
+    cache = ResponseCache(max_entry_bytes=10)
+    response = cache.store("etag", Response(iter([b"x" * 8, b"y" * 8]), mimetype="application/json"), closed=True)
+    assert response.get_data() == b"x" * 8 + b"y" * 8
+    assert cache.lookup("etag", closed=True) is None
+
+def test_open_window_not_versioned_by_default():
+    es = FakeDataES()
+    client = build_client(es)
+    response = client.get("/abc/throughput/base/0")
+    assert response.status_code == 200
+    assert len(es.searches) == 1
+    assert "ETag" not in response.headers
+
+def test_open_window_versioned_when_enabled():
+    es = FakeDataES()
+    client = build_client(es, response_cache={ "open_windows": True })
+    etag = client.get("/abc/throughput/base/0").headers["ETag"]
+    assert len(es.searches) == 2
+    assert client.get("/abc/throughput/base/0", headers={ "If-None-Match": etag }).status_code == 304
+    assert len(es.searches) == 3
+
+def test_closed_window_answered_from_cache():
+    es = FakeDataES()
+    client = build_client(es)
+    assert client.get("/abc/throughput/base/0", query_string=CLOSED).status_code == 200
+    assert client.get("/abc/throughput/base/0", query_string=CLOSED).status_code == 200
+    assert len(es.searches) == 1
+
+def test_empty_closed_window_not_kept_long():
+    es = FakeDataES(num_hits=0)
+    client = build_client(es)
+    response = client.get("/abc/throughput/base/0", query_string=CLOSED)
+    assert response.get_data() == b"[]\n"
+    assert response.headers["Cache-Control"] == "no-cache"
+    assert EMPTY_RESULTS_HEADER not in response.headers
@@ -0,0 +1,28 @@
+import pytest
+from conftest import FakeMetadataIndexES
+from metadata import EsmondMetadata, METADATA_SOURCE_INDEX
+
+@pytest.fixture
+def index_app(flask_app):
+    flask_app.config["ELMOND"]["METADATA_SOURCE"] = METADATA_SOURCE_INDEX
+    return flask_app
+
+def _checksums(metadata):
+    return [md["metadata-key"] for md in metadata]
+
+def test_index_offset_uses_from(index_app):
+    es = FakeMetadataIndexES(num_tests=50)
+    metadata = EsmondMetadata(es).search(q={ "limit": "5", "offset": "10" })
+    assert _checksums(metadata) == ["cs{0:05d}".format(i) for i in range(10, 15)]
+    assert es.searches == 1
+
+def test_index_offset_past_result_window(index_app):
+    es = FakeMetadataIndexES(num_tests=25000)
+    metadata = EsmondMetadata(es).search(q={ "limit": "5", "offset": "21000" })
+    assert _checksums(metadata) == ["cs{0:05d}".format(i) for i in range(21000, 21005)]
+    #three pages of ids to skip then the page itself
+    assert es.searches == 4
+
+def test_index_offset_past_last_test(index_app):
+    es = FakeMetadataIndexES(num_tests=12000)
+    assert EsmondMetadata(es).search(q={ "limit": "5", "offset": "15000" }) == []
@@ -0,0 +1,27 @@
+import resolver
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+def test_concurrent_misses_share_lookup(monkeypatch):
+    release = threading.Event()
+    calls = []
+    def lookup_hostname(host, family):
+        calls.append((host, family))
+        release.wait(5)
+        return "10.0.0.1"
+    monkeypatch.setattr(resolver, "lookup_hostname", lookup_hostname)
+    res = resolver.Resolver()
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        futures = [pool.submit(res.resolve, "ps.example.net", [socket.AF_INET]) for i in range(8)]
+        deadline = time.time() + 5
+        while res.stats()["shared"] < 7 and time.time() < deadline:
+            time.sleep(0.01)
+        release.set()
+        results = [f.result() for f in futures]
+    assert calls == [("ps.example.net", socket.AF_INET)]
+    assert all(r == { socket.AF_INET: "10.0.0.1" } for r in results)
+    #the next caller gets it from the cache
+    assert res.resolve("ps.example.net", [socket.AF_INET]) == { socket.AF_INET: "10.0.0.1" }
+    assert res.stats()["lookups"] == 1
@@ -0,0 +1,154 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from flask import Flask, Response
+from singleflight import SingleFlight, coalesce_response
+
+def run_threads(num, target):
+    threads = [threading.Thread(target=target) for i in range(num)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+
+def test_concurrent_calls_coalesced():
+    flight = SingleFlight()
+    calls = []
+    results = []
+    def slow():
+        calls.append(1)
+        time.sleep(0.2)
+        return "result"
+    run_threads(10, lambda: results.append(flight.do("key", slow)))
+    assert results == ["result"] * 10
+    assert len(calls) == 1
+    stats = flight.stats()
+    assert stats["leaders"] == 1
+    assert stats["shared"] == 9
+    assert stats["in_flight"] == 0
+
+def test_different_keys_not_coalesced():
+    flight = SingleFlight()
+    assert flight.do("a", lambda: 1) == 1
+    assert flight.do("b", lambda: 2) == 2
+    assert flight.stats()["leaders"] == 2
+
+def test_error_shared():
+    flight = SingleFlight()
+    errors = []
+    def fail():
+        time.sleep(0.2)
+        raise ValueError("nope")
+    def call():
+        try:
+            flight.do("key", fail)
+        except ValueError as e:
+            errors.append(e)
+    run_threads(5, call)
+    assert len(errors) == 5
+    assert len(set(id(e) for e in errors)) == 1
+    #the next call runs again
+    assert flight.do("key", lambda: "ok") == "ok"
+
+def test_timeout_runs_again():
+    flight = SingleFlight(timeout=0.05)
+    results = []
+    def slow():
+        time.sleep(0.3)
+        return "slow"
+    leader = threading.Thread(target=lambda: results.append(flight.do("key", slow)))
+    leader.start()
+    time.sleep(0.05)
+    assert flight.do("key", lambda: "fast") == "fast"
+    leader.join(10)
+    assert results == ["slow"]
+    assert flight.stats()["timeouts"] == 1
+
+def test_shared_between_processes(tmp_path):
+    flight = SingleFlight(lock_dir=str(tmp_path))
+    assert flight.do("key", lambda: { "a": 1 }) == { "a": 1 }
+
+def test_async_coalesced():
+    flight = SingleFlight()
+    calls = []
+    async def slow():
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        return "result"
+    async def main():
+        return await asyncio.gather(*[flight.do_async("key", slow) for i in range(10)])
+    assert asyncio.run(main()) == ["result"] * 10
+    assert len(calls) == 1
+
+def test_async_error_shared():
+    flight = SingleFlight()
+    async def fail():
+        await asyncio.sleep(0.1)
+        raise ValueError("nope")
+    async def main():
+        return await asyncio.gather(*[flight.do_async("key", fail) for i in range(3)], return_exceptions=True)
+    results = asyncio.run(main())
+    assert all(isinstance(r, ValueError) for r in results)
+
+def test_async_leader_cancelled():
+    flight = SingleFlight()
+    calls = []
+    async def slow():
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        return "result"
+    async def main():
+        leader = asyncio.ensure_future(flight.do_async("key", slow))
+        await asyncio.sleep(0)
+        followers = [asyncio.ensure_future(flight.do_async("key", slow)) for i in range(5)]
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await asyncio.gather(*followers)
+    #one of the followers takes over instead of each running it
+    assert asyncio.run(main()) == ["result"] * 5
+    assert len(calls) == 2
+
+def test_async_follower_cancelled():
+    flight = SingleFlight()
+    async def slow():
+        await asyncio.sleep(0.1)
+        return "result"
+    async def main():
+        leader = asyncio.ensure_future(flight.do_async("key", slow))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flight.do_async("key", slow))
+        await asyncio.sleep(0.01)
+        follower.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await follower
+        return await leader
+    assert asyncio.run(main()) == "result"
+
+def _coalesced_responses(flight, body_size):
+    app = Flask("elmond-tests")
+    builds = []
+    bodies = []
+    def build():
+        builds.append(1)
+        time.sleep(0.2)
+        return Response(iter([b"x" * body_size, b"y" * body_size]))
+    def call():
+        with app.test_request_context("/"):
+            bodies.append(coalesce_response(flight, "key", build).get_data())
+    run_threads(5, call)
+    return builds, bodies
+
+def test_small_responses_shared():
+    builds, bodies = _coalesced_responses(SingleFlight(max_response_bytes=1000), 10)
+    assert len(builds) == 1
+    assert bodies == [b"x" * 10 + b"y" * 10] * 5
+
+def test_big_responses_streamed_not_shared():
+    builds, bodies = _coalesced_responses(SingleFlight(max_response_bytes=1000), 1000)
+    #the leader streams what it built and everyone else builds their own
+    assert len(builds) == 5
+    assert bodies == [b"x" * 1000 + b"y" * 1000] * 5
@@ -0,0 +1,100 @@
+import multiprocessing
+import sqlite3
+import time
+
+import pytest
+from conftest import FakeMetadataES
+from metadata import EsmondMetadataCache
+from sqlitecache import SQLiteCacheStore
+
+#each test process opens the file itself like a gunicorn worker
+fork = multiprocessing.get_context("fork")
+
+def run_in_process(func, *args):
+    process = fork.Process(target=func, args=args)
+    process.start()
+    process.join(30)
+    assert process.exitcode == 0
+
+def _write_entries(path):
+    store = SQLiteCacheStore(path=path)
+    store.cache("entries", max_size=10).set_many([("a", { "n": 1 }), ("b", [1, 2])])
+
+def _evict(path, max_size):
+    store = SQLiteCacheStore(path=path)
+    md_cache = EsmondMetadataCache(None, max_size=max_size, entries=store.cache("metadata", max_size=max_size), state=store.cache("metadata_state", max_size=None))
+    md_cache._read_state()
+    md_cache.put("new", { "metadata-key": "new" })
+
+@pytest.fixture
+def store_path(tmp_path):
+    return str(tmp_path / "cache.db")
+
+def test_entries_shared_between_processes(store_path):
+    store = SQLiteCacheStore(path=store_path)
+    cache = store.cache("entries", max_size=10)
+    run_in_process(_write_entries, store_path)
+    assert cache.get("a") == { "n": 1 }
+    assert cache.get("b") == [1, 2]
+    assert len(cache) == 2
+
+def test_caches_in_one_file_are_separate(store_path):
+    store = SQLiteCacheStore(path=store_path)
+    store.cache("one").set("a", 1)
+    assert store.cache("two").get("a") is None
+
+def test_lru_eviction(store_path):
+    cache = SQLiteCacheStore(path=store_path).cache("entries", max_size=3)
+    cache.set_many([(str(i), i) for i in range(5)])
+    assert sorted(k for k, v in cache.items()) == ["2", "3", "4"]
+    assert cache.evictions == 2
+
+def test_expired_rows_purged(store_path):
+    store = SQLiteCacheStore(path=store_path, purge_interval=0)
+    cache = store.cache("entries")
+    cache.set("old", 1, ttl=0.05)
+    time.sleep(0.1)
+    assert cache.get("old") is None
+    cache.set("new", 2)
+    keys = sqlite3.connect(store_path).execute("SELECT key FROM entries WHERE cache = 'entries'").fetchall()
+    assert len(keys) == 1
+    assert cache.stats()["size"] == 1
+
+def test_incr(store_path):
+    cache = SQLiteCacheStore(path=store_path).cache("state", max_size=None)
+    assert cache.incr("version") == 1
+    assert cache.incr("version") == 2
+
+def test_lock_across_processes(store_path):
+    cache = SQLiteCacheStore(path=store_path).cache("state", max_size=None)
+    with cache.lock() as locked:
+        assert locked
+        result = fork.Queue()
+        def try_lock():
+            with cache.lock(blocking=False) as other:
+                result.put(other)
+        run_in_process(try_lock)
+        assert result.get(timeout=5) is False
+
+def test_metadata_load_shared(flask_app, store_path):
+    store = SQLiteCacheStore(path=store_path)
+    md_cache = EsmondMetadataCache(FakeMetadataES(num_tests=20), max_size=20, entries=store.cache("metadata", max_size=20), state=store.cache("metadata_state", max_size=None))
+    md_cache._refresh_due()
+    assert md_cache.complete
+
+    #another worker sees the load without searching
+    other_es = FakeMetadataES(num_tests=20)
+    other = EsmondMetadataCache(other_es, max_size=20, entries=store.cache("metadata", max_size=20), state=store.cache("metadata_state", max_size=None))
+    assert other.answers({})
+    assert len(other.list({})) == 20
+    assert other_es.searches == 0
+
+def test_eviction_in_another_process_clears_complete(flask_app, store_path):
+    store = SQLiteCacheStore(path=store_path)
+    md_cache = EsmondMetadataCache(FakeMetadataES(num_tests=20), max_size=20, entries=store.cache("metadata", max_size=20), state=store.cache("metadata_state", max_size=None))
+    md_cache._refresh_due()
+    version = md_cache.version
+    assert md_cache.answers({})
+    run_in_process(_evict, store_path, 20)
+    assert not md_cache.answers({})
+    assert md_cache.version > version
@@ -0,0 +1,25 @@
+import base64
+
+import pytest
+from util import decode_cursor, encode_cursor
+from werkzeug.exceptions import BadRequest
+
+def test_cursor_round_trip():
+    position = { "after": [1588291200000, "abc"], "offset": 10 }
+    token = encode_cursor(position)
+    assert decode_cursor(token) == position
+
+def test_cursor_url_safe():
+    token = encode_cursor({ "after": ["???>>>"] })
+    assert "+" not in token and "/" not in token
+
+@pytest.mark.parametrize("token", [
+    "not a cursor",
+    base64.urlsafe_b64encode(b"{nope").decode("ascii"),
+    base64.urlsafe_b64encode(b"[1, 2]").decode("ascii"),
+    base64.urlsafe_b64encode(b"\xff\xfe").decode("ascii"),
+    "",
+])
+def test_bad_cursor_rejected(token):
+    with pytest.raises(BadRequest):
+        decode_cursor(token)
@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+
+from utils import *
+import datetime
+import hashlib
+import random
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+DEFAULT_TESTS=100
+DEFAULT_HOSTS=20
+DEFAULT_DAYS=7
+DEFAULT_WORKERS=4
+DEFAULT_BATCH_SIZE=5000
+DEFAULT_SEED=42
+DEFAULT_TEST_TYPES="latencybg,throughput,rtt,trace"
+#Seconds between runs of each test type, like the default perfSONAR mesh
+DEFAULT_INTERVALS={
+    "latencybg": 60,
+    "throughput": 14400,
+    "rtt": 600,
+    "trace": 600
+}
+TOOLS={
+    "latencybg": "powstream",
+    "throughput": "iperf3",
+    "rtt": "ping",
+    "trace": "traceroute"
+}
+DURATIONS={
+    "latencybg": 60,
+    "throughput": 30,
+    "rtt": 10,
+    "trace": 30
+}
+#Generated documents are tagged so they can be deleted without touching real ones
+GENERATED_FIELD="reference.pselastic-generate"
+GENERATE_INDEX_PATTERN="pscheduler_*"
+#Test parameters the pipeline converts from ISO 8601 durations to seconds
+SPEC_DURATION_FIELDS={
+    "throughput": ["duration", "omit", "interval"],
+    "rtt": ["interval", "timeout", "deadline"],
+    "trace": ["sendwait", "wait"]
+}
+#Buckets in generated latency histograms
+HISTOGRAM_BUCKETS=20
+#Most tests a worker generates documents for at a time
+LOAD_CHUNK_SIZE=1000
+
+def _iso(ts):
+    return datetime.datetime.utcfromtimestamp(ts).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def _json_c14n_number(num):
+    #ES6 number formatting, ported from ruby/pscheduler_test_checksum.rb
+    if num == 0:
+        return "0"
+    sign = ""
+    if num < 0:
+        num, sign = -num, "-"
+    decimal, exponential = ("%.15E" % num).split("E")
+    exp_val = int(exponential)
+    exponential = "+{0}".format(exp_val) if exp_val > 0 else str(exp_val)
+    integral, fractional = decimal.split(".")
+    fractional = fractional.rstrip("0")
+    if 0 < exp_val < 21:
+        while exp_val > 0:
+            integral += fractional[:1] or "0"
+            fractional = fractional[1:]
+            exp_val -= 1
+        exponential = None
+    elif exp_val == 0:
+        exponential = None
+    elif -7 < exp_val < 0:
+        #small numbers are shown as 0.etc down to e-6
+        fractional = "0" * (-exp_val - 1) + integral + fractional
+        integral, exponential = "0", None
+    return sign + integral + (".{0}".format(fractional) if fractional else "") + ("e{0}".format(exponential) if exponential else "")
+
+def to_json_c14n(obj):
+    '''
+    Returns obj as canonical JSON the same way the Logstash pipeline does
+    before hashing it: keys sorted, no whitespace and ES6 number formatting
+    '''
+    if isinstance(obj, bool) or obj is None:
+        return json.dumps(obj)
+    elif isinstance(obj, (int, float)):
+        return _json_c14n_number(obj)
+    elif isinstance(obj, list):
+        return "[" + ",".join(to_json_c14n(v) for v in obj) + "]"
+    elif isinstance(obj, dict):
+        keys = sorted(obj.keys(), key=lambda k: k.encode("utf-16-be"))
+        return "{" + ",".join(json.dumps(k) + ":" + to_json_c14n(obj[k]) for k in keys) + "}"
+    return json.dumps(obj)
+
+def test_checksum(test, observer_ip, tool):
+    '''
+    Returns the pscheduler.test_checksum the pipeline gives results of test
+    '''
+    return hashlib.sha256(to_json_c14n({ "test": test, "observer_ip": observer_ip, "tool": tool }).encode("utf-8")).hexdigest()
+
+def iso8601_seconds(val):
+    '''
+    Returns a PTnS, PTnM or PTnH duration in seconds like the pipeline does or
+    val if it is not one
+    '''
+    if not isinstance(val, str) or not val.startswith("PT"):
+        return val
+    try:
+        return float(val[2:-1]) * { "S": 1, "M": 60, "H": 3600 }[val[-1]]
+    except (KeyError, ValueError):
+        return val
+
+def pipeline_test(test):
+    '''
+    Returns test with the durations the pipeline converts in seconds
+    '''
+    fields = SPEC_DURATION_FIELDS.get(test["type"], [])
+    spec = { k: iso8601_seconds(v) if k in fields else v for k, v in test["spec"].items() }
+    return { "type": test["type"], "spec": spec }
+
+def build_host(n):
+    #skip 10.0.0.0 so every host has its own address
+    addr = n + 1
+    return { "ip": "10.{0}.{1}.{2}".format((addr >> 16) & 255, (addr >> 8) & 255, addr & 255), "hostname": "ps{0}.example.net".format(n) }
+
+def build_tests(num_tests, num_hosts, test_types, seed=DEFAULT_SEED):
+    '''
+    Returns num_tests test definitions spread over test_types and pairs of
+    num_hosts hosts. Once every pair has a test of a type, a type specific
+    parameter is changed so every test has its own checksum.
+    '''
+    if num_hosts < 2:
+        raise ValueError("Tests need at least 2 hosts, got {0}".format(num_hosts))
+    hosts = [build_host(n) for n in range(num_hosts)]
+    pairs = [(s, d) for s in range(num_hosts) for d in range(num_hosts) if s != d]
+    rnd = random.Random("{0}/pairs".format(seed))
+    rnd.shuffle(pairs)
+    tests = []
+    for i in range(num_tests):
+        test_type = test_types[i % len(test_types)]
+        n = i // len(test_types)
+        variant = n // len(pairs)
+        source, dest = pairs[n % len(pairs)]
+        spec = { "schema": 1, "source": hosts[source]["ip"], "dest": hosts[dest]["ip"] }
+        if test_type == "latencybg":
+            spec.update({ "packet-count": 600, "packet-interval": 0.1, "bucket-width": 0.001, "packet-padding": variant })
+        elif test_type == "throughput":
+            spec.update({ "duration": "PT20S", "omit": "PT{0}S".format(variant), "parallel": 1 + n % 4 })
+        elif test_type == "rtt":
+            spec.update({ "count": 10, "interval": "PT1S", "length": 64 + variant })
+        elif test_type == "trace":
+            spec.update({ "algorithm": "paris-traceroute", "probe-type": "udp", "first-ttl": 1 + variant })
+        test = { "type": test_type, "spec": spec }
+        #the source runs every test so it is the observer
+        checksum = test_checksum(test, hosts[source]["ip"], TOOLS.get(test_type, test_type))
+        tests.append({
+            "id": i,
+            "checksum": checksum,
+            "test": test,
+            "source": hosts[source],
+            "dest": hosts[dest],
+            #tests don't all start on the same second
+            "phase": random.Random("{0}/{1}".format(seed, checksum)).random()
+        })
+    return tests
+
+def _stats(rnd, low, spread):
+    vals = sorted(rnd.uniform(low, low + spread) for i in range(20))
+    mean = sum(vals) / len(vals)
+    variance = sum((v - mean) ** 2 for v in vals) / len(vals)
+    return {
+        "min": vals[0], "max": vals[-1], "mean": mean, "median": vals[10], "mode": [vals[10]],
+        "p_25": vals[5], "p_75": vals[15], "p_95": vals[19], "stddev": variance ** 0.5, "variance": variance
+    }
+
+def _histogram(rnd, low, spread, total, buckets=HISTOGRAM_BUCKETS):
+    #a peak a third of the way into the range with a tail
+    width = spread / buckets
+    weights = [1.0 / (1 + abs(i - buckets // 3)) for i in range(buckets)]
+    scale = total / sum(weights)
+    values = []
+    counts = []
+    for i, weight in enumerate(weights):
+        count = int(weight * scale * rnd.uniform(0.8, 1.2))
+        if count:
+            values.append(round(low + i * width, 4))
+            counts.append(count)
+    return { "values": values, "counts": counts }
+
+def _packets(rnd, sent):
+    lost = rnd.choice([0] * 9 + [rnd.randint(1, max(sent // 50, 1))])
+    return { "sent": sent, "lost": lost, "duplicated": 0, "reordered": rnd.choice([0] * 19 + [1]), "loss": float(lost) / sent }
+
+def _interval(rnd, start, rate, stream_id=None):
+    interval = { "start": start, "end": start + 1.0, "throughput": rnd.gauss(rate, rate * 0.05), "retransmits": rnd.choice([0] * 4 + [rnd.randint(1, 50)]) }
+    if stream_id is not None:
+        interval["stream-id"] = stream_id
+    return interval
+
+def build_result(rnd, test):
+    '''
+    Returns the result object of a run the way the pscheduler Logstash
+    pipeline stores it
+    '''
+    test_type = test["test"]["type"]
+    #base latency depends on the pair so the same test looks consistent
+    base = 1 + (test["id"] * 7919 % 100)
+    if test_type == "latencybg":
+        stats = _stats(rnd, base, 2)
+        stats["histogram"] = _histogram(rnd, base, 2, 600)
+        ttl = _stats(rnd, 250, 0)
+        ttl["histogram"] = { "values": [250], "counts": [600] }
+        return {
+            "succeeded": True,
+            "latency": stats,
+            "ttl": ttl,
+            "packets": _packets(rnd, 600),
+            "max_clock_error": rnd.uniform(0.5, 5)
+        }
+    elif test_type == "throughput":
+        rate = 1e9 * (1 + test["id"] % 10)
+        streams = test["test"]["spec"].get("parallel", 1)
+        intervals = [{
+            "summary": _interval(rnd, float(i), rate),
+            "streams": [_interval(rnd, float(i), rate / streams, stream_id=s + 1) for s in range(streams)]
+        } for i in range(20)]
+        return {
+            "succeeded": True,
+            "throughput": sum(i["summary"]["throughput"] for i in intervals) / len(intervals),
+            "retransmits": sum(i["summary"]["retransmits"] for i in intervals),
+            "intervals": { "json": intervals },
+            "streams": { "json": [dict(_interval(rnd, 0.0, rate, stream_id=s + 1), end=20.0) for s in range(streams)] }
+        }
+    elif test_type == "rtt":
+        #ping reports seconds
+        stats = _stats(rnd, base / 1000.0, 0.002)
+        stats["histogram"] = _histogram(rnd, base / 1000.0, 0.002, 10, buckets=5)
+        ttl = _stats(rnd, 60, 0)
+        ttl["histogram"] = { "values": [60], "counts": [10] }
+        return { "succeeded": True, "rtt": stats, "ttl": ttl, "packets": _packets(rnd, 10) }
+    elif test_type == "trace":
+        hops = []
+        for ttl in range(1, 6 + test["id"] % 10):
+            hops.append({
+                "ip": "172.16.{0}.{1}".format(test["id"] % 256, ttl),
+                "hostname": "hop{0}.net{1}.example.net".format(ttl, test["id"] % 256),
+                "as": { "number": 64512 + ttl, "owner": "EXAMPLE" },
+                "rtt": "PT{0:.6f}S".format(base / 1000.0 * ttl / 10 + rnd.uniform(0, 0.0005)),
+                "mtu": 9000 if ttl == 1 else None
+            })
+        return { "succeeded": True, "json": [hops], "mtu": 9000 }
+    return { "succeeded": True }
+
+def build_document(rnd, test, start_time, seed=DEFAULT_SEED):
+    '''
+    Returns the index, id and source of one run of test
+    '''
+    test_type = test["test"]["type"]
+    duration = DURATIONS.get(test_type, 30)
+    #logstash names the daily index by the time the result was archived
+    archived = start_time + duration + rnd.uniform(1, 30)
+    #ids depend only on the run so loading again overwrites instead of duplicating
+    doc_id = hashlib.sha1("{0}/{1}".format(test["checksum"], start_time).encode("utf-8")).hexdigest()
+    doc = {
+        "@timestamp": _iso(archived),
+        "pscheduler": {
+            "test_checksum": test["checksum"],
+            "start_time": _iso(start_time),
+            "end_time": _iso(start_time + duration),
+            "duration": float(duration),
+            "tool": TOOLS.get(test_type, test_type),
+            "added": _iso(start_time - 60),
+            "participants": [test["source"]["hostname"], test["dest"]["hostname"]],
+            #elmond breaks ties between results with the same time on this
+            "run_href": "https://{0}/pscheduler/tasks/{1}/runs/{2}".format(test["source"]["ip"], test["checksum"], doc_id)
+        },
+        "test": pipeline_test(test["test"]),
+        "meta": {
+            "observer": dict(test["source"]),
+            "source": dict(test["source"]),
+            "destination": dict(test["dest"])
+        },
+        "reference": { "pselastic-generate": seed },
+        "result": build_result(rnd, test)
+    }
+    index = "pscheduler_{0}-{1}".format(test_type, datetime.datetime.utcfromtimestamp(archived).strftime("%Y.%m.%d"))
+    return index, doc_id, doc
+
+def iter_documents(tests, day_start, interval_overrides={}, seed=DEFAULT_SEED):
+    '''
+    Yields (index, id, source) for every run of tests that starts in the day
+    starting at day_start
+    '''
+    for test in tests:
+        test_type = test["test"]["type"]
+        interval = interval_overrides.get(test_type, DEFAULT_INTERVALS.get(test_type, 600))
+        rnd = random.Random("{0}/{1}/{2}".format(seed, test["checksum"], day_start))
+        start_time = day_start + int(test["phase"] * interval)
+        while start_time < day_start + 86400:
+            yield build_document(rnd, test, start_time, seed=seed)
+            start_time += interval
+
+def build_bulk_body(docs):
+    lines = []
+    for index, doc_id, doc in docs:
+        lines.append(json.dumps({ "index": { "_index": index, "_id": doc_id } }))
+        lines.append(json.dumps(doc))
+    return "\n".join(lines) + "\n"
+
+#Tests each worker process builds once when it starts
+_worker_tests = None
+
+def _init_worker(num_tests, num_hosts, test_types, seed):
+    global _worker_tests
+    _worker_tests = build_tests(num_tests, num_hosts, test_types, seed=seed)
+
+def load_chunk(elastic_url, auth, day_start, first_test, last_test, batch_size, interval_overrides, seed):
+    '''
+    Generates the documents of tests first_test to last_test for one day and
+    sends them in batches with the bulk API. Runs in a worker process. Returns
+    the number of documents sent and how many of them failed.
+    '''
+    session = requests.Session()
+    session.auth = auth
+    url = "{0}/_bulk".format(elastic_url)
+    sent = 0
+    failed = 0
+    batch = []
+    def flush():
+        r = session.post(url=url, data=build_bulk_body(batch), headers={ "Content-Type": "application/x-ndjson" })
+        r.raise_for_status()
+        result = r.json()
+        if result.get("errors", False):
+            return len([i for i in result.get("items", []) if list(i.values())[0].get("error", None)])
+        return 0
+    tests = _worker_tests[first_test:last_test]
+    for doc in iter_documents(tests, day_start, interval_overrides=interval_overrides, seed=seed):
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            failed += flush()
+            sent += len(batch)
+            batch = []
+    if batch:
+        failed += flush()
+        sent += len(batch)
+    return sent, failed
+
+def at_least(minimum):
+    '''
+    Returns an argparse type for integers no smaller than minimum
+    '''
+    def parse(val):
+        num = int(val)
+        if num < minimum:
+            raise argparse.ArgumentTypeError("must be at least {0}".format(minimum))
+        return num
+    return parse
+
+class PSElasticGenerateUtil(PSElasticUtil):
+
+    def __init__(self):
+        self.resource = 'generate'
+        self.valid_actions = [ "load", "print", "delete" ]
+
+    def build_arg_parser(self):
+        args = super().build_arg_parser()
+        args.add_argument('--tests', dest='tests', default=DEFAULT_TESTS, type=int, help='Number of tests to generate')
+        args.add_argument('--skip-tests', dest='skip_tests', default=0, type=int, help='Do not generate documents for this many of the first tests, e.g. because they were loaded before')
+        args.add_argument('--hosts', dest='hosts', default=DEFAULT_HOSTS, type=at_least(2), help='Number of hosts the tests run between')
+        args.add_argument('--days', dest='days', default=DEFAULT_DAYS, type=int, help='Number of days of results to generate, ending today')
+        args.add_argument('--end-date', dest='end_date', default=None, type=str, help='Last day to generate results for as YYYY-MM-DD. Defaults to today.')
+        args.add_argument('--test-types', dest='test_types', default=DEFAULT_TEST_TYPES, type=str, help='Comma-separated list of test types to generate')
+        args.add_argument('--interval', dest='intervals', action='append', default=[], type=str, help='Seconds between runs of a test type as TYPE=SECONDS. Can be given more than once.')
+        args.add_argument('--workers', dest='workers', default=DEFAULT_WORKERS, type=at_least(1), help='Number of processes generating and sending documents')
+        args.add_argument('--batch-size', dest='batch_size', default=DEFAULT_BATCH_SIZE, type=at_least(1), help='Number of documents per bulk request')
+        args.add_argument('--seed', dest='seed', default=DEFAULT_SEED, type=int, help='Seed for the random values. The same seed generates the same documents.')
+        return args
+
+    def get_days(self, args):
+        end = datetime.datetime.utcnow().date()
+        if args.end_date:
+            end = datetime.datetime.strptime(args.end_date, "%Y-%m-%d").date()
+        epoch = datetime.date(1970, 1, 1)
+        return [((end - epoch).days - d) * 86400 for d in range(args.days - 1, -1, -1)]
+
+    def get_test_types(self, args):
+        return [t.strip() for t in args.test_types.split(",") if t.strip()]
+
+    def get_interval_overrides(self, args):
+        overrides = {}
+        for interval in args.intervals:
+            test_type, _, seconds = interval.partition("=")
+            overrides[test_type] = int(seconds)
+        return overrides
+
+    def test_elastic(self, args):
+        #printing doesn't need elastic
+        if args.action[0] == "print":
+            return True
+        return super().test_elastic(args)
+
+    def load(self, args):
+        days = self.get_days(args)
+        overrides = self.get_interval_overrides(args)
+        #split each day into chunks of tests so the workers stay busy
+        chunk_size = max(min(LOAD_CHUNK_SIZE, (args.tests - args.skip_tests) // args.workers), 1)
+        chunks = [(first, min(first + chunk_size, args.tests)) for first in range(args.skip_tests, args.tests, chunk_size)]
+        self.log.info("resource=generate action=load.start tests={0} days={1} workers={2}".format(args.tests - args.skip_tests, len(days), args.workers))
+        start = time.time()
+        sent = 0
+        failed = 0
+        initargs = (args.tests, args.hosts, self.get_test_types(args), args.seed)
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker, initargs=initargs) as pool:
+            futures = [pool.submit(load_chunk, args.elastic_url, self.auth, day, first, last, args.batch_size, overrides, args.seed) for day in days for first, last in chunks]
+            for future in as_completed(futures):
+                try:
+                    chunk_sent, chunk_failed = future.result()
+                    sent += chunk_sent
+                    failed += chunk_failed
+                except:
+                    self.log.error("resource=generate action=load.error msg={0}".format(sys.exc_info()))
+                self.log.debug("resource=generate action=load.progress docs={0} seconds={1:.1f}".format(sent, time.time() - start))
+        elapsed = time.time() - start
+        requests.post(url="{0}/{1}/_refresh".format(args.elastic_url, GENERATE_INDEX_PATTERN), auth=self.auth)
+        self.log.info("resource=generate action=load.end docs={0} failed={1} seconds={2:.1f} docs_per_second={3:.0f}".format(sent, failed, elapsed, sent / elapsed if elapsed else 0))
+
+    def print_docs(self, args):
+        tests = build_tests(args.tests, args.hosts, self.get_test_types(args), seed=args.seed)[args.skip_tests:]
+        overrides = self.get_interval_overrides(args)
+        for day in self.get_days(args):
+            batch = []
+            for doc in iter_documents(tests, day, interval_overrides=overrides, seed=args.seed):
+                batch.append(doc)
+                if len(batch) >= args.batch_size:
+                    sys.stdout.write(build_bulk_body(batch))
+                    batch = []
+            if batch:
+                sys.stdout.write(build_bulk_body(batch))
+
+    def delete(self, args):
+        url = "{0}/{1}/_delete_by_query".format(args.elastic_url, GENERATE_INDEX_PATTERN)
+        dsl = { "query": { "exists": { "field": GENERATED_FIELD } } }
+        try:
+            self.log.debug("resource=generate action=delete.start url={0}".format(url))
+            r = requests.post(url=url, json=dsl, auth=self.auth, params={ "conflicts": "proceed" })
+            r.raise_for_status()
+            self.log.info("resource=generate action=delete.end url={0} deleted={1}".format(url, r.json().get("deleted", None)))
+        except:
+            self.log.error("resource=generate action=delete.error url={0} msg={1}".format(url, sys.exc_info()))
+
+    def handle_command(self, args):
+        action = args.action[0]
+        if action == "load":
+            self.load(args)
+        elif action == "print":
+            self.print_docs(args)
+        elif action == "delete":
+            self.delete(args)
+        else:
+            self.log.error("Unknown action {0}".format(action))
+            sys.exit(1)
+
+'''
+Handle when called from command-line
+'''
+if __name__ == "__main__":
+    PSElasticGenerateUtil().run()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+from utils import *
+import datetime
+
+METADATA_INDEX="pscheduler_metadata"
+#Raw result indices are named pscheduler_<test type>-<date>. The hyphen keeps
+# the metadata index out of the pattern.
+RESULT_INDEX_PATTERN="pscheduler_*-*"
+DEFAULT_PAGE_SIZE=500
+DEFAULT_OVERLAP=300
+
+class PSElasticMetadataUtil(PSElasticUtil):
+
+    def __init__(self):
+        self.resource = 'metadata'
+        self.valid_actions = [ "install", "update", "cleanup" ]
+        self.last_update = None
+
+    '''
+    Check if the metadata index exists since it can only be created once
+    '''
+    def need_index(self, index_name, index, elastic_url):
+        url = "{0}/{1}".format(elastic_url, index_name)
+        try:
+            self.log.debug("resource=metadata action=check_index.start url={0}".format(url))
+            r = requests.head(url=url, auth=self.auth)
+            self.log.debug("resource=metadata action=check_index.end url={0} status={1}".format(url, r.status_code))
+            if r.status_code == 200:
+                return False
+        except:
+            self.log.error("resource=metadata action=check_index.error url={0} msg={1}".format(url, sys.exc_info()))
+            return False
+
+        return True
+
+    '''
+    The pscheduler index template attaches the ILM policy to anything matching
+    pscheduler_*, but the metadata index is not a time-based index so remove it
+    '''
+    def remove_ilm(self, index_name, index, elastic_url):
+        url = "{0}/{1}/_ilm/remove".format(elastic_url, index_name)
+        try:
+            self.log.debug("resource=metadata action=remove_ilm.start url={0}".format(url))
+            r = requests.post(url=url, auth=self.auth)
+            r.raise_for_status()
+            self.log.debug("resource=metadata action=remove_ilm.end url={0} status={1} elastic_reponse={2}".format(url, r.status_code, r.text))
+        except:
+            self.log.error("resource=metadata action=remove_ilm.error url={0} msg={1}".format(url, sys.exc_info()))
+
+    '''
+    Find the last time the metadata index was updated so we can pick-up where
+    we left off after a restart
+    '''
+    def get_last_seen(self, elastic_url):
+        url = "{0}/{1}/_search".format(elastic_url, METADATA_INDEX)
+        dsl = {
+            "size": 0,
+            "aggs": {
+                "last_seen": { "max": { "field": "last_seen" } }
+            }
+        }
+        r = requests.post(url=url, json=dsl, auth=self.auth)
+        r.raise_for_status()
+        return r.json().get("aggregations", {}).get("last_seen", {}).get("value_as_string", None)
+
+    '''
+    Walk every test that has run since the given time using a composite
+    aggregation and yield one metadata document per test checksum
+    '''
+    def iter_tests(self, elastic_url, since=None, page_size=DEFAULT_PAGE_SIZE):
+        url = "{0}/{1}/_search".format(elastic_url, RESULT_INDEX_PATTERN)
+        after_key = None
+        while True:
+            dsl = {
+                "size": 0,
+                "aggs": {
+                    "tests": {
+                        "composite": {
+                            "size": page_size,
+                            "sources": [
+                                { "checksum": { "terms": { "field": "pscheduler.test_checksum.keyword" } } }
+                            ]
+                        },
+                        "aggs": {
+                            "test_params": {
+                                "top_hits": {
+                                    "size": 1,
+                                    "sort": [ { "pscheduler.start_time": { "order": "desc" } } ],
+                                    "_source": ["test.*", "meta.*", "pscheduler.*", "reference.*"]
+                                }
+                            },
+                            "first_seen": { "min": { "field": "pscheduler.start_time" } },
+                            "last_seen": { "max": { "field": "pscheduler.start_time" } }
+                        }
+                    }
+                }
+            }
+            if after_key:
+                dsl["aggs"]["tests"]["composite"]["after"] = after_key
+            if since:
+                dsl["query"] = { "range": { "pscheduler.start_time": { "gte": since } } }
+            r = requests.post(url=url, json=dsl, auth=self.auth, params={ "ignore_unavailable": "true" })
+            r.raise_for_status()
+            tests_agg = r.json().get("aggregations", {}).get("tests", {})
+            buckets = tests_agg.get("buckets", [])
+            for bucket in buckets:
+                hits = bucket.get("test_params", {}).get("hits", {}).get("hits", [])
+                if not hits:
+                    continue
+                doc = hits[0].get("_source", {})
+                doc["first_seen"] = bucket.get("first_seen", {}).get("value_as_string", None)
+                doc["last_seen"] = bucket.get("last_seen", {}).get("value_as_string", None)
+                yield bucket.get("key", {}).get("checksum"), doc
+            after_key = tests_agg.get("after_key", None)
+            if len(buckets) < page_size or after_key is None:
+                break
+
+    '''
+    Upsert a batch of metadata documents with the bulk API. first_seen is only
+    set when the document is created.
+    '''
+    def bulk_update(self, docs, elastic_url):
+        lines = []
+        for checksum, doc in docs:
+            update_doc = dict(doc)
+            update_doc.pop("first_seen", None)
+            lines.append(json.dumps({ "update": { "_index": METADATA_INDEX, "_id": checksum } }))
+            lines.append(json.dumps({ "doc": update_doc, "upsert": doc }))
+        url = "{0}/_bulk".format(elastic_url)
+        r = requests.post(
+            url=url,
+            data="\n".join(lines) + "\n",
+            headers={ "Content-Type": "application/x-ndjson" },
+            auth=self.auth
+        )
+        r.raise_for_status()
+        if r.json().get("errors", False):
+            self.log.error("resource=metadata action=bulk_update.error url={0} elastic_reponse={1}".format(url, r.text))
+
+    '''
+    Add or update the metadata for every test that has run since the last update
+    '''
+    def update(self, elastic_url, overlap=DEFAULT_OVERLAP, page_size=DEFAULT_PAGE_SIZE):
+        start = datetime.datetime.utcnow()
+        since = None
+        try:
+            if self.last_update:
+                since = (self.last_update - datetime.timedelta(seconds=overlap)).isoformat() + "Z"
+            else:
+                last_seen = self.get_last_seen(elastic_url)
+                if last_seen:
+                    since = "{0}||-{1}s".format(last_seen, overlap)
+            self.log.debug("resource=metadata action=update.start since={0}".format(since))
+            count = 0
+            batch = []
+            for checksum, doc in self.iter_tests(elastic_url, since=since, page_size=page_size):
+                batch.append((checksum, doc))
+                if len(batch) >= page_size:
+                    self.bulk_update(batch, elastic_url)
+                    count += len(batch)
+                    batch = []
+            if batch:
+                self.bulk_update(batch, elastic_url)
+                count += len(batch)
+            self.last_update = start
+            self.log.info("resource=metadata action=update.end since={0} tests={1}".format(since, count))
+        except:
+            self.log.error("resource=metadata action=update.error since={0} msg={1}".format(since, sys.exc_info()))
+
+    def build_arg_parser(self):
+        args = super().build_arg_parser()
+        args.add_argument('--overlap', dest='overlap', default=DEFAULT_OVERLAP, type=int, help='Seconds before the last update to look for new results when updating, to account for ingest delays.')
+        args.add_argument('--page-size', dest='page_size', default=DEFAULT_PAGE_SIZE, type=int, help='Number of tests to aggregate and index per request when updating.')
+        return args
+
+    def handle_command(self, args):
+        action = args.action[0]
+        if action == "install":
+            self.load_from_file(
+                action,
+                config_dir=args.config_dir,
+                elastic_url=args.elastic_url,
+                pre_func=self.need_index,
+                post_func=self.remove_ilm
+            )
+        elif action == "update":
+            self.update(args.elastic_url, overlap=args.overlap, page_size=args.page_size)
+        elif action == "cleanup":
+            self.load_from_file(
+                action,
+                url_path_suffix="_delete_by_query",
+                config_dir=args.config_dir,
+                elastic_url=args.elastic_url,
+                http_method=requests.post
+            )
+        else:
+            log.error("Unknown action {0}".format(action))
+            sys.exit(1)
+
+'''
+Handle when called from command-line
+'''
+if __name__ == "__main__":
+    PSElasticMetadataUtil().run()
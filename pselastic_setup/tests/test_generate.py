@@ -0,0 +1,41 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pselastic"))
+
+from generate import build_tests, test_checksum as checksum, to_json_c14n
+
+TEST = {
+    "type": "latencybg",
+    "spec": {
+        "schema": 1, "source": "10.0.0.1", "dest": "10.0.0.2", "packet-interval": 0.1, "packet-count": 600,
+        "bucket-width": 0.001, "ip-tos": 0, "data-ports": { "lower": 8760, "upper": 9960 }, "flip": False,
+        "Z": 1.5e-7, "big": 1e21
+    }
+}
+#the output of to_json_c14n and the digest in pscheduler_test_checksum.rb for TEST
+RUBY_C14N = '{"observer_ip":"10.0.0.1","test":{"spec":{"Z":1.5e-7,"big":1e+21,"bucket-width":0.001,"data-ports":{"lower":8760,"upper":9960},"dest":"10.0.0.2","flip":false,"ip-tos":0,"packet-count":600,"packet-interval":0.1,"schema":1,"source":"10.0.0.1"},"type":"latencybg"},"tool":"owping"}'
+RUBY_CHECKSUM = "32d9b69b458c982931c29b2d1a51de8a1bc3b04e6916c10ea60c65a774bcfbea"
+
+def test_c14n_matches_ruby():
+    assert to_json_c14n({ "test": TEST, "observer_ip": "10.0.0.1", "tool": "owping" }) == RUBY_C14N
+
+def test_checksum_matches_ruby():
+    assert checksum(TEST, "10.0.0.1", "owping") == RUBY_CHECKSUM
+
+#also what the ruby version writes
+@pytest.mark.parametrize("num,expected", [(0, "0"), (-2, "-2"), (100, "100"), (0.5, "0.5"), (1e21, "1e+21"), (1e-7, "1e-7"), (0.000001, "0.000001"), (123456.789, "123456.789")])
+def test_c14n_numbers(num, expected):
+    assert to_json_c14n(num) == expected
+
+def test_tests_have_unique_checksums():
+    tests = build_tests(200, 3, ["latencybg", "throughput"])
+    assert len(tests) == 200
+    assert len(set(t["checksum"] for t in tests)) == 200
+
+@pytest.mark.parametrize("num_hosts", [0, 1])
+def test_too_few_hosts(num_hosts):
+    with pytest.raises(ValueError):
+        build_tests(10, num_hosts, ["latencybg"])